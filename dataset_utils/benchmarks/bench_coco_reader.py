@@ -0,0 +1,167 @@
+import os
+import sys
+
+# Get the dataset_utils and format_converters directories
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+converters_dir = os.path.join(root_dir, "format_converters")
+
+# Add them to the search path
+sys.path.append(root_dir)
+sys.path.append(converters_dir)
+
+
+import json
+import random
+import resource
+import tempfile
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+from coco_utils import CocoJsonWriter, read_coco_instances
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--size-gb",
+        type=float,
+        help="Approximate size of the synthetic instances json file in GB",
+        default=2.0,
+    )
+    parser.add_argument(
+        "--boxes-per-image",
+        type=int,
+        help="Number of annotations of each image",
+        default=8,
+    )
+    parser.add_argument(
+        "--points-per-polygon",
+        type=int,
+        help="Number of points of the segmentation of each annotation, like LVIS",
+        default=16,
+    )
+    parser.add_argument(
+        "--json",
+        type=str,
+        help="Reuse an existing instances json file instead of generating one",
+        default=None,
+    )
+
+    return parser.parse_args()
+
+
+def write_synthetic_instances(
+    json_path: Path,
+    size_gb: float,
+    boxes_per_image: int,
+    points_per_polygon: int,
+    num_categories: int = 1000,
+):
+    """Write a COCO instances json file of about size_gb, images are not created"""
+
+    rng = random.Random(0)
+    categories = [{"id": i, "name": f"category{i}"} for i in range(1, num_categories + 1)]
+
+    def make_batch(first_img_id: int, first_annot_id: int) -> tuple[list, list]:
+        images, annotations = [], []
+        for img_id in range(first_img_id, first_img_id + 1000):
+            images.append(
+                {"id": img_id, "file_name": f"{img_id:012d}.jpg", "width": 640, "height": 480}
+            )
+            for _ in range(boxes_per_image):
+                x, y = rng.uniform(0, 600), rng.uniform(0, 440)
+                polygon = [
+                    round(v, 2)
+                    for _ in range(points_per_polygon)
+                    for v in (x + rng.uniform(0, 40), y + rng.uniform(0, 40))
+                ]
+                annotations.append(
+                    {
+                        "id": first_annot_id + len(annotations),
+                        "image_id": img_id,
+                        "category_id": rng.randint(1, num_categories),
+                        "segmentation": [polygon],
+                        "area": 1600.0,
+                        "bbox": [round(x, 2), round(y, 2), 40.0, 40.0],
+                        "iscrowd": 0,
+                    }
+                )
+        return images, annotations
+
+    with CocoJsonWriter(json_path, categories, compact=True) as writer:
+        images, annotations = make_batch(1, 1)
+        batch_size = len(json.dumps([images, annotations], separators=(",", ":")))
+        num_batches = max(1, int(size_gb * 1e9 / batch_size))
+
+        for _ in range(num_batches):
+            writer.add_images(images)
+            writer.add_annotations(annotations)
+            images, annotations = make_batch(
+                writer.num_images + 1, writer.num_annotations + 1
+            )
+
+
+def _run_reader(json_path: str, stream: bool) -> tuple[float, float, int, int, bytes]:
+    """Read the file in a fresh process and return time, peak RSS and a digest"""
+
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    ds = read_coco_instances(json_path, Path(json_path).parent, stream=stream)
+    elapsed = perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    digest = np.concatenate(
+        [ds.image_ids.astype(np.float64), ds.boxes.ravel(), ds.box_classes.astype(np.float64)]
+    )
+    return (
+        elapsed,
+        (peak_rss - base_rss) / 1024,
+        ds.num_images,
+        ds.num_boxes,
+        digest.sum().tobytes() + digest[::997].tobytes(),
+    )
+
+
+def run_reader(json_path: Path, stream: bool):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(_run_reader, str(json_path), stream).result()
+
+
+def main():
+    args = get_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_path = Path(args.json) if args.json else Path(tmp_dir) / "instances_bench.json"
+
+        if not args.json:
+            start = perf_counter()
+            write_synthetic_instances(
+                json_path,
+                size_gb=args.size_gb,
+                boxes_per_image=args.boxes_per_image,
+                points_per_polygon=args.points_per_polygon,
+            )
+            print(f"Synthetic instances written in {perf_counter() - start:.2f}s")
+
+        size_mb = json_path.stat().st_size / 1e6
+
+        # the streaming reader runs first, the other one may run out of memory
+        stream_time, stream_mb, num_images, num_boxes, stream_digest = run_reader(
+            json_path, stream=True
+        )
+        print(f"File: {size_mb:.0f} MB, images: {num_images}, annotations: {num_boxes}")
+        print(f"streaming reader: {stream_time:.2f}s, peak memory +{stream_mb:.0f} MB")
+
+        load_time, load_mb, _, _, load_digest = run_reader(json_path, stream=False)
+        print(f"json.load reader: {load_time:.2f}s, peak memory +{load_mb:.0f} MB")
+
+    if stream_digest != load_digest:
+        raise RuntimeError("Results of the readers differ")
+
+
+if __name__ == "__main__":
+    main()
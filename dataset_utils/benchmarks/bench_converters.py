@@ -0,0 +1,290 @@
+import os
+import sys
+
+# Get the dataset_utils and format_converters directories
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+converters_dir = os.path.join(root_dir, "format_converters")
+
+# Add them to the search path
+sys.path.append(root_dir)
+sys.path.append(converters_dir)
+
+
+import datetime as dt
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from synthetic_datasets import parse_image_size, write_synthetic_dataset
+
+# Converters under format_converters/, with the format of their source dataset
+# and their extra arguments. "images" is a flat directory of images.
+CONVERTERS = {
+    "cvat_to_yolo": ("cvat", []),
+    "cvat_to_coco": ("cvat", []),
+    "cvat_to_imagenet": ("cvat", []),
+    "yolo_to_coco": ("yolo", ["--no-cache"]),
+    "yolo_to_cvat": ("yolo", ["--no-cache"]),
+    "yolo_to_imagenet": ("yolo", ["--no-cache"]),
+    "coco_to_imagenet": ("coco", []),
+    "imagenet_to_cvat": ("imagenet", []),
+    "images_folder_to_yolo": ("images", []),
+    "convert": ("coco", ["--from", "coco", "--to", "yolo", "--no-cache"]),
+}
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--converter",
+        type=str,
+        action="append",
+        choices=list(CONVERTERS),
+        help="Converter to benchmark, all converters by default",
+        default=[],
+    )
+    parser.add_argument(
+        "--num-images",
+        type=int,
+        help="Number of images of the synthetic datasets",
+        default=1000,
+    )
+    parser.add_argument(
+        "--boxes-per-image",
+        type=int,
+        help="Number of boxes of each image",
+        default=5,
+    )
+    parser.add_argument(
+        "--num-classes",
+        type=int,
+        help="Number of classes of the synthetic datasets",
+        default=10,
+    )
+
+    # Example --image-size 640x480 --image-size 1920x1080
+    parser.add_argument(
+        "--image-size",
+        type=str,
+        action="append",
+        help="Size of the images as WIDTHxHEIGHT, each image picks one of the given sizes",
+        default=[],
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of workers of the converters",
+        default=4,
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        help="Number of runs of each converter, the fastest run is kept",
+        default=1,
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=str,
+        help="Directory of the synthetic datasets, they are generated once and "
+        "reused by later benchmarks. A temporary directory by default",
+        default=None,
+    )
+    parser.add_argument(
+        "--output-json",
+        type=str,
+        help="Path to the json file of the results",
+        default=None,
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="Json results of a previous run, to compare the wall times with",
+        default=None,
+    )
+
+    return parser.parse_args()
+
+
+def count_files(path: Path) -> int:
+    return sum(len(files) for _, _, files in os.walk(path))
+
+
+def run_converter(
+    name: str,
+    src_dir: Path,
+    output_dir: Path,
+    workers: int,
+    log_path: Path,
+) -> dict:
+    """Run a converter in a new process and measure it
+
+    The image metadata cache of the converter is a new file for every run, so
+    image sizes are always probed.
+
+    Returns:
+        dict: wall time in seconds, peak RSS in MB of the converter process
+            (including the worker processes it waited for), number of output
+            files and files written per second
+    """
+
+    _, extra_args = CONVERTERS[name]
+    cmd = [
+        sys.executable,
+        os.path.join(converters_dir, f"{name}.py"),
+        "--src",
+        str(src_dir),
+        "--output",
+        str(output_dir),
+        "--workers",
+        str(workers),
+        *extra_args,
+    ]
+    env = dict(os.environ, IMAGE_META_CACHE=str(output_dir) + ".sqlite3")
+
+    # the converters import their modules from the working directory
+    with log_path.open("w") as log:
+        start = perf_counter()
+        proc = subprocess.Popen(cmd, cwd=root_dir, env=env, stdout=log, stderr=log)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall_time = perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    Path(env["IMAGE_META_CACHE"]).unlink(missing_ok=True)
+
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"{name} failed with exit code {proc.returncode}:\n{log_path.read_text()[-2000:]}"
+        )
+
+    num_files = count_files(output_dir)
+    return {
+        "wall_time": round(wall_time, 4),
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "files": num_files,
+        "files_per_s": round(num_files / max(wall_time, 1e-9), 1),
+    }
+
+
+def prepare_source(
+    src_format: str,
+    data_dir: Path,
+    num_images: int,
+    boxes_per_image: int,
+    num_classes: int,
+    image_sizes: list[tuple[int, int]],
+) -> Path:
+    """Return the synthetic dataset of a format, generate it if it does not exist"""
+
+    # a flat directory of images is the train images of a YOLO dataset
+    if src_format == "images":
+        yolo_dir = prepare_source(
+            "yolo", data_dir, num_images, boxes_per_image, num_classes, image_sizes
+        )
+        return yolo_dir / "images" / "train"
+
+    key = f"{src_format}_{num_images}_{boxes_per_image}_{num_classes}_" + "_".join(
+        f"{w}x{h}" for w, h in image_sizes
+    )
+    src_dir = data_dir / key
+    if not src_dir.exists():
+        write_synthetic_dataset(
+            src_format,
+            src_dir,
+            num_images,
+            boxes_per_image=boxes_per_image,
+            num_classes=num_classes,
+            image_sizes=image_sizes,
+        )
+    return src_dir
+
+
+def print_results(results: dict, baseline: dict | None):
+    header = f"{'converter':<24}{'wall time':>12}{'peak RSS':>12}{'files':>10}{'files/s':>12}"
+    if baseline is not None:
+        header += f"{'vs baseline':>14}"
+    print(header)
+
+    for name, result in results.items():
+        line = (
+            f"{name:<24}{result['wall_time']:>11.2f}s{result['peak_rss_mb']:>9.0f} MB"
+            f"{result['files']:>10}{result['files_per_s']:>12.1f}"
+        )
+        previous = (baseline or {}).get(name)
+        if previous is not None:
+            ratio = result["wall_time"] / max(previous["wall_time"], 1e-9)
+            line += f"{ratio:>13.2f}x"
+        print(line)
+
+
+def main():
+    args = get_args()
+
+    names = args.converter or list(CONVERTERS)
+    image_sizes = [parse_image_size(size) for size in args.image_size] or [(640, 480)]
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix="bench_converters_"))
+    data_dir = Path(args.data_dir) if args.data_dir else tmp_dir / "data"
+    data_dir.mkdir(parents=True, exist_ok=True)
+
+    results = {}
+    try:
+        for name in names:
+            src_dir = prepare_source(
+                CONVERTERS[name][0],
+                data_dir,
+                args.num_images,
+                args.boxes_per_image,
+                args.num_classes,
+                image_sizes,
+            )
+
+            # the fastest run is the least disturbed by the rest of the system
+            runs = []
+            for k in range(args.repeat):
+                output_dir = tmp_dir / f"{name}_{k}"
+                runs.append(
+                    run_converter(
+                        name, src_dir, output_dir, args.workers, tmp_dir / f"{name}.log"
+                    )
+                )
+                shutil.rmtree(output_dir)
+            results[name] = min(runs, key=lambda run: run["wall_time"])
+            print(f"{name}: {results[name]['wall_time']:.2f}s")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print_results(results, baseline)
+
+    if args.output_json:
+        report = {
+            "date": dt.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "params": {
+                "num_images": args.num_images,
+                "boxes_per_image": args.boxes_per_image,
+                "num_classes": args.num_classes,
+                "image_sizes": [f"{w}x{h}" for w, h in image_sizes],
+                "workers": args.workers,
+                "repeat": args.repeat,
+            },
+            "results": results,
+        }
+        with open(args.output_json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
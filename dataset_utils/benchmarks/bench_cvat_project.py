@@ -0,0 +1,155 @@
+import os
+import sys
+
+# Get the dataset_utils and format_converters directories
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+converters_dir = os.path.join(root_dir, "format_converters")
+
+# Add them to the search path
+sys.path.append(root_dir)
+sys.path.append(converters_dir)
+
+
+import random
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from cvat_utils import iter_cvat_images, read_cvat_annotation_xml
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--num-annotations",
+        type=int,
+        help="Number of box annotations in the synthetic project",
+        default=500_000,
+    )
+    parser.add_argument(
+        "--boxes-per-image",
+        type=int,
+        help="Number of boxes of each image",
+        default=5,
+    )
+    parser.add_argument(
+        "--num-subsets",
+        type=int,
+        help="Number of subsets of the synthetic project",
+        default=8,
+    )
+    parser.add_argument(
+        "--num-labels",
+        type=int,
+        help="Number of labels of the synthetic project",
+        default=20,
+    )
+
+    return parser.parse_args()
+
+
+def write_synthetic_project(
+    xml_path: Path,
+    num_annotations: int,
+    boxes_per_image: int,
+    num_subsets: int,
+    num_labels: int,
+):
+    """Write a CVAT project annotation XML file, images are not created"""
+
+    rng = random.Random(0)
+    subsets = [f"subset{i}" for i in range(num_subsets)]
+    labels = [f"label{i}" for i in range(num_labels)]
+
+    with xml_path.open("w") as f:
+        f.write("<?xml version='1.0' encoding='utf-8'?>\n<annotations>\n")
+        f.write("<version>1.1</version>\n<meta><project><name>synthetic</name>")
+        f.write(f"<subsets>{chr(10).join(subsets)}</subsets><labels>")
+        for label in labels:
+            f.write(f"<label><name>{label}</name><type>rectangle</type><color>#ff0000</color></label>")
+        f.write("</labels><tasks>")
+        for i, subset in enumerate(subsets):
+            f.write(f"<task><id>{i}</id><name>{subset}</name><subset>{subset}</subset><size>0</size></task>")
+        f.write("</tasks></project></meta>\n")
+
+        for img_id in range(num_annotations // boxes_per_image):
+            subset_id = rng.randrange(num_subsets)
+            f.write(
+                f'<image id="{img_id}" name="{img_id}.jpg" subset="{subsets[subset_id]}" '
+                f'task_id="{subset_id}" width="640" height="480">'
+            )
+            for _ in range(boxes_per_image):
+                x, y = rng.uniform(0, 600), rng.uniform(0, 440)
+                f.write(
+                    f'<box label="{rng.choice(labels)}" xtl="{x:.2f}" ytl="{y:.2f}" '
+                    f'xbr="{x + 40:.2f}" ybr="{y + 40:.2f}" />'
+                )
+            f.write("</image>\n")
+
+        f.write("</annotations>\n")
+
+
+def legacy_filter(xml_path: Path) -> tuple[float, int]:
+    """Per subset filtering on lists of dicts, as the converters used to do"""
+
+    images, annotations, subsets = [], [], set()
+    for img in iter_cvat_images(xml_path):
+        subsets.add(img["subset"])
+        images.append({"id": img["id"], "subset": img["subset"]})
+        for label, _ in img["boxes"]:
+            annotations.append({"image_id": img["id"], "label": label, "subset": img["subset"]})
+
+    start = perf_counter()
+    total = 0
+    for subset in subsets:
+        imgs = [img for img in images if img["subset"] == subset]
+        image_ids = set(img["id"] for img in imgs)
+        annots = [annot for annot in annotations if annot["image_id"] in image_ids]
+        total += len(annots)
+    return perf_counter() - start, total
+
+
+def indexed_filter(xml_path: Path) -> tuple[float, int]:
+    """Per subset lookups on the indexed CvatProject"""
+
+    project = read_cvat_annotation_xml(xml_path)
+
+    start = perf_counter()
+    total = 0
+    for subset in project.subsets:
+        subset_ds = project.select(project.subset_rows(subset))
+        total += subset_ds.num_boxes
+    return perf_counter() - start, total
+
+
+def main():
+    args = get_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        xml_path = Path(tmp_dir) / "annotations.xml"
+
+        start = perf_counter()
+        write_synthetic_project(
+            xml_path,
+            num_annotations=args.num_annotations,
+            boxes_per_image=args.boxes_per_image,
+            num_subsets=args.num_subsets,
+            num_labels=args.num_labels,
+        )
+        print(f"Synthetic project written in {perf_counter() - start:.2f}s")
+
+        legacy_time, legacy_total = legacy_filter(xml_path)
+        indexed_time, indexed_total = indexed_filter(xml_path)
+
+    if legacy_total != indexed_total:
+        raise RuntimeError(f"Results differ: {legacy_total} != {indexed_total}")
+
+    print(f"Annotations: {legacy_total}, subsets: {args.num_subsets}")
+    print(f"legacy per subset filtering: {legacy_time:.3f}s")
+    print(f"indexed CvatProject lookups: {indexed_time:.3f}s")
+    print(f"speedup: {legacy_time / max(indexed_time, 1e-9):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
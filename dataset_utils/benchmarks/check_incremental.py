@@ -0,0 +1,174 @@
+import os
+import sys
+
+# Get the dataset_utils and format_converters directories
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+converters_dir = os.path.join(root_dir, "format_converters")
+
+# Add them to the search path
+sys.path.append(root_dir)
+sys.path.append(converters_dir)
+
+
+import shutil
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+
+from synthetic_datasets import write_synthetic_dataset
+from utils.manifest_utils import MANIFEST_FILE
+
+# Converters with an --annotations-only mode, with the format of their source
+# dataset and their extra arguments
+CONVERTERS = {
+    "cvat_to_yolo": ("cvat", []),
+    "yolo_to_coco": ("yolo", ["--no-cache"]),
+    "yolo_to_cvat": ("yolo", ["--no-cache"]),
+    "imagenet_to_cvat": ("imagenet", []),
+    "convert": ("coco", ["--from", "coco", "--to", "yolo", "--no-cache"]),
+}
+
+# Arguments of the successive incremental runs over the same output, every
+# switch between transferred images and links to the source directories
+MODES = [
+    [],
+    ["--annotations-only"],
+    [],
+    ["--transfer", "symlink"],
+    ["--annotations-only"],
+    ["--transfer", "copy"],
+]
+
+
+def get_args():
+    parser = ArgumentParser(
+        description="Check that incremental runs of the converters switching between "
+        "modes write the same output as a new run"
+    )
+    parser.add_argument(
+        "--converter",
+        type=str,
+        action="append",
+        choices=list(CONVERTERS),
+        help="Converter to check, all converters by default",
+        default=[],
+    )
+    parser.add_argument(
+        "--num-images",
+        type=int,
+        help="Number of images of the synthetic datasets",
+        default=20,
+    )
+
+    return parser.parse_args()
+
+
+def run_converter(name: str, src_dir: Path, output_dir: Path, args: list[str]):
+    """Run a converter in a new process, raise a RuntimeError if it fails"""
+
+    _, extra_args = CONVERTERS[name]
+    cmd = [
+        sys.executable,
+        os.path.join(converters_dir, f"{name}.py"),
+        "--src",
+        str(src_dir),
+        "--output",
+        str(output_dir),
+        *extra_args,
+        *args,
+    ]
+    env = dict(os.environ, IMAGE_META_CACHE=str(output_dir) + ".sqlite3")
+
+    # the converters import their modules from the working directory
+    proc = subprocess.run(cmd, cwd=root_dir, env=env, capture_output=True, text=True)
+    Path(env["IMAGE_META_CACHE"]).unlink(missing_ok=True)
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"{name} {' '.join(args)} failed with exit code {proc.returncode}:\n"
+            f"{(proc.stdout + proc.stderr)[-2000:]}"
+        )
+
+
+def snapshot(output_dir: Path) -> dict[str, tuple[bool, int]]:
+    """Return whether each file of an output directory is reached through a link, and its size
+
+    Sizes are compared instead of contents, since some converters write
+    their subsets in any order.
+    """  # noqa: E501
+
+    files = {}
+    for root, _, names in os.walk(output_dir, followlinks=True):
+        rel_root = os.path.relpath(root, output_dir)
+        linked = any(
+            os.path.islink(os.path.join(output_dir, *Path(rel_root).parts[: k + 1]))
+            for k in range(len(Path(rel_root).parts))
+        )
+        for name in names:
+            if name == MANIFEST_FILE:
+                continue
+            path = os.path.join(root, name)
+            key = os.path.normpath(os.path.join(rel_root, name))
+            files[key] = (linked or os.path.islink(path), os.path.getsize(path))
+    return files
+
+
+def check_converter(name: str, src_dir: Path, tmp_dir: Path) -> list[str]:
+    """Run the modes of MODES incrementally over one output, return the differences found"""
+
+    output_dir = tmp_dir / f"{name}_incremental"
+    errors = []
+    for k, args in enumerate(MODES):
+        mode = " ".join(args) or "(default)"
+        try:
+            run_converter(name, src_dir, output_dir, args + (["--incremental"] if k > 0 else []))
+        except RuntimeError as e:
+            # later runs cannot update an output left without a manifest
+            errors.append(f"run {k} {mode}: {e}")
+            break
+
+        fresh_dir = tmp_dir / f"{name}_fresh"
+        run_converter(name, src_dir, fresh_dir, args)
+        expected, found = snapshot(fresh_dir), snapshot(output_dir)
+        shutil.rmtree(fresh_dir)
+
+        if found != expected:
+            diff = sorted(
+                key
+                for key in expected.keys() | found.keys()
+                if expected.get(key) != found.get(key)
+            )
+            errors.append(f"run {k} {mode}: {len(diff)} files differ, {diff[:5]}")
+    return errors
+
+
+def main():
+    args = get_args()
+
+    names = args.converter or list(CONVERTERS)
+    tmp_dir = Path(tempfile.mkdtemp(prefix="check_incremental_"))
+    failed = False
+    try:
+        sources = {}
+        for name in names:
+            src_format = CONVERTERS[name][0]
+            if src_format not in sources:
+                sources[src_format] = tmp_dir / src_format
+                write_synthetic_dataset(
+                    src_format, sources[src_format], args.num_images, num_classes=3
+                )
+
+            errors = check_converter(name, sources[src_format], tmp_dir)
+            print(f"{name}: {'OK' if not errors else 'FAILED'}")
+            for error in errors:
+                print(f"  {error}")
+            failed = failed or bool(errors)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
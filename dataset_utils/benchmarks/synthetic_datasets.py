@@ -0,0 +1,286 @@
+import os
+import sys
+
+# Get the dataset_utils and format_converters directories
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+converters_dir = os.path.join(root_dir, "format_converters")
+
+# Add them to the search path
+sys.path.append(root_dir)
+sys.path.append(converters_dir)
+
+
+import io
+import random
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+from coco_utils import write_coco_dataset
+from columnar_utils import ColumnarBuilder, ColumnarDataset
+from cvat_utils import write_cvat_dataset
+from imagenet_utils import write_imagenet_dataset
+from PIL import Image
+from utils.manifest_utils import OutputManifest
+from utils.transfer_utils import FileTransfer
+from yolo_utils import write_yolo_dataset
+
+StrPath = str | Path
+
+SYNTHETIC_FORMATS = ("cvat", "coco", "yolo", "imagenet")
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=SYNTHETIC_FORMATS,
+        help="Format of the synthetic dataset",
+        required=True,
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Path to the output directory",
+        required=True,
+    )
+    parser.add_argument(
+        "--num-images",
+        type=int,
+        help="Number of images of the dataset",
+        default=1000,
+    )
+    parser.add_argument(
+        "--boxes-per-image",
+        type=int,
+        help="Number of boxes of each image, ImageNet datasets have one class per image instead",
+        default=5,
+    )
+    parser.add_argument(
+        "--num-classes",
+        type=int,
+        help="Number of classes of the dataset",
+        default=10,
+    )
+
+    # Example --image-size 640x480 --image-size 1920x1080
+    parser.add_argument(
+        "--image-size",
+        type=str,
+        action="append",
+        help="Size of the images as WIDTHxHEIGHT, each image picks one of the given sizes",
+        default=[],
+    )
+    parser.add_argument(
+        "--val-ratio",
+        type=float,
+        help="Ratio of the images in the val subset, the others are in train",
+        default=0.2,
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed of the random generator",
+        default=0,
+    )
+
+    return parser.parse_args()
+
+
+def parse_image_size(value: str) -> tuple[int, int]:
+    """Parse an image size given as WIDTHxHEIGHT"""
+
+    try:
+        width, height = (int(v) for v in value.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"Invalid image size, expected WIDTHxHEIGHT: {value}") from None
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Invalid image size: {value}")
+    return width, height
+
+
+def _encode_jpeg(width: int, height: int, rng: np.random.Generator) -> bytes:
+    # noise is decoded at about the speed of real photos, unlike a plain image
+    pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def make_synthetic_dataset(
+    images_dir: StrPath,
+    num_images: int,
+    boxes_per_image: int = 5,
+    num_classes: int = 10,
+    image_sizes: list[tuple[int, int]] | None = None,
+    val_ratio: float = 0.2,
+    tags: bool = False,
+    seed: int = 0,
+) -> ColumnarDataset:
+    """Write random images to images_dir and return a dataset of random boxes on them
+
+    Images of the same size share the same JPEG content, so large datasets
+    are written at disk speed.
+
+    Args:
+        images_dir (StrPath): directory of the generated images
+        num_images (int): number of images
+        boxes_per_image (int, optional): number of boxes of each image. Defaults to 5.
+        num_classes (int, optional): number of classes. Defaults to 10.
+        image_sizes (list[tuple[int, int]] | None, optional): (width, height) of the images, each image picks one of them. Defaults to [(640, 480)].
+        val_ratio (float, optional): ratio of the images in the val subset. Defaults to 0.2.
+        tags (bool, optional): annotate each image with one class tag instead of boxes, classes are assigned in turn inside each subset. Defaults to False.
+        seed (int, optional): seed of the random generator. Defaults to 0.
+
+    Returns:
+        ColumnarDataset: images with boxes in "xyxy" format, or with tags
+    """  # noqa: E501
+
+    images_dir = Path(images_dir)
+    images_dir.mkdir(parents=True, exist_ok=True)
+    image_sizes = image_sizes or [(640, 480)]
+
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    jpegs = [_encode_jpeg(width, height, np_rng) for width, height in image_sizes]
+
+    names = [f"class{i}" for i in range(num_classes)]
+    builder = ColumnarBuilder(names, ["train", "val"], "xyxy")
+    subset_counts = {"train": 0, "val": 0}
+    for i in range(num_images):
+        size_id = rng.randrange(len(image_sizes))
+        width, height = image_sizes[size_id]
+
+        file_name = f"{i:08d}.jpg"
+        with open(images_dir / file_name, "wb") as f:
+            f.write(jpegs[size_id])
+
+        subset = "val" if rng.random() < val_ratio else "train"
+        if tags:
+            # classes are balanced inside each subset, like ImageNet
+            builder.add_image(
+                file_name=file_name,
+                dir_path=images_dir,
+                subset=subset,
+                width=width,
+                height=height,
+                tags=[subset_counts[subset] % num_classes],
+            )
+            subset_counts[subset] += 1
+            continue
+
+        # boxes cover between 5% and 50% of each side of the image
+        boxes = []
+        for _ in range(boxes_per_image):
+            box_w = rng.uniform(0.05, 0.5) * width
+            box_h = rng.uniform(0.05, 0.5) * height
+            x1 = rng.uniform(0, width - box_w)
+            y1 = rng.uniform(0, height - box_h)
+            boxes.append([round(x1, 2), round(y1, 2), round(x1 + box_w, 2), round(y1 + box_h, 2)])
+
+        builder.add_image(
+            file_name=file_name,
+            dir_path=images_dir,
+            subset=subset,
+            width=width,
+            height=height,
+            boxes=boxes,
+            box_classes=[rng.randrange(num_classes) for _ in boxes],
+        )
+
+    return builder.build()
+
+
+def write_synthetic_dataset(
+    dataset_format: str,
+    output_dir: StrPath,
+    num_images: int,
+    boxes_per_image: int = 5,
+    num_classes: int = 10,
+    image_sizes: list[tuple[int, int]] | None = None,
+    val_ratio: float = 0.2,
+    seed: int = 0,
+    verbose: bool = True,
+):
+    """Write a synthetic dataset in any supported format
+
+    The images are generated once in a temporary directory next to the output
+    and hardlinked into the dataset by the writer of the format.
+
+    Args:
+        dataset_format (str): one of SYNTHETIC_FORMATS
+        output_dir (StrPath): directory of the dataset, it must not exist
+        num_images (int): number of images
+        boxes_per_image (int, optional): number of boxes of each image, ImageNet datasets have one class per image instead. Defaults to 5.
+        num_classes (int, optional): number of classes. Defaults to 10.
+        image_sizes (list[tuple[int, int]] | None, optional): (width, height) of the images, each image picks one of them. Defaults to [(640, 480)].
+        val_ratio (float, optional): ratio of the images in the val subset. Defaults to 0.2.
+        seed (int, optional): seed of the random generator. Defaults to 0.
+        verbose (bool, optional): print a summary. Defaults to True.
+    """  # noqa: E501
+
+    if dataset_format not in SYNTHETIC_FORMATS:
+        raise ValueError(f"Unsupported format: {dataset_format}")
+
+    output_dir = Path(output_dir)
+    if output_dir.exists():
+        raise ValueError(f"Output directory already exists: {output_dir}")
+    output_dir.parent.mkdir(parents=True, exist_ok=True)
+
+    start = perf_counter()
+    tmp_dir = tempfile.mkdtemp(prefix=".synthetic_", dir=output_dir.parent)
+    try:
+        ds = make_synthetic_dataset(
+            tmp_dir,
+            num_images,
+            boxes_per_image=boxes_per_image,
+            num_classes=num_classes,
+            image_sizes=image_sizes,
+            val_ratio=val_ratio,
+            tags=dataset_format == "imagenet",
+            seed=seed,
+        )
+
+        output_dir.mkdir()
+        manifest = OutputManifest(output_dir)
+        with FileTransfer("hardlink", verbose=False) as file_transfer:
+            if dataset_format == "cvat":
+                write_cvat_dataset(ds, output_dir, file_transfer, manifest)
+            elif dataset_format == "coco":
+                write_coco_dataset(ds, output_dir, file_transfer, manifest, compact=True)
+            elif dataset_format == "yolo":
+                write_yolo_dataset(ds, output_dir, file_transfer, manifest)
+            else:
+                write_imagenet_dataset(ds, output_dir, file_transfer, manifest, crop=False)
+        manifest.finish(verbose=False)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if verbose:
+        print(
+            f"Synthetic {dataset_format} dataset written in {perf_counter() - start:.2f}s: "
+            f"{len(ds)} images, {ds.num_boxes} boxes, {num_classes} classes"
+        )
+
+
+def main():
+    args = get_args()
+
+    write_synthetic_dataset(
+        dataset_format=args.format,
+        output_dir=args.output,
+        num_images=args.num_images,
+        boxes_per_image=args.boxes_per_image,
+        num_classes=args.num_classes,
+        image_sizes=[parse_image_size(size) for size in args.image_size],
+        val_ratio=args.val_ratio,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,649 @@
+import datetime as dt
 import json
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from array import array
+from dataclasses import replace
 from pathlib import Path
 
+import numpy as np
+from columnar_utils import ColumnarDataset, group_rows
+from utils.manifest_utils import ImageDirLinks, OutputManifest
+from utils.transfer_utils import FileTransfer
+
+try:
+    import orjson
+except ImportError:  # optional, faster json encoder
+    orjson = None
+
 StrPath = str | Path
 
 
-def read_coco_dataset(root: StrPath) -> dict:
+def default_coco_info() -> dict:
+    return {
+        "description": "COCO Dataset",
+        "url": "https://khiemle.dev",
+        "version": "1.0",
+        "year": dt.datetime.now().year,
+        "contributor": "Khiem Le",
+        "date_created": dt.datetime.now().strftime("%Y/%m/%d"),
+    }
+
+
+JSON_ENCODERS = ("auto", "json", "orjson")
+
+
+def add_coco_writer_args(parser: ArgumentParser):
+    """Add --compact and --json-encoder arguments to a converter parser"""
+
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Write json files without indentation, smaller and much faster",
+    )
+    parser.add_argument(
+        "--json-encoder",
+        type=str,
+        choices=JSON_ENCODERS,
+        help="Json encoder, auto uses orjson when it is installed",
+        default="auto",
+    )
+
+
+class CocoJsonWriter:
+    """Write a COCO instances json file incrementally
+
+    Images are written to the output file as soon as they are added, while
+    annotations are spooled to a temporary file next to the output and
+    appended when the writer is closed. The dataset never needs to be in
+    memory.
+
+    With the "json" encoder, the output is the same as `json.dump(..., indent=2)`
+    of the whole dataset, or `json.dump(..., separators=(",", ":"))` in compact
+    mode. Only the compact mode uses the C encoder of the json module, and
+    `add_images`/`add_annotations` encode a whole batch in one call, so they
+    are much faster than adding items one by one. The "orjson" encoder is
+    faster still and produces the same json data, with non ASCII characters
+    written as UTF-8 instead of escaped; "auto" uses it when it is installed.
+
+    Example:
+        with CocoJsonWriter(path, categories, compact=True) as writer:
+            writer.add_images([{...}, ...])
+            writer.add_annotations([{...}, ...])
+    """
+
+    def __init__(
+        self,
+        path: StrPath,
+        categories: list[dict],
+        info: dict | None = None,
+        compact: bool = False,
+        encoder: str = "auto",
+    ):
+        if encoder not in JSON_ENCODERS:
+            raise ValueError(f"Unsupported json encoder: {encoder}")
+        if encoder == "orjson" and orjson is None:
+            raise ValueError("orjson encoder is requested but orjson is not installed")
+
+        self.path = Path(path)
+        self.categories = categories
+        self.compact = compact
+        if encoder == "auto":
+            encoder = "orjson" if orjson is not None else "json"
+        self.encoder = encoder
+
+        self.num_images = 0
+        self.num_annotations = 0
+
+        self._file = self.path.open("w", encoding="utf-8")
+        self._annots_file = tempfile.TemporaryFile(
+            "w+",
+            encoding="utf-8",
+            dir=self.path.parent,
+            prefix=f".{self.path.stem}_",
+            suffix=".json",
+        )
+
+        header = self._dumps({"info": info or default_coco_info(), "licenses": []})
+        if self.compact:
+            self._file.write(header[: -len("}")] + ',"images":[')
+        else:
+            self._file.write(header[: -len("\n}")] + ',\n  "images": [')
+
+    def _dumps(self, obj) -> str:
+        if self.encoder == "orjson":
+            option = 0 if self.compact else orjson.OPT_INDENT_2
+            return orjson.dumps(obj, option=option).decode("utf-8")
+
+        if self.compact:
+            return json.dumps(obj, separators=(",", ":"))
+        return json.dumps(obj, indent=2)
+
+    def _encode_items(self, items: list[dict], first: bool) -> str:
+        # Items of the top level lists are indented by two levels, so the
+        # batch is encoded as a list and re-indented by one level
+        text = self._dumps(items)
+        if self.compact:
+            text = text[len("[") : -len("]")]
+        else:
+            text = text.replace("\n", "\n  ")[len("[") : -len("\n  ]")]
+        return text if first else "," + text
+
+    def add_images(self, images: list[dict]):
+        if len(images) == 0:
+            return
+        self._file.write(self._encode_items(images, self.num_images == 0))
+        self.num_images += len(images)
+
+    def add_annotations(self, annotations: list[dict]):
+        if len(annotations) == 0:
+            return
+        text = self._encode_items(annotations, self.num_annotations == 0)
+        self._annots_file.write(text)
+        self.num_annotations += len(annotations)
+
+    def add_image(self, image: dict):
+        self.add_images([image])
+
+    def add_annotation(self, annotation: dict):
+        self.add_annotations([annotation])
+
+    def _end_list(self, num_items: int) -> str:
+        if self.compact:
+            return "],"
+        return "\n  ]," if num_items else "],"
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        self._file.write(self._end_list(self.num_images))
+        if self.compact:
+            self._file.write('"annotations":[')
+        else:
+            self._file.write('\n  "annotations": [')
+
+        self._annots_file.seek(0)
+        shutil.copyfileobj(self._annots_file, self._file)
+        self._annots_file.close()
+
+        self._file.write(self._end_list(self.num_annotations))
+        categories = self._dumps({"categories": self.categories})
+        self._file.write(categories[len("{") :])
+        self._file.close()
+
+    def abort(self):
+        """Close the writer without finishing the output, and delete it
+
+        A partial output would still be a valid json file once its footer is
+        written, so it is removed instead.
+        """
+
+        if self._file.closed:
+            return
+
+        self._annots_file.close()
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "CocoJsonWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def add_coco_images(
+    writer: CocoJsonWriter,
+    ds: ColumnarDataset,
+    image_ids: np.ndarray,
+    batch_size: int = 10000,
+):
+    """Add all images of a dataset and their boxes as annotations to a writer
+
+    Items are built and encoded by batches of images, so only one batch of
+    dicts is in memory at a time. Annotation ids continue from the ones
+    already in the writer and category ids are class ids + 1.
+
+    Args:
+        writer (CocoJsonWriter): writer of the output subset
+        ds (ColumnarDataset): images to add
+        image_ids (np.ndarray): COCO id of every image of ds
+        batch_size (int, optional): number of images per batch. Defaults to 10000.
+    """
+
+    bboxes = ds.boxes_as("xywh")
+    areas = bboxes[:, 2] * bboxes[:, 3]
+    annot_image_ids = np.asarray(image_ids)[ds.box_image_index()]
+    annot_ids = np.arange(1, len(bboxes) + 1) + writer.num_annotations
+
+    for start in range(0, len(ds), batch_size):
+        end = min(start + batch_size, len(ds))
+        writer.add_images(
+            [
+                {
+                    "id": img_id,
+                    "file_name": file_name,
+                    "width": width,
+                    "height": height,
+                }
+                for img_id, file_name, width, height in zip(
+                    image_ids[start:end].tolist(),
+                    ds.file_names[start:end].tolist(),
+                    ds.widths[start:end].tolist(),
+                    ds.heights[start:end].tolist(),
+                )
+            ]
+        )
+
+        box_start, box_end = ds.box_offsets[start], ds.box_offsets[end]
+        writer.add_annotations(
+            [
+                {
+                    "id": annot_id,
+                    "image_id": img_id,
+                    "category_id": cls_id + 1,
+                    "segmentation": [],
+                    "area": area,
+                    "bbox": bbox,
+                    "iscrowd": 0,
+                }
+                for annot_id, img_id, cls_id, area, bbox in zip(
+                    annot_ids[box_start:box_end].tolist(),
+                    annot_image_ids[box_start:box_end].tolist(),
+                    ds.box_classes[box_start:box_end].tolist(),
+                    areas[box_start:box_end].tolist(),
+                    bboxes[box_start:box_end].tolist(),
+                )
+            ]
+        )
+
+
+def write_coco_dataset(
+    ds: ColumnarDataset,
+    output_dir: StrPath,
+    file_transfer: FileTransfer,
+    manifest: OutputManifest,
+    compact: bool = False,
+    encoder: str = "auto",
+    annotations_only: bool = False,
+):
+    """Write a dataset in COCO format
+
+    Images of all subsets are transferred to <output_dir>/images/ and the
+    boxes of each subset are written to
+    <output_dir>/annotations/instances_<subset>.json. Image ids start from 1
+    in every subset and category ids are class ids + 1.
+
+    With annotations_only, images are not transferred: every source directory
+    is linked to <output_dir>/images/<link>/ and the file name of each image
+    is <link>/<file name>.
+
+    Args:
+        ds (ColumnarDataset): dataset to write, image sizes are required
+        output_dir (StrPath): directory of the output dataset
+        file_transfer (FileTransfer): transfer of the images
+        manifest (OutputManifest): manifest of the output directory, only
+            the images which changed are transferred
+        compact (bool, optional): write json files without indentation. Defaults to False.
+        encoder (str, optional): one of JSON_ENCODERS. Defaults to "auto".
+        annotations_only (bool, optional): reference the source images
+            instead of transferring them. Defaults to False.
+    """
+
+    output_dir = Path(output_dir)
+    images_output_dir = output_dir / "images"
+    annotations_output_dir = output_dir / "annotations"
+    images_output_dir.mkdir(parents=True, exist_ok=True)
+    annotations_output_dir.mkdir(parents=True, exist_ok=True)
+
+    categories = [{"id": i, "name": name} for i, name in enumerate(ds.names, start=1)]
+    links = ImageDirLinks(images_output_dir, manifest)
+
+    for subset_id, subset in enumerate(ds.subsets):
+        subset_ds = ds.select(np.flatnonzero(ds.subset_ids == subset_id))
+        if len(subset_ds) == 0:
+            continue
+
+        if annotations_only:
+            file_names = np.array(links.image_names(subset_ds), dtype=object)
+            subset_ds = replace(subset_ds, file_names=file_names)
+        else:
+            for img_path, file_name in zip(subset_ds.image_paths(), subset_ds.file_names):
+                manifest.transfer(file_transfer, img_path, images_output_dir / file_name)
+
+        json_output_path = annotations_output_dir / f"instances_{subset}.json"
+        manifest.add(json_output_path)
+        with CocoJsonWriter(
+            json_output_path,
+            categories,
+            info=default_coco_info(),
+            compact=compact,
+            encoder=encoder,
+        ) as writer:
+            add_coco_images(writer, subset_ds, np.arange(1, len(subset_ds) + 1))
+
+
+class _JsonStream:
+    """Minimal incremental json reader over a text file
+
+    Values are decoded with the C scanner of the json module from a buffer
+    that is refilled from the file, so only the current value needs to be in
+    memory.
+    """
+
+    def __init__(self, f, chunk_size: int = 1 << 20):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size: int) -> bool:
+        if self._eof:
+            return False
+
+        data = self._file.read(size)
+        if not data:
+            self._eof = True
+            return False
+
+        # drop the consumed part of the buffer
+        self._buf = self._buf[self._pos :] + data
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Skip whitespaces and return the next character, "" at the end"""
+        while True:
+            buf_len = len(self._buf)
+            while self._pos < buf_len and self._buf[self._pos] in " \t\n\r":
+                self._pos += 1
+            if self._pos < buf_len:
+                return self._buf[self._pos]
+            if not self._fill(self._chunk_size):
+                return ""
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if char == "" or char not in chars:
+            raise ValueError(f"Invalid json, expected one of {chars!r}, got {char!r}")
+        self._pos += 1
+        return char
+
+    def value(self):
+        """Decode the next value"""
+        self.peek()
+        size = self._chunk_size
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+                error = None
+            except json.JSONDecodeError as e:
+                obj, end, error = None, None, e
+
+            # a value ending with the buffer may be truncated (e.g. numbers)
+            if end is not None and (end < len(self._buf) or self._eof):
+                self._pos = end
+                return obj
+
+            # the value may be incomplete, read more of the file and retry
+            if not self._fill(size):
+                if error is not None:
+                    raise ValueError(f"Invalid json: {error}")
+                self._pos = end
+                return obj
+            size *= 2
+
+
+def _stream_json_object(path: StrPath, item_handlers: dict) -> dict:
+    """Read a json object incrementally
+
+    The items of the top level arrays whose key is in item_handlers are passed
+    one by one to the handler of the key and never kept, the other top level
+    values are decoded and returned.
+
+    Args:
+        path (StrPath): path to the json file
+        item_handlers (dict): callable taking one item, by top level key
+
+    Returns:
+        dict: top level values which are not handled
+    """
+
+    result = {}
+    with open(path, "r", encoding="utf-8") as f:
+        stream = _JsonStream(f)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return result
+
+        while True:
+            key = stream.value()
+            if not isinstance(key, str):
+                raise ValueError(f"Invalid json, object key is not a string: {key}")
+            stream.expect(":")
+
+            handler = item_handlers.get(key)
+            if handler is not None and stream.peek() == "[":
+                stream.expect("[")
+                if stream.peek() == "]":
+                    stream.expect("]")
+                else:
+                    while True:
+                        handler(stream.value())
+                        if stream.expect(",]") == "]":
+                            break
+            else:
+                result[key] = stream.value()
+
+            if stream.expect(",}") == "}":
+                return result
+
+
+def _coco_subset_dataset(
+    json_path: Path,
+    images_dir: Path,
+    subset: str,
+    categories: list[dict],
+    file_names: np.ndarray,
+    image_ids: np.ndarray,
+    widths: np.ndarray,
+    heights: np.ndarray,
+    annot_img_ids: np.ndarray,
+    annot_category_ids: np.ndarray,
+    annot_boxes: np.ndarray,
+) -> ColumnarDataset:
+    """Group the annotations of a COCO instances file by image into a ColumnarDataset"""
+
+    # class ids of the dataset are indices of the categories sorted by id
+    category_ids = np.array([c["id"] for c in categories], dtype=np.int64)
+    annot_classes = np.searchsorted(category_ids, annot_category_ids)
+    known = annot_classes < len(category_ids)
+    known[known] = category_ids[annot_classes[known]] == annot_category_ids[known]
+    if not known.all():
+        unknown = annot_category_ids[~known][0]
+        raise ValueError(f"Unknown category_id in {json_path}: {unknown}")
+
+    # assign annotations to image rows with image_id
+    order = np.argsort(image_ids, kind="stable")
+    pos = np.searchsorted(image_ids, annot_img_ids, sorter=order)
+    valid = pos < len(image_ids)
+    valid[valid] = image_ids[order[pos[valid]]] == annot_img_ids[valid]
+    if not valid.all():
+        print(f"{np.count_nonzero(~valid)} annotations with image_id not exist")
+    rows = order[pos[valid]]
+
+    # group boxes by image row, keeping the annotation order inside each image
+    box_order, box_offsets = group_rows(rows, len(image_ids))
+
+    return ColumnarDataset(
+        names=[c["name"] for c in categories],
+        subsets=[subset],
+        dirs=[images_dir.as_posix()],
+        box_format="xywh",
+        file_names=file_names,
+        dir_ids=np.zeros(len(image_ids), dtype=np.int32),
+        subset_ids=np.zeros(len(image_ids), dtype=np.int32),
+        image_ids=image_ids,
+        widths=widths,
+        heights=heights,
+        boxes=annot_boxes[valid][box_order],
+        box_classes=annot_classes[valid][box_order].astype(np.int32),
+        box_offsets=box_offsets,
+        tag_offsets=np.zeros(len(image_ids) + 1, dtype=np.int64),
+        polygon_offsets=np.zeros(len(image_ids) + 1, dtype=np.int64),
+        meta={"categories": categories},
+    )
+
+
+def _sorted_categories(data: dict) -> list[dict]:
+    return sorted(data["categories"], key=lambda c: c["id"])
+
+
+def _read_instances_json(
+    json_path: Path,
+    images_dir: Path,
+    subset: str,
+    categories: list[dict] | None,
+) -> ColumnarDataset:
+    with json_path.open() as f:
+        data = json.load(f)
+
+    if categories is None:
+        categories = _sorted_categories(data)
+
+    images = data["images"]
+    annotations = data["annotations"]
+    return _coco_subset_dataset(
+        json_path,
+        images_dir,
+        subset,
+        categories,
+        file_names=np.array([img["file_name"] for img in images], dtype=object),
+        image_ids=np.array([img["id"] for img in images], dtype=np.int64),
+        widths=np.array([img.get("width", -1) for img in images], dtype=np.int32),
+        heights=np.array([img.get("height", -1) for img in images], dtype=np.int32),
+        annot_img_ids=np.array([a["image_id"] for a in annotations], dtype=np.int64),
+        annot_category_ids=np.array(
+            [a["category_id"] for a in annotations], dtype=np.int64
+        ),
+        annot_boxes=np.array(
+            [a["bbox"] for a in annotations], dtype=np.float64
+        ).reshape(-1, 4),
+    )
+
+
+def _stream_instances_json(
+    json_path: Path,
+    images_dir: Path,
+    subset: str,
+    categories: list[dict] | None,
+) -> ColumnarDataset:
+    file_names: list[str] = []
+    image_ids = array("q")
+    widths = array("i")
+    heights = array("i")
+
+    def add_image(img: dict):
+        file_names.append(img["file_name"])
+        image_ids.append(img["id"])
+        widths.append(img.get("width", -1))
+        heights.append(img.get("height", -1))
+
+    annot_img_ids = array("q")
+    annot_category_ids = array("q")
+    annot_boxes = array("d")
+
+    def add_annotation(annot: dict):
+        bbox = annot["bbox"]
+        if len(bbox) != 4:
+            raise ValueError(f"Invalid bbox in {json_path}: {bbox}")
+
+        annot_img_ids.append(annot["image_id"])
+        annot_category_ids.append(annot["category_id"])
+        annot_boxes.extend(bbox)
+
+    data = _stream_json_object(
+        json_path, {"images": add_image, "annotations": add_annotation}
+    )
+
+    # categories are usually after the annotations, so classes are mapped last
+    if categories is None:
+        categories = _sorted_categories(data)
+
+    return _coco_subset_dataset(
+        json_path,
+        images_dir,
+        subset,
+        categories,
+        file_names=np.array(file_names, dtype=object),
+        image_ids=np.frombuffer(image_ids, dtype=np.int64),
+        widths=np.frombuffer(widths, dtype=np.int32),
+        heights=np.frombuffer(heights, dtype=np.int32),
+        annot_img_ids=np.frombuffer(annot_img_ids, dtype=np.int64),
+        annot_category_ids=np.frombuffer(annot_category_ids, dtype=np.int64),
+        annot_boxes=np.frombuffer(annot_boxes, dtype=np.float64).reshape(-1, 4),
+    )
+
+
+def read_coco_instances(
+    json_path: StrPath,
+    images_dir: StrPath,
+    subset: str | None = None,
+    categories: list[dict] | None = None,
+    stream: bool = False,
+) -> ColumnarDataset:
+    """Read one COCO instances json file, without checking the images
+
+    Args:
+        json_path (StrPath): path to the instances json file
+        images_dir (StrPath): directory of the images of the file
+        subset (str | None, optional): subset of the images. Defaults to the
+            name of the file after "instances_".
+        categories (list[dict] | None, optional): categories sorted by id which
+            define the class ids. Defaults to the categories of the file.
+        stream (bool, optional): parse the file incrementally, so the memory
+            used depends on the number of images and annotations instead of
+            the size of the json text. Defaults to False.
+
+    Returns:
+        ColumnarDataset: images with boxes in "xywh" format, categories are
+            kept in meta["categories"]
+    """
+
+    json_path = Path(json_path)
+    if subset is None:
+        subset = json_path.stem.split("instances_")[-1]
+
+    read = _stream_instances_json if stream else _read_instances_json
+    return read(json_path, Path(images_dir), subset, categories)
+
+
+def read_coco_dataset(
+    root: StrPath, stream: bool = False, check_images: bool = True
+) -> ColumnarDataset:
     """Read COCO dataset
 
     Args:
         root (StrPath): path to dataset
+        stream (bool, optional): parse annotation files incrementally, see
+            read_coco_instances. Defaults to False.
+        check_images (bool, optional): raise an error when an image does not
+            exist. Defaults to True.
 
     Raises:
         ValueError: description about the error
     Returns:
-        dict: {
-            "idx2name": {
-                "1": "person",
-                "2": "bicycle",
-                ...
-            },
-            "<subset>": [
-                {
-                    "image": <path_to_image>,
-                    "labels": [
-                        [cls_id, x1, y1, w, h],
-                        ...
-                    ],
-                },
-                ...
-            ],
-            ...
-        }
+        ColumnarDataset: images of all subsets with boxes in "xywh" format
+            [x1, y1, w, h]. Class ids are indices of the categories sorted by
+            id, the original category ids are kept in meta["category_ids"].
     """
 
     root = Path(root)
@@ -50,67 +663,27 @@ def read_coco_dataset(root: StrPath) -> dict:
     if len(annot_files) == 0:
         raise ValueError("annotations files not found")
 
-    result = {}
+    parts: list[ColumnarDataset] = []
+    categories: list[dict] | None = None
 
-    idx2name = None
+    # images are looked up in one listing of the images folder, file names
+    # with a directory are checked one by one
+    image_names = set(os.listdir(images_dir)) if check_images else set()
 
     for annot_file in annot_files:
-        subset = annot_file.stem.split("instances_")[-1]
-        subset_data = []
-
-        with annot_file.open() as f:
-            data = json.load(f)
+        # categories of the first annotation file are used for all subsets
+        part = read_coco_instances(
+            annot_file, images_dir, categories=categories, stream=stream
+        )
+        categories = part.meta["categories"]
 
-        categories = data["categories"]
-        if idx2name is None:
-            idx2name = {c["id"]: c["name"] for c in categories}
+        for file_name in part.file_names.tolist() if check_images else []:
+            if file_name not in image_names and not (images_dir / file_name).exists():
+                raise ValueError(f"image {images_dir / file_name} does not exist")
 
-        images = {c["id"]: c for c in data["images"]}
-        annotations = data["annotations"]
+        parts.append(part)
 
-        # this loop assign labels to correct image with image_id
-        for annot in annotations:
-            """
-                {
-                "id": 86,
-                "image_id": 19,
-                "category_id": 2,
-                "segmentation": [],
-                "area": 672.4672000000002,
-                "bbox": [
-                    286.9,
-                    231.92000000000002,
-                    23.480000000000018,
-                    28.639999999999986
-                ],
-                "iscrowd": 0
-                },
-            """
-            img_id = annot["image_id"]
-            if img_id not in images:
-                print("image_id not exist")
-                continue
-
-            if "labels" not in images[img_id]:
-                images[img_id]["labels"] = []
-
-            images[img_id]["labels"].append(annot)
-
-        for img_data in images.values():
-            img_path = images_dir / img_data["file_name"]
-            if not img_path.exists():
-                raise ValueError(f"image {img_path} does not exist")
-
-            # convert labels to format [cls_id, x1, y1, w, h]
-            labels = []
-            for annot in img_data["labels"]:
-                cls_id = annot["category_id"]
-                x1, y1, w, h = annot["bbox"]
-                labels.append([cls_id, x1, y1, w, h])
-            subset_data.append({"image": img_path.as_posix(), "labels": labels})
-
-        result[subset] = subset_data
-
-    result["idx2name"] = idx2name
+    result = ColumnarDataset.concatenate(parts)
+    result.meta["category_ids"] = [c["id"] for c in categories]
 
     return result
@@ -0,0 +1,686 @@
+import os
+from array import array
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+from utils.bbox_utils import (
+    clip_boxes_xyxy,
+    xywh2xyxy_array,
+    xywh2yolo_array,
+    xyxy2xywh_array,
+    xyxy2yolo_array,
+    yolo2xywh_array,
+    yolo2xyxy_array,
+)
+from utils.image_meta_utils import get_image_metas
+from utils.split_utils import hash_fractions, split_ids, stratified_split_ids
+
+StrPath = str | Path
+
+# Supported layouts of the rows inside ColumnarDataset.boxes
+#   - "xyxy": absolute pixel corners (x1, y1, x2, y2), used by CVAT
+#   - "xywh": absolute pixel top-left corner and size (x1, y1, w, h), used by COCO
+#   - "yolo": normalized center and size (xc, yc, w, h), used by YOLO
+BOX_FORMATS = ("xyxy", "xywh", "yolo")
+
+
+def _empty_offsets(n: int) -> np.ndarray:
+    return np.zeros(n + 1, dtype=np.int64)
+
+
+def _gather_ragged(offsets: np.ndarray, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Gather the items of the given rows from a ragged (CSR-like) array
+
+    Args:
+        offsets (np.ndarray): offsets of the ragged array, shape (M + 1,)
+        rows (np.ndarray): indices of the rows to keep
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: index of the kept items in the values
+            array and the offsets of the new ragged array
+    """
+
+    counts = (offsets[1:] - offsets[:-1])[rows]
+    new_offsets = _empty_offsets(len(rows))
+    np.cumsum(counts, out=new_offsets[1:])
+
+    starts = offsets[:-1][rows]
+    index = np.repeat(starts - new_offsets[:-1], counts) + np.arange(
+        new_offsets[-1], dtype=np.int64
+    )
+    return index, new_offsets
+
+
+def group_rows(keys: np.ndarray, num_groups: int) -> tuple[np.ndarray, np.ndarray]:
+    """Group row indices by integer key
+
+    Args:
+        keys (np.ndarray): key of each row, in range [0, num_groups)
+        num_groups (int): number of groups
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: rows sorted by key (stable) and offsets of
+            shape (num_groups + 1,), the rows of group k are
+            rows[offsets[k]:offsets[k + 1]]
+    """
+
+    rows = np.argsort(keys, kind="stable")
+    offsets = _empty_offsets(num_groups)
+    np.cumsum(np.bincount(keys, minlength=num_groups), out=offsets[1:])
+    return rows, offsets
+
+
+def _concat_offsets(offsets_list: Sequence[np.ndarray]) -> np.ndarray:
+    result = [np.zeros(1, dtype=np.int64)]
+    shift = 0
+    for offsets in offsets_list:
+        result.append(offsets[1:] + shift)
+        shift += int(offsets[-1])
+    return np.concatenate(result)
+
+
+# Array kernels of each conversion, kernels which need the image sizes take the
+# width and height of the image of every box
+_BOX_CONVERSIONS = {
+    ("xyxy", "xywh"): xyxy2xywh_array,
+    ("xyxy", "yolo"): xyxy2yolo_array,
+    ("xywh", "xyxy"): xywh2xyxy_array,
+    ("xywh", "yolo"): xywh2yolo_array,
+    ("yolo", "xyxy"): yolo2xyxy_array,
+    ("yolo", "xywh"): yolo2xywh_array,
+}
+
+
+@dataclass
+class ColumnarDataset:
+    """In-memory dataset where images and annotations are stored in NumPy arrays
+
+    Images are rows of the image table (file_names, dir_ids, subset_ids,
+    image_ids, widths, heights). Boxes, tags and polygons are ragged arrays
+    indexed by image row through their offsets array: the boxes of image i are
+    boxes[box_offsets[i]:box_offsets[i + 1]].
+
+    Class ids are indices into `names`, subset ids are indices into `subsets`
+    and dir ids are indices into `dirs`. Unknown image sizes are stored as -1.
+    """
+
+    names: list[str]
+    subsets: list[str]
+    dirs: list[str]
+    box_format: str = "xyxy"
+
+    # image table, shape (M,)
+    file_names: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=object))
+    dir_ids: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    subset_ids: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    image_ids: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+    widths: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    heights: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+
+    # boxes, shape (N, 4) and (N,), grouped by image with box_offsets (M + 1,)
+    boxes: np.ndarray = field(default_factory=lambda: np.empty((0, 4), dtype=np.float64))
+    box_classes: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    box_offsets: np.ndarray = field(default_factory=lambda: _empty_offsets(0))
+
+    # image level labels (CVAT tags, ImageNet classes), shape (T,)
+    tag_classes: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    tag_offsets: np.ndarray = field(default_factory=lambda: _empty_offsets(0))
+
+    # polygons, shape (P,), the points of polygon j are
+    # polygon_points[polygon_point_offsets[j]:polygon_point_offsets[j + 1]]
+    polygon_classes: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    polygon_points: np.ndarray = field(default_factory=lambda: np.empty((0, 2), dtype=np.float64))
+    polygon_point_offsets: np.ndarray = field(default_factory=lambda: _empty_offsets(0))
+    polygon_offsets: np.ndarray = field(default_factory=lambda: _empty_offsets(0))
+
+    # format specific metadata (CVAT project name, labels, tasks, ...)
+    meta: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        if self.box_format not in BOX_FORMATS:
+            raise ValueError(f"Unsupported box format: {self.box_format}")
+
+    def __len__(self) -> int:
+        return len(self.file_names)
+
+    @property
+    def num_images(self) -> int:
+        return len(self.file_names)
+
+    @property
+    def num_boxes(self) -> int:
+        return len(self.boxes)
+
+    @property
+    def boxes_per_image(self) -> np.ndarray:
+        return np.diff(self.box_offsets)
+
+    @property
+    def tags_per_image(self) -> np.ndarray:
+        return np.diff(self.tag_offsets)
+
+    @property
+    def polygons_per_image(self) -> np.ndarray:
+        return np.diff(self.polygon_offsets)
+
+    def image_path(self, i: int) -> str:
+        return os.path.join(self.dirs[self.dir_ids[i]], self.file_names[i])
+
+    def image_paths(self) -> list[str]:
+        dirs = self.dirs
+        return [
+            os.path.join(dirs[d], name)
+            for d, name in zip(self.dir_ids.tolist(), self.file_names.tolist())
+        ]
+
+    def image_boxes(self, i: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return boxes and class ids of image row i, these are views not copies"""
+        start, end = self.box_offsets[i], self.box_offsets[i + 1]
+        return self.boxes[start:end], self.box_classes[start:end]
+
+    def image_tags(self, i: int) -> np.ndarray:
+        return self.tag_classes[self.tag_offsets[i] : self.tag_offsets[i + 1]]
+
+    def image_polygons(self, i: int) -> list[tuple[int, np.ndarray]]:
+        result = []
+        for j in range(self.polygon_offsets[i], self.polygon_offsets[i + 1]):
+            start, end = self.polygon_point_offsets[j], self.polygon_point_offsets[j + 1]
+            result.append((int(self.polygon_classes[j]), self.polygon_points[start:end]))
+        return result
+
+    def image_classes(self, i: int) -> np.ndarray:
+        """Return the class ids of every annotation (box, polygon and tag) of image row i"""
+        polygons = self.polygon_classes[self.polygon_offsets[i] : self.polygon_offsets[i + 1]]
+        return np.concatenate([self.image_boxes(i)[1], polygons, self.image_tags(i)])
+
+    def box_image_index(self) -> np.ndarray:
+        """Return the image row of every box, shape (N,)"""
+        return np.repeat(np.arange(self.num_images), self.boxes_per_image)
+
+    def subset_indices(self, subset: str) -> np.ndarray:
+        if subset not in self.subsets:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(self.subset_ids == self.subsets.index(subset))
+
+    def fill_image_sizes(
+        self,
+        workers: int = 8,
+        cache: bool = True,
+        rows: np.ndarray | None = None,
+        verbose: bool = True,
+    ) -> "ColumnarDataset":
+        """Read the size of the images whose size is unknown, in place
+
+        Sizes are read by `workers` threads through the persistent image
+        metadata cache, see utils.image_meta_utils. Only the images of rows
+        are read when given, so batches of rows can be filled by several
+        threads at the same time.
+        """
+        unknown = (self.widths < 0) | (self.heights < 0)
+        rows = np.flatnonzero(unknown) if rows is None else rows[unknown[rows]]
+        if len(rows) == 0:
+            return self
+
+        metas = get_image_metas(
+            [self.image_path(i) for i in rows.tolist()], workers, cache, verbose
+        )
+        self.widths[rows] = [meta.width for meta in metas]
+        self.heights[rows] = [meta.height for meta in metas]
+        return self
+
+    def boxes_as(self, box_format: str) -> np.ndarray:
+        """Return all boxes converted to the given box format with vectorized ops
+
+        Converting from or to "yolo" requires the image sizes, see fill_image_sizes.
+        """
+
+        if box_format not in BOX_FORMATS:
+            raise ValueError(f"Unsupported box format: {box_format}")
+        if box_format == self.box_format:
+            return self.boxes
+
+        convert = _BOX_CONVERSIONS[(self.box_format, box_format)]
+        if "yolo" not in (box_format, self.box_format):
+            return convert(self.boxes)
+
+        return convert(self.boxes, *self._box_image_sizes(f"convert boxes to {box_format}"))
+
+    def _box_image_sizes(self, action: str) -> tuple[np.ndarray, np.ndarray]:
+        """Return the width and height of the image of every box"""
+
+        box_img = self.box_image_index()
+        widths = self.widths[box_img].astype(np.float64)
+        heights = self.heights[box_img].astype(np.float64)
+        if np.any(widths <= 0) or np.any(heights <= 0):
+            raise ValueError(f"Image sizes are required to {action}")
+        return widths, heights
+
+    def clip_boxes(self, min_size: float = 1.0) -> "ColumnarDataset":
+        """Return a new dataset with boxes clipped to their image, without degenerate boxes
+
+        Boxes narrower or lower than min_size pixels once clipped are dropped,
+        clipping and filtering are done for all boxes at once. Image sizes are
+        required, see fill_image_sizes.
+        """
+
+        widths, heights = self._box_image_sizes("clip boxes")
+        if self.box_format == "yolo":
+            xyxy = yolo2xyxy_array(self.boxes, widths, heights)
+        elif self.box_format == "xywh":
+            xyxy = xywh2xyxy_array(self.boxes)
+        else:
+            xyxy = self.boxes
+        clipped, keep = clip_boxes_xyxy(xyxy, widths, heights, min_size)
+
+        # only the clipped boxes are converted back to the format of the
+        # dataset, the other boxes are kept as is without rounding errors
+        changed = np.flatnonzero(np.any(clipped != xyxy, axis=1) & keep)
+        boxes = self.boxes.copy()
+        if self.box_format == "yolo":
+            boxes[changed] = xyxy2yolo_array(clipped[changed], widths[changed], heights[changed])
+        elif self.box_format == "xywh":
+            boxes[changed] = xyxy2xywh_array(clipped[changed])
+        else:
+            boxes[changed] = clipped[changed]
+        boxes = boxes[keep]
+
+        # new offsets are the number of kept boxes before each old offset
+        kept = np.zeros(len(keep) + 1, dtype=np.int64)
+        np.cumsum(keep, out=kept[1:])
+
+        return replace(
+            self,
+            boxes=boxes,
+            box_classes=self.box_classes[keep],
+            box_offsets=kept[self.box_offsets],
+        )
+
+    def select(self, rows: np.ndarray | Sequence[int]) -> "ColumnarDataset":
+        """Return a new dataset which contains only the given image rows"""
+
+        rows = np.asarray(rows, dtype=np.int64)
+        box_idx, box_offsets = _gather_ragged(self.box_offsets, rows)
+        tag_idx, tag_offsets = _gather_ragged(self.tag_offsets, rows)
+        poly_idx, polygon_offsets = _gather_ragged(self.polygon_offsets, rows)
+        point_idx, point_offsets = _gather_ragged(self.polygon_point_offsets, poly_idx)
+
+        return replace(
+            self,
+            file_names=self.file_names[rows],
+            dir_ids=self.dir_ids[rows],
+            subset_ids=self.subset_ids[rows],
+            image_ids=self.image_ids[rows],
+            widths=self.widths[rows],
+            heights=self.heights[rows],
+            boxes=self.boxes[box_idx],
+            box_classes=self.box_classes[box_idx],
+            box_offsets=box_offsets,
+            tag_classes=self.tag_classes[tag_idx],
+            tag_offsets=tag_offsets,
+            polygon_classes=self.polygon_classes[poly_idx],
+            polygon_points=self.polygon_points[point_idx],
+            polygon_point_offsets=point_offsets,
+            polygon_offsets=polygon_offsets,
+        )
+
+    def filter_annotations(
+        self,
+        keep_boxes: np.ndarray | None = None,
+        keep_tags: np.ndarray | None = None,
+        keep_polygons: np.ndarray | None = None,
+    ) -> "ColumnarDataset":
+        """Return a new dataset with only the annotations whose mask is True
+
+        Every image is kept, masks of shape (N,), (T,) and (P,) select the
+        boxes, tags and polygons, None keeps them all.
+        """
+
+        def keep_items(keep: np.ndarray, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            # new offsets are the number of kept items before each old offset
+            kept = np.zeros(len(keep) + 1, dtype=np.int64)
+            np.cumsum(keep, out=kept[1:])
+            return np.flatnonzero(keep), kept[offsets]
+
+        result = replace(self)
+        if keep_boxes is not None:
+            box_idx, result.box_offsets = keep_items(keep_boxes, self.box_offsets)
+            result.boxes = self.boxes[box_idx]
+            result.box_classes = self.box_classes[box_idx]
+        if keep_tags is not None:
+            tag_idx, result.tag_offsets = keep_items(keep_tags, self.tag_offsets)
+            result.tag_classes = self.tag_classes[tag_idx]
+        if keep_polygons is not None:
+            poly_idx, result.polygon_offsets = keep_items(keep_polygons, self.polygon_offsets)
+            point_idx, result.polygon_point_offsets = _gather_ragged(
+                self.polygon_point_offsets, poly_idx
+            )
+            result.polygon_classes = self.polygon_classes[poly_idx]
+            result.polygon_points = self.polygon_points[point_idx]
+        return result
+
+    def with_subsets(self, subsets: list[str], subset_ids: np.ndarray) -> "ColumnarDataset":
+        """Return a new dataset sharing the annotations but with new subset assignment"""
+        return replace(
+            self,
+            subsets=list(subsets),
+            subset_ids=np.asarray(subset_ids, dtype=np.int32),
+        )
+
+    def map_subsets(self, subset_map: dict[str, str]) -> "ColumnarDataset":
+        """Rename subsets, subsets mapped to the same name are merged"""
+
+        subsets: list[str] = []
+        lookup = np.empty(len(self.subsets), dtype=np.int32)
+        for i, subset in enumerate(self.subsets):
+            target = subset_map.get(subset, subset)
+            if target not in subsets:
+                subsets.append(target)
+            lookup[i] = subsets.index(target)
+
+        return self.with_subsets(subsets, lookup[self.subset_ids])
+
+    def resplit(
+        self,
+        split_ratio: dict[str, float],
+        seed: int = 0,
+        stratify: bool = False,
+    ) -> "ColumnarDataset":
+        """Assign images to new subsets with the given ratio of each subset
+
+        The subset of an image is drawn from a hash of its source subset,
+        directory name and file name, and the seed, so a split is reproducible
+        and an image keeps its subset when other images are added, removed or
+        split in another chunk. Images with the same file name in different
+        subsets or directories are split independently. With stratify, the
+        images of each stratum (their rarest class, see rarest_classes) are
+        split with the ratios, this needs the whole dataset.
+        """
+
+        dir_names = [os.path.basename(os.path.normpath(d)) for d in self.dirs]
+        keys = [
+            f"{self.subsets[s]}/{dir_names[d]}/{file_name}"
+            for s, d, file_name in zip(
+                self.subset_ids.tolist(), self.dir_ids.tolist(), self.file_names.tolist()
+            )
+        ]
+        fractions = hash_fractions(keys, seed)
+        if stratify:
+            subset_ids = stratified_split_ids(
+                fractions, self.rarest_classes(), split_ratio.values()
+            )
+        else:
+            subset_ids = split_ids(fractions, split_ratio.values())
+        return self.with_subsets(list(split_ratio.keys()), subset_ids)
+
+    def check_unique_file_names(
+        self,
+        output: str,
+        by_subset: bool = True,
+        rows: np.ndarray | None = None,
+        seen: set | None = None,
+    ):
+        """Raise a ValueError when two images would be written to the same output file
+
+        Args:
+            output (str): name of the output format, for the error message
+            by_subset (bool, optional): images of each subset are written to their
+                own directory, otherwise all images share one directory. Defaults to True.
+            rows (np.ndarray | None, optional): only check these images. Defaults to None.
+            seen (set | None, optional): names of the images of the previous
+                chunks of a streamed dataset, updated with the names of this one.
+                Defaults to None.
+        """  # noqa: E501
+
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        names = self.file_names[rows].tolist()
+        if by_subset:
+            subset_ids = self.subset_ids[rows].tolist()
+            keys = [f"{self.subsets[s]}/{name}" for s, name in zip(subset_ids, names)]
+        else:
+            keys = names
+
+        seen = set() if seen is None else seen
+        for key in keys:
+            if key in seen:
+                raise ValueError(f"Image file names are not unique in the {output} output: {key}")
+            seen.add(key)
+
+    def rarest_classes(self) -> np.ndarray:
+        """Return the rarest class of the annotations of every image, -1 without annotations
+
+        Classes are ranked by their number of annotations (boxes, polygons and tags).
+        """
+
+        classes = np.concatenate([self.box_classes, self.polygon_classes, self.tag_classes])
+        rows = np.concatenate(
+            [
+                self.box_image_index(),
+                np.repeat(np.arange(self.num_images), self.polygons_per_image),
+                np.repeat(np.arange(self.num_images), self.tags_per_image),
+            ]
+        )
+
+        # rank of each class by count, ties broken by class id
+        counts = np.bincount(classes, minlength=len(self.names))
+        rank = np.empty(len(counts), dtype=np.int64)
+        rank[np.lexsort((np.arange(len(counts)), counts))] = np.arange(len(counts))
+
+        rarest = np.full(self.num_images, len(counts), dtype=np.int64)
+        np.minimum.at(rarest, rows, rank[classes])
+
+        by_rank = np.r_[np.argsort(rank), -1]
+        return by_rank[rarest]
+
+    @classmethod
+    def concatenate(cls, parts: Sequence["ColumnarDataset"]) -> "ColumnarDataset":
+        """Concatenate datasets which have the same class names and box format"""
+
+        if len(parts) == 0:
+            raise ValueError("Nothing to concatenate")
+
+        first = parts[0]
+        dirs: list[str] = []
+        subsets: list[str] = []
+        dir_ids, subset_ids = [], []
+        for part in parts:
+            if part.names != first.names:
+                raise ValueError(f"Class names are not the same: {first.names} != {part.names}")
+            if part.box_format != first.box_format:
+                raise ValueError(
+                    f"Box formats are not the same: {first.box_format} != {part.box_format}"
+                )
+
+            for d in part.dirs:
+                if d not in dirs:
+                    dirs.append(d)
+            for s in part.subsets:
+                if s not in subsets:
+                    subsets.append(s)
+
+            dir_lookup = np.array([dirs.index(d) for d in part.dirs], dtype=np.int32)
+            subset_lookup = np.array([subsets.index(s) for s in part.subsets], dtype=np.int32)
+            dir_ids.append(dir_lookup[part.dir_ids] if len(part.dirs) else part.dir_ids)
+            subset_ids.append(
+                subset_lookup[part.subset_ids] if len(part.subsets) else part.subset_ids
+            )
+
+        return cls(
+            names=list(first.names),
+            subsets=subsets,
+            dirs=dirs,
+            box_format=first.box_format,
+            file_names=np.concatenate([p.file_names for p in parts]),
+            dir_ids=np.concatenate(dir_ids).astype(np.int32),
+            subset_ids=np.concatenate(subset_ids).astype(np.int32),
+            image_ids=np.concatenate([p.image_ids for p in parts]),
+            widths=np.concatenate([p.widths for p in parts]),
+            heights=np.concatenate([p.heights for p in parts]),
+            boxes=np.concatenate([p.boxes for p in parts]),
+            box_classes=np.concatenate([p.box_classes for p in parts]),
+            box_offsets=_concat_offsets([p.box_offsets for p in parts]),
+            tag_classes=np.concatenate([p.tag_classes for p in parts]),
+            tag_offsets=_concat_offsets([p.tag_offsets for p in parts]),
+            polygon_classes=np.concatenate([p.polygon_classes for p in parts]),
+            polygon_points=np.concatenate([p.polygon_points for p in parts]),
+            polygon_point_offsets=_concat_offsets([p.polygon_point_offsets for p in parts]),
+            polygon_offsets=_concat_offsets([p.polygon_offsets for p in parts]),
+            meta=dict(first.meta),
+        )
+
+
+class ColumnarBuilder:
+    """Build a ColumnarDataset image by image
+
+    Values are appended to compact `array.array` buffers, so the memory used
+    while reading is close to the memory of the final dataset.
+    """
+
+    def __init__(
+        self,
+        names: list[str],
+        subsets: list[str] | None = None,
+        box_format: str = "xyxy",
+        meta: dict | None = None,
+    ):
+        if box_format not in BOX_FORMATS:
+            raise ValueError(f"Unsupported box format: {box_format}")
+
+        self.names = list(names)
+        self.subsets = list(subsets or [])
+        self.box_format = box_format
+        self.meta = meta or {}
+
+        self._dirs: dict[str, int] = {}
+        self._subsets = {s: i for i, s in enumerate(self.subsets)}
+
+        self._file_names: list[str] = []
+        self._dir_ids = array("i")
+        self._subset_ids = array("i")
+        self._image_ids = array("q")
+        self._widths = array("i")
+        self._heights = array("i")
+
+        self._boxes = array("d")
+        self._box_classes = array("i")
+        self._box_offsets = array("q", [0])
+
+        self._tag_classes = array("i")
+        self._tag_offsets = array("q", [0])
+
+        self._polygon_classes = array("i")
+        self._polygon_points = array("d")
+        self._polygon_point_offsets = array("q", [0])
+        self._polygon_offsets = array("q", [0])
+
+    def __len__(self) -> int:
+        return len(self._file_names)
+
+    def _dir_id(self, dir_path: StrPath) -> int:
+        dir_path = str(dir_path)
+        dir_id = self._dirs.get(dir_path)
+        if dir_id is None:
+            dir_id = self._dirs[dir_path] = len(self._dirs)
+        return dir_id
+
+    def _subset_id(self, subset: str) -> int:
+        subset_id = self._subsets.get(subset)
+        if subset_id is None:
+            subset_id = self._subsets[subset] = len(self.subsets)
+            self.subsets.append(subset)
+        return subset_id
+
+    def add_image(
+        self,
+        file_name: str,
+        dir_path: StrPath,
+        subset: str,
+        width: int = -1,
+        height: int = -1,
+        image_id: int | None = None,
+        boxes: np.ndarray | Sequence = (),
+        box_classes: np.ndarray | Sequence[int] = (),
+        tags: Sequence[int] = (),
+        polygons: Sequence[tuple[int, Sequence[float]]] = (),
+    ) -> int:
+        """Append one image with its annotations and return its row
+
+        Args:
+            file_name (str): file name of the image, relative to dir_path
+            dir_path (StrPath): directory containing the image
+            subset (str): subset of the image
+            width (int, optional): image width. Defaults to -1 (unknown).
+            height (int, optional): image height. Defaults to -1 (unknown).
+            image_id (int | None, optional): id of the image in the source
+                dataset. Defaults to the row index.
+            boxes (np.ndarray | Sequence, optional): boxes of shape (n, 4) in the
+                builder box format. Defaults to ().
+            box_classes (np.ndarray | Sequence[int], optional): class id of each box. Defaults to ().
+            tags (Sequence[int], optional): image level class ids. Defaults to ().
+            polygons (Sequence[tuple[int, Sequence[float]]], optional): pairs of
+                class id and flat list of points x1, y1, x2, y2, ... Defaults to ().
+
+        Returns:
+            int: row of the image
+        """
+
+        row = len(self._file_names)
+
+        self._file_names.append(file_name)
+        self._dir_ids.append(self._dir_id(dir_path))
+        self._subset_ids.append(self._subset_id(subset))
+        self._image_ids.append(row if image_id is None else image_id)
+        self._widths.append(width)
+        self._heights.append(height)
+
+        if len(boxes):
+            boxes = np.ascontiguousarray(boxes, dtype=np.float64)
+            if boxes.ndim != 2 or boxes.shape[1] != 4:
+                raise ValueError(f"Boxes must have shape (n, 4): {boxes.shape}")
+            if len(box_classes) != len(boxes):
+                raise ValueError("Number of box classes and boxes are not the same")
+
+            self._boxes.frombytes(boxes.tobytes())
+            self._box_classes.frombytes(
+                np.ascontiguousarray(box_classes, dtype=np.int32).tobytes()
+            )
+        self._box_offsets.append(len(self._box_classes))
+
+        self._tag_classes.extend(tags)
+        self._tag_offsets.append(len(self._tag_classes))
+
+        for cls_id, points in polygons:
+            self._polygon_classes.append(cls_id)
+            self._polygon_points.extend(points)
+            self._polygon_point_offsets.append(len(self._polygon_points) // 2)
+        self._polygon_offsets.append(len(self._polygon_classes))
+
+        return row
+
+    def build(self, dataset_cls: type[ColumnarDataset] = ColumnarDataset) -> ColumnarDataset:
+        def _np(buffer: array, dtype) -> np.ndarray:
+            return np.frombuffer(buffer, dtype=dtype).copy()
+
+        return dataset_cls(
+            names=self.names,
+            subsets=self.subsets,
+            dirs=list(self._dirs.keys()),
+            box_format=self.box_format,
+            file_names=np.array(self._file_names, dtype=object),
+            dir_ids=_np(self._dir_ids, np.int32),
+            subset_ids=_np(self._subset_ids, np.int32),
+            image_ids=_np(self._image_ids, np.int64),
+            widths=_np(self._widths, np.int32),
+            heights=_np(self._heights, np.int32),
+            boxes=_np(self._boxes, np.float64).reshape(-1, 4),
+            box_classes=_np(self._box_classes, np.int32),
+            box_offsets=_np(self._box_offsets, np.int64),
+            tag_classes=_np(self._tag_classes, np.int32),
+            tag_offsets=_np(self._tag_offsets, np.int64),
+            polygon_classes=_np(self._polygon_classes, np.int32),
+            polygon_points=_np(self._polygon_points, np.float64).reshape(-1, 2),
+            polygon_point_offsets=_np(self._polygon_point_offsets, np.int64),
+            polygon_offsets=_np(self._polygon_offsets, np.int64),
+            meta=self.meta,
+        )
@@ -0,0 +1,502 @@
+import os
+import sys
+
+# Get the current directory
+current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
+
+# Add the current directory to the search path
+sys.path.append(current_dir)
+
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from coco_utils import add_coco_writer_args, read_coco_dataset, write_coco_dataset
+from columnar_utils import ColumnarBuilder, ColumnarDataset
+from cvat_utils import read_cvat_annotation_xml, write_cvat_dataset
+from dedupe_utils import DUPLICATE_SCOPES, add_duplicate_args, duplicate_rows, find_duplicates
+from imagenet_utils import read_imagenet, write_imagenet_dataset
+from shard_utils import add_shard_writer_args, write_shard_dataset
+from utils.bbox_utils import add_box_args
+from utils.manifest_utils import (
+    OutputManifest,
+    add_annotations_only_arg,
+    add_manifest_args,
+    check_output_dir,
+    prepare_output_dir,
+)
+from utils.packed_utils import check_no_packed_images
+from utils.profile_utils import StageProfiler, add_profile_args
+from utils.split_utils import add_split_args
+from utils.transfer_utils import FileTransfer, add_transfer_args, open_file_transfer
+from yolo_utils import read_yolo_data_yaml, validate_dataset_folder, write_yolo_dataset
+
+StrPath = str | Path
+
+FORMATS = ("cvat", "coco", "yolo", "imagenet")
+
+# Output only formats, packing the images for training
+OUTPUT_FORMATS = FORMATS + ("shards",)
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--from",
+        type=str,
+        dest="src_format",
+        choices=FORMATS,
+        help="Format of the source dataset",
+        required=True,
+    )
+    parser.add_argument(
+        "--to",
+        type=str,
+        dest="dst_format",
+        choices=OUTPUT_FORMATS,
+        help="Format of the output dataset",
+        required=True,
+    )
+    parser.add_argument(
+        "--src",
+        type=str,
+        help="Path to the source dataset directory",
+        required=True,
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Path to the output directory",
+        required=True,
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Overwrite existing output directory",
+    )
+
+    # arguments to map subsets. Example --subset-map Train:train --subset-map Test:test
+    parser.add_argument(
+        "--subset-map",
+        type=str,
+        action="append",
+        help="Map subset names to new subset names",
+        default=[],
+    )
+
+    # arguments to resplit dataset subsets. Example --split-ratio train:0.8 --split-ratio val:0.2
+    parser.add_argument(
+        "--split-ratio",
+        type=str,
+        action="append",
+        help="Split dataset into subsets and specify the ratio of each subset",
+        default=[],
+    )
+
+    parser.add_argument(
+        "--skip-missing",
+        action="store_true",
+        help="Skip images without label file, YOLO source only",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the label and image metadata caches",
+    )
+    parser.add_argument(
+        "--whole-images",
+        action="store_true",
+        help="ImageNet output only, copy whole images into the directory of "
+        "every class they are annotated with instead of cropping boxes",
+    )
+    parser.add_argument(
+        "--max-size",
+        type=int,
+        help="ImageNet output only, downscale crops so their longest side is at most this size",
+        default=None,
+    )
+    parser.add_argument(
+        "--drop-duplicates",
+        type=str,
+        choices=DUPLICATE_SCOPES,
+        help="Drop near duplicate images found with a perceptual hash, inside each "
+        "subset or also across subsets, one image of each group is kept",
+        default=None,
+    )
+    parser.add_argument(
+        "--keep-subset",
+        type=str,
+        action="append",
+        help="Subset whose copy of an image found in several subsets is kept, "
+        "can be repeated in order of priority",
+        default=[],
+    )
+
+    add_coco_writer_args(parser)
+    add_duplicate_args(parser)
+    add_shard_writer_args(parser)
+    add_split_args(parser)
+    add_transfer_args(parser)
+    add_box_args(parser)
+    add_manifest_args(parser)
+    add_annotations_only_arg(parser)
+    add_profile_args(parser)
+
+    return parser.parse_args()
+
+
+def read_dataset(
+    src_format: str,
+    src_dir: StrPath,
+    workers: int = 4,
+    cache: bool = True,
+    skip_missing: bool = False,
+    check_images: bool = True,
+) -> ColumnarDataset:
+    """Read a dataset of any supported format in memory
+
+    Args:
+        src_format (str): one of FORMATS
+        src_dir (StrPath): directory of the dataset
+        workers (int, optional): Number of threads used to read labels and image sizes. Defaults to 4.
+        cache (bool, optional): Use the label and image metadata caches. Defaults to True.
+        skip_missing (bool, optional): Skip images without label file, YOLO only. Defaults to False.
+        check_images (bool, optional): Raise an error when an image does not exist, COCO only. Defaults to True.
+
+    Raises:
+        ValueError: unsupported format
+
+    Returns:
+        ColumnarDataset: images and annotations of all subsets
+    """  # noqa: E501
+
+    src_dir = Path(src_dir)
+
+    if src_format == "cvat":
+        return read_cvat_annotation_xml(src_dir / "annotations.xml")
+
+    if src_format == "coco":
+        return read_coco_dataset(src_dir, check_images=check_images)
+
+    if src_format == "yolo":
+        data_yml_file = src_dir / "data.yaml"
+        if not data_yml_file.exists():
+            raise ValueError(f"data.yaml does not exist: {data_yml_file}")
+
+        data_yml = read_yolo_data_yaml(data_yml_file)
+        return validate_dataset_folder(
+            data_yml, src_dir, skip_missing, workers=workers, cache=cache
+        )
+
+    if src_format == "imagenet":
+        return read_imagenet(src_dir, workers=workers, cache=cache)
+
+    raise ValueError(f"Unsupported format: {src_format}")
+
+
+def merge_imagenet_copies(ds: ColumnarDataset) -> ColumnarDataset:
+    """Merge the copies of an image found in several class directories of a subset
+
+    ImageNet datasets store an image with several classes once per class, the
+    copies are merged into one image with every class as a tag.
+    """
+
+    rows_by_key: dict[tuple[int, str], list[int]] = {}
+    for i, key in enumerate(zip(ds.subset_ids.tolist(), ds.file_names.tolist())):
+        rows_by_key.setdefault(key, []).append(i)
+
+    if len(rows_by_key) == len(ds):
+        return ds
+
+    result = ColumnarBuilder(ds.names, ds.subsets, ds.box_format, dict(ds.meta))
+    for (subset_id, file_name), rows in rows_by_key.items():
+        i = rows[0]
+        result.add_image(
+            file_name=file_name,
+            dir_path=ds.dirs[ds.dir_ids[i]],
+            subset=ds.subsets[subset_id],
+            width=int(ds.widths[i]),
+            height=int(ds.heights[i]),
+            image_id=int(ds.image_ids[i]),
+            tags=sorted({cls_id for row in rows for cls_id in ds.image_tags(row).tolist()}),
+        )
+
+    return result.build()
+
+
+def write_dataset(
+    ds: ColumnarDataset,
+    output_dir: StrPath,
+    dst_format: str,
+    file_transfer: FileTransfer,
+    manifest: OutputManifest,
+    workers: int = 4,
+    compact: bool = False,
+    json_encoder: str = "auto",
+    crop: bool = True,
+    max_size: int | None = None,
+    shard_size: int = 1024,
+    annotations_only: bool = False,
+):
+    """Write a dataset with the writer of any output format
+
+    Options are described in convert_dataset, each writer only uses its own.
+    """
+
+    if dst_format == "cvat":
+        write_cvat_dataset(
+            ds, output_dir, file_transfer, manifest, annotations_only=annotations_only
+        )
+    elif dst_format == "coco":
+        write_coco_dataset(
+            ds,
+            output_dir,
+            file_transfer,
+            manifest,
+            compact=compact,
+            encoder=json_encoder,
+            annotations_only=annotations_only,
+        )
+    elif dst_format == "yolo":
+        write_yolo_dataset(
+            ds, output_dir, file_transfer, manifest, annotations_only=annotations_only
+        )
+    elif dst_format == "shards":
+        write_shard_dataset(ds, output_dir, manifest, shard_size=shard_size << 20, workers=workers)
+    elif dst_format == "imagenet":
+        write_imagenet_dataset(
+            ds,
+            output_dir,
+            file_transfer,
+            manifest,
+            crop=crop,
+            workers=workers,
+            max_size=max_size,
+        )
+    else:
+        raise ValueError(f"Unsupported format: {dst_format}")
+
+
+def convert_dataset(
+    src_dir: StrPath,
+    output_dir: StrPath,
+    src_format: str,
+    dst_format: str,
+    force: bool = False,
+    incremental: bool = False,
+    subset_map: dict[str, str] | None = None,
+    split_ratio: dict[str, float] | None = None,
+    split_seed: int = 0,
+    stratify: bool = False,
+    skip_missing: bool = False,
+    transfer: str = "copy",
+    workers: int = 4,
+    cache: bool = True,
+    compact: bool = False,
+    json_encoder: str = "auto",
+    crop: bool = True,
+    max_size: int | None = None,
+    shard_size: int = 1024,
+    annotations_only: bool = False,
+    clip_boxes: bool = False,
+    drop_duplicates: str | None = None,
+    keep_subsets: list[str] | None = None,
+    hash_radius: int = 4,
+    hash_batch_size: int = 256,
+    profiler: StageProfiler | None = None,
+):
+    """Convert a dataset between any two formats in memory
+
+    The source dataset is read with the reader of its format, and written by
+    the writer of the output format, images are transferred once from the
+    source to the output without intermediate datasets.
+
+    Args:
+        src_dir (StrPath): directory of the source dataset
+        output_dir (StrPath): directory of the output dataset
+        src_format (str): format of the source dataset, one of FORMATS
+        dst_format (str): format of the output dataset, one of OUTPUT_FORMATS
+        force (bool, optional): Overwrite existing output directory. Defaults to False.
+        incremental (bool, optional): Update an output directory written by a previous run, only files whose source changed are rewritten. Defaults to False.
+        subset_map (dict[str, str], optional): Map subset names to new subset names. Defaults to None.
+        split_ratio (dict[str, float], optional): Split dataset into subsets and specify the ratio of each subset. Defaults to None.
+        split_seed (int, optional): Seed of the split, the subset of an image is drawn from a hash of its file name and the seed. Defaults to 0.
+        stratify (bool, optional): Split the images of each class with the split ratio, images are grouped by their rarest class. Defaults to False.
+        skip_missing (bool, optional): Skip images without label file, YOLO source only. Defaults to False.
+        transfer (str, optional): How images are transferred, one of "copy", "hardlink", "reflink", "symlink" and "pack". Defaults to "copy".
+        workers (int, optional): Number of threads used to read labels and transfer images, and of processes cropping images. Defaults to 4.
+        cache (bool, optional): Use the label and image metadata caches. Defaults to True.
+        compact (bool, optional): Write json files without indentation, COCO output only. Defaults to False.
+        json_encoder (str, optional): Json encoder, one of "auto", "json" and "orjson", COCO output only. Defaults to "auto".
+        crop (bool, optional): Save boxes as crops instead of whole images, ImageNet output only. Defaults to True.
+        max_size (int | None, optional): Downscale crops so their longest side is at most max_size, ImageNet output only. Defaults to None.
+        shard_size (int, optional): Maximum size of a shard in MB, shards output only. Defaults to 1024.
+        annotations_only (bool, optional): Write only the annotation files and reference the source images through symlinks, not supported by ImageNet and shards outputs. Defaults to False.
+        clip_boxes (bool, optional): Clip boxes to their image and drop boxes left without area. Defaults to False.
+        drop_duplicates (str | None, optional): Drop near duplicate images inside each subset ("subset") or also across subsets ("all"), duplicates are found in the output subsets. Defaults to None.
+        keep_subsets (list[str] | None, optional): Subsets whose copies are kept first when dropping duplicates across subsets. Defaults to None.
+        hash_radius (int, optional): Maximum number of different bits of the perceptual hashes of duplicates. Defaults to 4.
+        hash_batch_size (int, optional): Number of images hashed per worker task. Defaults to 256.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage of the conversion. Defaults to None.
+    """  # noqa: E501
+
+    if src_format not in FORMATS:
+        raise ValueError(f"Unsupported format: {src_format}")
+    if dst_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported format: {dst_format}")
+    if dst_format == "imagenet" and annotations_only:
+        raise ValueError("ImageNet output has no annotation files, cannot use --annotations-only")
+    if dst_format == "shards" and annotations_only:
+        raise ValueError("Shards output packs the images, cannot use --annotations-only")
+
+    src_dir = Path(src_dir)
+    if not src_dir.exists():
+        raise ValueError(f"Source directory does not exist: {src_dir}")
+    if not src_dir.is_dir():
+        raise ValueError(f"Source is not a directory: {src_dir}")
+    if annotations_only:
+        # packed images cannot be referenced through links to their directories
+        check_no_packed_images(src_dir, "referenced with --annotations-only")
+
+    # The output directory is only removed once the dataset passed its checks
+    output_dir = Path(output_dir)
+    check_output_dir(output_dir, force, incremental)
+    profiler = profiler or StageProfiler()
+
+    with profiler.stage("read annotations") as stage:
+        ds = read_dataset(src_format, src_dir, workers, cache, skip_missing)
+        if src_format == "imagenet":
+            ds = merge_imagenet_copies(ds)
+        stage.items += len(ds)
+
+    # Validate subset map if provided
+    if subset_map:
+        for src, target in subset_map.items():
+            if src not in ds.subsets:
+                raise ValueError(f"Subset '{src}' does not exist in {src_format} dataset")
+            if target in ds.subsets:
+                raise ValueError(f"Subset '{target}' already exists in {src_format} dataset")
+
+    # Get the new subsets if split_ratio or subset_map is provided
+    if split_ratio:
+        ds = ds.resplit(split_ratio, split_seed, stratify)
+    elif subset_map:
+        ds = ds.map_subsets(subset_map)
+
+    # Drop near duplicates, so copies of a frame do not leak between subsets
+    if drop_duplicates:
+        with profiler.stage("hash images", items=len(ds)):
+            groups = find_duplicates(ds, hash_radius, workers, hash_batch_size)
+        rows = duplicate_rows(ds, groups, drop_duplicates, keep_subsets)
+        ds = ds.select(np.setdiff1d(np.arange(len(ds)), rows))
+        print(f"Dropped {len(rows)} duplicate images")
+
+    if dst_format == "imagenet" and crop and ds.num_boxes == 0:
+        raise ValueError("Dataset has no boxes to crop, use --whole-images")
+
+    # Images of all subsets share the images directory of COCO datasets,
+    # other formats have one directory per subset. Samples of shards are
+    # named by position
+    if dst_format != "shards":
+        ds.check_unique_file_names(dst_format, by_subset=dst_format != "coco")
+
+    # Image sizes are required to convert boxes between formats
+    with profiler.stage("probe image sizes", items=len(ds)):
+        ds.fill_image_sizes(workers, cache)
+
+    # Clip boxes to their image and drop degenerate boxes, all at once
+    if clip_boxes:
+        ds = ds.clip_boxes()
+
+    prepare_output_dir(output_dir, force, incremental)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Only the files which changed since the previous run are written
+    manifest = OutputManifest(output_dir)
+
+    with (
+        profiler.stage("write dataset", items=len(ds)) as stage,
+        open_file_transfer(transfer, workers, output_dir) as file_transfer,
+    ):
+        write_dataset(
+            ds,
+            output_dir,
+            dst_format,
+            file_transfer,
+            manifest,
+            workers=workers,
+            compact=compact,
+            json_encoder=json_encoder,
+            crop=crop,
+            max_size=max_size,
+            shard_size=shard_size,
+            annotations_only=annotations_only,
+        )
+
+    stage.bytes += file_transfer.num_bytes
+
+    with profiler.stage("finish manifest"):
+        manifest.finish()
+    print(f"Converted {len(ds)} images and {ds.num_boxes} boxes")
+
+
+def main():
+    args = get_args()
+
+    # Process subset map
+    subset_map = {}
+    for _map in args.subset_map:
+        k, v = _map.split(":")
+        subset_map[k] = v
+
+    # Process split ratio
+    split_ratio = {}
+    for arg in args.split_ratio:
+        k, v = arg.split(":")
+        split_ratio[k] = float(v)
+
+    FAULT_TOLERANCE = 1e-6
+    if split_ratio and (1 - sum(split_ratio.values())) > FAULT_TOLERANCE:
+        raise ValueError("Sum of split ratios should be 1.0")
+
+    if split_ratio and subset_map:
+        raise ValueError("Subset map and split ratio cannot be used together")
+
+    profiler = StageProfiler() if args.profile is not None else None
+
+    convert_dataset(
+        src_dir=args.src,
+        output_dir=args.output,
+        src_format=args.src_format,
+        dst_format=args.dst_format,
+        force=args.force,
+        incremental=args.incremental,
+        subset_map=subset_map,
+        split_ratio=split_ratio,
+        split_seed=args.split_seed,
+        stratify=args.stratify,
+        skip_missing=args.skip_missing,
+        transfer=args.transfer,
+        workers=args.workers,
+        cache=not args.no_cache,
+        compact=args.compact,
+        json_encoder=args.json_encoder,
+        crop=not args.whole_images,
+        max_size=args.max_size,
+        shard_size=args.shard_size,
+        annotations_only=args.annotations_only,
+        clip_boxes=args.clip_boxes,
+        drop_duplicates=args.drop_duplicates,
+        keep_subsets=args.keep_subset,
+        hash_radius=args.hash_radius,
+        hash_batch_size=args.hash_batch_size,
+        profiler=profiler,
+    )
+
+    if profiler is not None:
+        profiler.finish(args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+from columnar_utils import ColumnarDataset
+from PIL import Image, ImageOps
+from utils.image_meta_utils import oriented_size
+from utils.manifest_utils import OutputManifest, file_fingerprint
+from utils.packed_utils import open_image
+
+StrPath = str | Path
+
+# Scales supported by the reduced-resolution decode of JPEG images
+JPEG_DRAFT_SCALES = (8, 4, 2)
+
+# Image modes which can be saved as JPEG
+_JPEG_MODES = ("1", "L", "RGB", "CMYK")
+
+# Minimum delay between two progress messages, in seconds
+_PROGRESS_INTERVAL = 5.0
+
+# A task crops the boxes of one image: (image path, [(xyxy box, output path), ...])
+CropTask = tuple[str, list[tuple[list[float], str]]]
+
+
+def _draft_scale(
+    img: Image.Image,
+    boxes: list[list[float]],
+    max_size: int | None,
+) -> int:
+    """Return the largest JPEG decode scale keeping every crop at least max_size"""
+
+    if max_size is None or img.format != "JPEG" or len(boxes) == 0:
+        return 1
+
+    boxes = np.asarray(boxes, dtype=np.float64)
+    longest = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+    allowed = float(longest.min()) / max_size
+    for scale in JPEG_DRAFT_SCALES:
+        if allowed >= scale:
+            return scale
+    return 1
+
+
+def _crop_image(
+    img_path: str,
+    crops: list[tuple[list[float], str]],
+    max_size: int | None,
+):
+    with open_image(img_path) as img:
+        # boxes are in the coordinates of the image once its EXIF orientation
+        # is applied, like its size in the dataset
+        width, height, orientation = oriented_size(img)
+        scale = _draft_scale(img, [box for box, _ in crops], max_size)
+        if scale > 1:
+            # decode the image directly at 1/scale with DCT scaling
+            img.draft(img.mode, (img.width // scale, img.height // scale))
+
+        img.load()
+        if orientation != 1:
+            img = ImageOps.exif_transpose(img)
+        sx, sy = img.width / width, img.height / height
+
+        for box, out_path in crops:
+            x1, y1, x2, y2 = box
+            roi = img.crop((x1 * sx, y1 * sy, x2 * sx, y2 * sy))
+
+            if max_size is not None and max(roi.size) > max_size:
+                roi.thumbnail((max_size, max_size), Image.Resampling.BILINEAR)
+            if roi.mode not in _JPEG_MODES:
+                roi = roi.convert("RGB")
+
+            roi.save(out_path)
+
+
+def _run_crop_tasks(tasks: list[CropTask], max_size: int | None) -> int:
+    """Crop a batch of images in a worker, return the number of crops"""
+
+    num_crops = 0
+    for img_path, crops in tasks:
+        _crop_image(img_path, crops, max_size)
+        num_crops += len(crops)
+    return num_crops
+
+
+def iter_crop_tasks(
+    ds: ColumnarDataset,
+    output_dir: StrPath,
+    max_size: int | None = None,
+    manifest: OutputManifest | None = None,
+):
+    """Yield one crop task per image with boxes and create the output directories
+
+    Crops are saved to <output_dir>/<subset>/<class name>/<image stem>_<i>.jpg
+    where i is the index of the box in the image. With a manifest, crops which
+    are up to date are skipped, and so are images without crops to write.
+    """
+
+    output_dir = Path(output_dir)
+    xyxy_boxes = ds.boxes_as("xyxy").tolist()
+    box_classes = ds.box_classes.tolist()
+    box_offsets = ds.box_offsets.tolist()
+
+    for subset_id, subset in enumerate(ds.subsets):
+        subset_dir = output_dir / subset
+
+        # make dir for each class name
+        class_dirs = []
+        for class_name in ds.names:
+            (subset_dir / class_name).mkdir(parents=True, exist_ok=True)
+            class_dirs.append((subset_dir / class_name).as_posix())
+
+        for idx in np.flatnonzero(ds.subset_ids == subset_id).tolist():
+            start, end = box_offsets[idx], box_offsets[idx + 1]
+            if start == end:
+                continue
+
+            img_path = ds.image_path(idx)
+            stem = Path(img_path).stem
+            crops = [
+                (xyxy_boxes[k], f"{class_dirs[box_classes[k]]}/{stem}_{i}.jpg")
+                for i, k in enumerate(range(start, end))
+            ]
+
+            if manifest is not None:
+                src = f"{Path(img_path).resolve()}:{file_fingerprint(img_path)}"
+                crops = [
+                    (box, out_path)
+                    for box, out_path in crops
+                    if not manifest.is_current(out_path, src, box, max_size)
+                ]
+                if not crops:
+                    continue
+
+            yield img_path, crops
+
+
+def crop_dataset(
+    ds: ColumnarDataset,
+    output_dir: StrPath,
+    workers: int = 4,
+    max_size: int | None = None,
+    batch_size: int = 32,
+    verbose: bool = True,
+    manifest: OutputManifest | None = None,
+) -> int:
+    """Save every box of the dataset as an ImageNet crop with a pool of processes
+
+    Each source image is decoded once and all its crops are encoded by the
+    same worker, images are sent to the workers by batches. When max_size is
+    given, crops are downscaled so their longest side is at most max_size, and
+    JPEG images are decoded at a reduced resolution (1/2, 1/4 or 1/8) when
+    every crop of the image stays at least max_size.
+
+    Args:
+        ds (ColumnarDataset): dataset with boxes, image sizes are required for
+            "yolo" boxes
+        output_dir (StrPath): directory of the ImageNet dataset
+        workers (int, optional): number of processes. Defaults to 4.
+        max_size (int | None, optional): maximum size of the longest side of
+            the crops. Defaults to None (crops keep the source resolution).
+        batch_size (int, optional): number of images per worker task. Defaults to 32.
+        verbose (bool, optional): print the progress every few seconds. Defaults to True.
+        manifest (OutputManifest | None, optional): manifest of the output
+            directory, only crops which changed are written. Defaults to None.
+
+    Returns:
+        int: number of crops saved
+    """
+
+    total_images = int(np.count_nonzero(ds.boxes_per_image))
+    tasks = iter_crop_tasks(ds, output_dir, max_size, manifest)
+
+    def batches():
+        batch = []
+        for task in tasks:
+            batch.append(task)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    start_time = last_report = perf_counter()
+    num_images = num_crops = 0
+
+    def report(batch_images: int, batch_crops: int, final: bool = False):
+        nonlocal num_images, num_crops, last_report
+        num_images += batch_images
+        num_crops += batch_crops
+
+        now = perf_counter()
+        if verbose and (final or now - last_report >= _PROGRESS_INTERVAL):
+            last_report = now
+            elapsed = max(now - start_time, 1e-9)
+            print(
+                f"Cropped {num_images}/{total_images} images, {num_crops} crops "
+                f"in {elapsed:.1f}s ({num_crops / elapsed:.1f} crops/s)"
+            )
+
+    if workers <= 1:
+        for batch in batches():
+            report(len(batch), _run_crop_tasks(batch, max_size))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # bound the number of pending batches, so tasks are built lazily
+            pending = deque()
+            for batch in batches():
+                future = pool.submit(_run_crop_tasks, batch, max_size)
+                pending.append((len(batch), future))
+                if len(pending) >= workers * 2:
+                    batch_images, future = pending.popleft()
+                    report(batch_images, future.result())
+
+            while pending:
+                batch_images, future = pending.popleft()
+                report(batch_images, future.result())
+
+    report(0, 0, final=True)
+    return num_crops
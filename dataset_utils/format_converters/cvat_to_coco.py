@@ -1,11 +1,25 @@
-import datetime as dt
-import json
-import random
-import shutil
+import os
+import sys
+
+# Get the current directory
+current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
+
+# Add the current directory to the search path
+sys.path.append(current_dir)
+
+
 from argparse import ArgumentParser
+from contextlib import ExitStack
 from pathlib import Path
 
-from cvat_utils import read_cvat_annotation_xml
+import numpy as np
+from coco_utils import CocoJsonWriter, add_coco_images, add_coco_writer_args
+from cvat_utils import iter_cvat_chunks, read_cvat_annotation_xml, read_cvat_project_meta
+from utils.bbox_utils import add_box_args
+from utils.manifest_utils import OutputManifest, add_manifest_args, prepare_output_dir
+from utils.profile_utils import StageProfiler, add_profile_args
+from utils.split_utils import add_split_args
+from utils.transfer_utils import add_transfer_args, open_file_transfer
 
 StrPath = str | Path
 
@@ -48,6 +62,19 @@ def get_args():
         default=[],
     )
 
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read annotations.xml incrementally with bounded memory, cannot be used with --stratify",
+    )
+
+    add_coco_writer_args(parser)
+    add_split_args(parser)
+    add_transfer_args(parser)
+    add_box_args(parser)
+    add_manifest_args(parser)
+    add_profile_args(parser)
+
     return parser.parse_args()
 
 
@@ -55,8 +82,18 @@ def convert_cvat_to_coco(
     src_dir: StrPath,
     output_dir: StrPath,
     force: bool = False,
+    incremental: bool = False,
     subset_map: dict[str, str] | None = None,
     split_ratio: dict[str, float] | None = None,
+    split_seed: int = 0,
+    stratify: bool = False,
+    stream: bool = False,
+    transfer: str = "copy",
+    workers: int = 4,
+    compact: bool = False,
+    json_encoder: str = "auto",
+    clip_boxes: bool = False,
+    profiler: StageProfiler | None = None,
 ):
     """Convert dataset from CVAT for images format to COCO format
 
@@ -68,8 +105,18 @@ def convert_cvat_to_coco(
         src_dir (StrPath): directory of the CVAT dataset
         output_dir (StrPath): directory of the output COCO dataset.
         force (bool, optional): Overwrite existing output directory. Defaults to False.
+        incremental (bool, optional): Update an output directory written by a previous run, only files whose source changed are rewritten. Defaults to False.
         subset_map (dict[str, str], optional): Map subset names to new subset names. Defaults to None.
         split_ratio (dict[str, float], optional): Split dataset into subsets and specify the ratio of each subset. Defaults to None.
+        split_seed (int, optional): Seed of the split, the subset of an image is drawn from a hash of its file name and the seed. Defaults to 0.
+        stratify (bool, optional): Split the images of each class with the split ratio, images are grouped by their rarest class. Defaults to False.
+        stream (bool, optional): Read annotations.xml in chunks of images instead of all at once. Defaults to False.
+        transfer (str, optional): How images are transferred, one of "copy", "hardlink", "reflink", "symlink" and "pack". Defaults to "copy".
+        workers (int, optional): Number of threads used to transfer images. Defaults to 4.
+        compact (bool, optional): Write json files without indentation. Defaults to False.
+        json_encoder (str, optional): Json encoder, one of "auto", "json" and "orjson". Defaults to "auto".
+        clip_boxes (bool, optional): Clip boxes to their image and drop boxes left without area. Defaults to False.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage of the conversion. Defaults to None.
     """
 
     src_dir = Path(src_dir)
@@ -79,220 +126,122 @@ def convert_cvat_to_coco(
         raise ValueError(f"Source is not a directory: {src_dir}")
 
     output_dir = Path(output_dir)
-    if not force:
-        if output_dir.exists():
-            raise ValueError("Output directory already exists")
+    prepare_output_dir(output_dir, force, incremental)
+    profiler = profiler or StageProfiler()
+
+    # Read the whole dataset at once, or chunk by chunk when streaming
+    xml_path = src_dir / "annotations.xml"
+    if stream:
+        if split_ratio and stratify:
+            raise ValueError("Stratified split cannot be used with stream")
+
+        with profiler.stage("read annotations", nbytes=xml_path.stat().st_size):
+            src_subsets = read_cvat_project_meta(xml_path)["subsets"]
+        chunks = profiler.iterate("read annotations", iter_cvat_chunks(xml_path))
     else:
-        print("Output directory already exists. Removing existing output directory")
-        shutil.rmtree(str(output_dir), ignore_errors=True)
-        print("Creating new output directory")
-
-    annot_data = read_cvat_annotation_xml(src_dir / "annotations.xml")
+        with profiler.stage("read annotations", nbytes=xml_path.stat().st_size) as stage:
+            ds = read_cvat_annotation_xml(xml_path)
+            stage.items += len(ds)
+        src_subsets = ds.subsets
+        chunks = [ds]
 
     # Validate subset map if provided
     if subset_map:
         for src, target in subset_map.items():
-            if src not in annot_data["subsets"]:
+            if src not in src_subsets:
                 raise ValueError(f"Subset '{src}' does not exist in CVAT dataset")
-            if target in annot_data["subsets"]:
+            if target in src_subsets:
                 raise ValueError(f"Subset '{target}' already exists in CVAT dataset")
 
-    # Get image path using 'images' in annot_data and check existence
-    for img in annot_data["images"]:
-        img_path = src_dir / "images" / img["subset"] / img["file_name"]
-        if not img_path.exists():
-            raise ValueError(f"Image file does not exist: {img_path}")
-
     # Create output directory
     # Create images and annotations folder
     out_imgs_dir = output_dir / "images"
     out_annots_dir = output_dir / "annotations"
-    out_imgs_dir.mkdir(parents=True, exist_ok=False)
-    out_annots_dir.mkdir(parents=True, exist_ok=False)
-
-    # Get categories for annotations, this was used consistently accross all subsets
-    name2id = {}
-    for _id, label in enumerate(annot_data["labels"], start=1):
-        name2id[label["name"]] = _id
-
-    # Create annotations for each subset
-    # We will get the images along with its annotations before actually writing
-    # the annotations to the file. This will support resplitting
-    all_images: dict[str, dict] = {}
-
-    # Create annotations for each subset
-    for subset in annot_data["subsets"]:
-        # Get images for each subset
-        imgs = [img for img in annot_data["images"] if img["subset"] == subset]
-        images: dict[int, dict] = {}  # id: data
-        for img in imgs:
-            images[img["id"]] = {
-                "id": img["id"],
-                "file_name": img["file_name"],
-                "width": img["width"],
-                "height": img["height"],
-                "subset": img["subset"],
-            }
-
-            all_images[f"{img['id']}_{img['subset']}"] = {
-                "image": images[img["id"]],
-                "annotations": [],
-                "subset": img["subset"],
-            }
-
-        image_ids = set(images.keys())
-
-        # Process annotations of each subset. Each each annotation contains
-        # image_id, cls_id and bbox
-        annots = [
-            annot
-            for annot in annot_data["annotations"]
-            if annot["image_id"] in image_ids and annot["subset"] == subset and annot["type"] == "rectangle"  # Image in COCO start from 1
-        ]
-
-        annotations: dict[int, dict] = {}  # image_id: data
-        for i in range(len(annots)):
-            annot = annots[i]
-
-            # # Skip if instance not have class name
-            if "label" not in annot:
-                continue
-
-            annot["id"] = i
-
-            # label to category_id
-            annot["category_id"] = name2id[annot["label"]]
-            del annot["label"]
-
-            # left to x
-            x = annot["left"]
-            del annot["left"]
-
-            # top to y
-            y = annot["top"]
-            del annot["top"]
-
-            width = annot["width"]
-            height = annot["height"]
-
-            annot["bbox"] = [x, y, width, height]
-            annot["segmentation"] = []
-            annot["iscrowd"] = 0
-
-            annots[i] = annot
-
-            annotations[annot["image_id"]] = annot
-
-            all_images[f"{annot["image_id"]}_{subset}"]["annotations"].append(
-                annotations[annot["image_id"]],
-            )
-
-    for k, data in all_images.items():
-        if len(data.get("annotations", [])) == 0:
-            raise ValueError(f"No annotations found for image: {k}")
-
-    # if split_ratio is provided, calculate size for each subset first
-    # if split_ratio is provided, calculate size for each subset first
-    if split_ratio:
-        keys = list(all_images.keys())
-
-        # make a list of position to split
-        split_pos = []
-
-        for subset, ratio in split_ratio.items():
-            split_size = round(len(all_images) * ratio)
-            split_pos.extend([subset] * split_size)
-
-        # shuffle the list
-        random.shuffle(split_pos)
-        for key in keys:
-            all_images[key]["subset"] = split_pos.pop()
-
-    # copy images to output directory
-    for subset in annot_data["subsets"]:
-        subset_img_src_dir = src_dir / "images" / subset
-        subset_img_dst_dir = out_imgs_dir
-
-        shutil.copytree(subset_img_src_dir, subset_img_dst_dir, dirs_exist_ok=True)
-
-    # Get the new subsets if split_ratio or subset_map is provided
-    subsets = set(annot_data["subsets"])
-    if split_ratio:
-        subsets = set(split_ratio.keys())
-    elif subset_map:
-        for src, target in subset_map.items():
-            if src in subsets:
-                subsets.remove(src)
-                subsets.add(target)
-
-    subsets_data: dict[str, dict] = {} # subset: data
-
-    # adding images to subsets_data
-    for key, data in all_images.items():
-        img_id, subset = key.split("_")
+    out_imgs_dir.mkdir(parents=True, exist_ok=True)
+    out_annots_dir.mkdir(parents=True, exist_ok=True)
 
-        # map to new subset if provided
-        new_subset = subset
-
-        if split_ratio:
-            new_subset = data["subset"]
-        elif subset_map and subset in subset_map:
-            new_subset = subset_map[subset]
-
-        if new_subset not in subsets_data:
-            subsets_data[new_subset] = {
-                "info": {
-                    "description": "COCO Dataset",
-                    "url": "https://khiemle.dev",
-                    "version": "1.0",
-                    "year": dt.datetime.now().year,
-                    "contributor": "Khiem Le",
-                    "date_created": dt.datetime.now().strftime("%Y/%m/%d"),
-                },
-                "licenses": [],
-                "images": [],
-                "annotations": [],
-                "categories": [{"id": v, "name": k} for k, v in name2id.items()],
-            }
-
-        # If resplit the data, reset the id of the image
-        if split_ratio:
-            data["image"]["id"] = len(subsets_data[new_subset]["images"]) + 1
-
-        subsets_data[new_subset]["images"].append(data["image"])
-
-    # write annotations to file
-    for key, data in all_images.items():
-        img_id, subset = key.split("_")
-
-        img = data["image"]
-        annotations = data["annotations"]
-
-        # map to new subset if provided
-        new_subset = subset
-
-        if split_ratio:
-            new_subset = data["subset"]
-        elif subset_map and subset in subset_map:
-            new_subset = subset_map[subset]
-
-        print(new_subset)
-
-        # Set image id for annotations
-        for i in range(len(data["annotations"])):
-            annot = data["annotations"][i]
-            annot["image_id"] = img["id"]
-
-            # reset the id of the annotation
-            annot["id"] = len(subsets_data[new_subset]["annotations"]) + 1
-
-            subsets_data[new_subset]["annotations"].append(annot)
-
-
-    for subset in subsets_data:
-        with open(out_annots_dir / f"instances_{subset}.json", "w") as f:
-            json.dump(subsets_data[subset], f, indent=2)
+    # Only the images which changed since the previous run are copied
+    manifest = OutputManifest(output_dir)
 
+    # copy images to output directory
+    with (
+        profiler.stage("transfer images") as stage,
+        open_file_transfer(transfer, workers, output_dir) as file_transfer,
+    ):
+        for subset in src_subsets:
+            subset_img_src_dir = src_dir / "images" / subset
+            subset_img_dst_dir = out_imgs_dir
+
+            manifest.submit_tree(file_transfer, subset_img_src_dir, subset_img_dst_dir)
+    stage.items += file_transfer.num_files
+    stage.bytes += file_transfer.num_bytes
+
+    # One json writer per output subset, images and annotations are written
+    # as soon as they are converted
+    with ExitStack() as stack:
+        writers: dict[str, CocoJsonWriter] = {}
+        output_names: set[str] = set()
+
+        for ds in chunks:
+            # Get image path of each image and check existence
+            with profiler.stage("check images", items=len(ds)):
+                for img_path in ds.image_paths():
+                    if not Path(img_path).exists():
+                        raise ValueError(f"Image file does not exist: {img_path}")
+
+            # Only rectangles are converted, each image must have at least one of them
+            no_annots = np.flatnonzero(ds.boxes_per_image == 0)
+            if len(no_annots) > 0:
+                raise ValueError(
+                    f"No annotations found for image: {ds.image_path(no_annots[0])}"
+                )
+
+            # Get the new subsets if split_ratio or subset_map is provided
+            if split_ratio:
+                ds = ds.resplit(split_ratio, split_seed, stratify)
+            elif subset_map:
+                ds = ds.map_subsets(subset_map)
+
+            # Clip boxes to their image and drop degenerate boxes, all at once
+            if clip_boxes:
+                ds = ds.clip_boxes()
+
+            # Images of all subsets share the images directory
+            ds.check_unique_file_names("coco", by_subset=False, seen=output_names)
+
+            with profiler.stage("write annotations", items=len(ds)):
+                for subset in ds.subsets:
+                    subset_ds = ds.select(ds.subset_rows(subset))
+                    if len(subset_ds) == 0:
+                        continue
+
+                    writer = writers.get(subset)
+                    if writer is None:
+                        manifest.add(out_annots_dir / f"instances_{subset}.json")
+
+                        # Categories are used consistently accross all subsets, id in
+                        # COCO starts from 1
+                        writer = writers[subset] = stack.enter_context(
+                            CocoJsonWriter(
+                                out_annots_dir / f"instances_{subset}.json",
+                                categories=[
+                                    {"id": i, "name": name}
+                                    for i, name in enumerate(ds.names, start=1)
+                                ],
+                                compact=compact,
+                                encoder=json_encoder,
+                            )
+                        )
+
+                    # If resplit the data, reset the id of the image
+                    image_ids = subset_ds.image_ids
+                    if split_ratio:
+                        image_ids = np.arange(1, len(subset_ds) + 1) + writer.num_images
+
+                    add_coco_images(writer, subset_ds, image_ids)
+
+    with profiler.stage("finish manifest"):
+        manifest.finish()
 
 
 def main():
@@ -316,14 +265,32 @@ def main():
     if split_ratio and subset_map:
         raise ValueError("Subset map and split ratio cannot be used together")
 
+    if split_ratio and args.stratify and args.stream:
+        raise ValueError("Stratified split cannot be used with stream")
+
+    profiler = StageProfiler() if args.profile is not None else None
+
     convert_cvat_to_coco(
         src_dir=args.src,
         output_dir=args.output,
         force=args.force,
+        incremental=args.incremental,
         subset_map=subset_map,
         split_ratio=split_ratio,
+        split_seed=args.split_seed,
+        stratify=args.stratify,
+        stream=args.stream,
+        transfer=args.transfer,
+        workers=args.workers,
+        compact=args.compact,
+        json_encoder=args.json_encoder,
+        clip_boxes=args.clip_boxes,
+        profiler=profiler,
     )
 
+    if profiler is not None:
+        profiler.finish(args.profile)
+
 
 if __name__ == "__main__":
     main()
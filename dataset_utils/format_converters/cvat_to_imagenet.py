@@ -8,15 +8,15 @@ current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
 sys.path.append(current_dir)
 
 
-import random
-import shutil
 from argparse import ArgumentParser
 from pathlib import Path
-from pprint import pprint
 
-import yaml
-from cvat_utils import read_cvat_annotation_xml
-from utils.bbox_utils import xywh2yolo
+import numpy as np
+from cvat_utils import iter_cvat_chunks, read_cvat_annotation_xml, read_cvat_project_meta
+from utils.manifest_utils import OutputManifest, add_manifest_args, prepare_output_dir
+from utils.profile_utils import StageProfiler, add_profile_args
+from utils.split_utils import add_split_args
+from utils.transfer_utils import add_transfer_args, open_file_transfer
 
 StrPath = str | Path
 
@@ -59,6 +59,17 @@ def get_args():
         default=[],
     )
 
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read annotations.xml incrementally with bounded memory, cannot be used with --stratify",
+    )
+
+    add_split_args(parser)
+    add_transfer_args(parser)
+    add_manifest_args(parser)
+    add_profile_args(parser)
+
     return parser.parse_args()
 
 
@@ -66,8 +77,15 @@ def convert_cvat_to_imagenet(
     src_dir: StrPath,
     output_dir: StrPath,
     force: bool = False,
+    incremental: bool = False,
     subset_map: dict[str, str] | None = None,
     split_ratio: dict[str, float] | None = None,
+    split_seed: int = 0,
+    stratify: bool = False,
+    stream: bool = False,
+    transfer: str = "copy",
+    workers: int = 4,
+    profiler: StageProfiler | None = None,
 ):
     """Convert dataset from CVAT for images format to ImageNet format
 
@@ -75,8 +93,15 @@ def convert_cvat_to_imagenet(
         src_dir (StrPath): directory of the CVAT dataset
         output_dir (StrPath): directory of the output ImageNet dataset
         force (bool, optional): Overwrite existing output directory. Defaults to False.
+        incremental (bool, optional): Update an output directory written by a previous run, only files whose source changed are rewritten. Defaults to False.
         subset_map (dict[str, str], optional): Map subset names to new subset names. Defaults to None.
         split_ratio (dict[str, float], optional): Split dataset into subsets and specify the ratio of each subset. Defaults to None.
+        split_seed (int, optional): Seed of the split, the subset of an image is drawn from a hash of its file name and the seed. Defaults to 0.
+        stratify (bool, optional): Split the images of each class with the split ratio, images are grouped by their rarest class. Defaults to False.
+        stream (bool, optional): Read annotations.xml in chunks of images instead of all at once. Defaults to False.
+        transfer (str, optional): How images are transferred, one of "copy", "hardlink", "reflink", "symlink" and "pack". Defaults to "copy".
+        workers (int, optional): Number of threads used to transfer images. Defaults to 4.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage of the conversion. Defaults to None.
     """  # noqa: E501
 
     src_dir = Path(src_dir)
@@ -86,141 +111,78 @@ def convert_cvat_to_imagenet(
         raise ValueError(f"Source is not a directory: {src_dir}")
 
     output_dir = Path(output_dir)
-    if not force:
-        if output_dir.exists():
-            raise ValueError("Output directory already exists")
+    prepare_output_dir(output_dir, force, incremental)
+    profiler = profiler or StageProfiler()
+
+    # Read the whole dataset at once, or chunk by chunk when streaming
+    xml_path = src_dir / "annotations.xml"
+    if stream:
+        if split_ratio and stratify:
+            raise ValueError("Stratified split cannot be used with stream")
+
+        with profiler.stage("read annotations", nbytes=xml_path.stat().st_size):
+            src_subsets = read_cvat_project_meta(xml_path)["subsets"]
+        chunks = profiler.iterate("read annotations", iter_cvat_chunks(xml_path))
     else:
-        print("Output directory already exists. Removing existing output directory")
-        shutil.rmtree(str(output_dir), ignore_errors=True)
-        print("Creating new output directory")
-
-    annot_data = read_cvat_annotation_xml(src_dir / "annotations.xml")
-
-    # Get image path using 'images' in annot_data and check existence
-    for img in annot_data["images"]:
-        img_path = src_dir / "images" / img["subset"] / img["file_name"]
-        if not img_path.exists():
-            raise ValueError(f"Image file does not exist: {img_path}")
+        with profiler.stage("read annotations", nbytes=xml_path.stat().st_size) as stage:
+            ds = read_cvat_annotation_xml(xml_path)
+            stage.items += len(ds)
+        src_subsets = ds.subsets
+        chunks = [ds]
 
     # Validate subset map if provided
     if subset_map:
         for src, target in subset_map.items():
-            if src not in annot_data["subsets"]:
+            if src not in src_subsets:
                 raise ValueError(f"Subset '{src}' does not exist in CVAT dataset")
-            if target in annot_data["subsets"]:
+            if target in src_subsets:
                 raise ValueError(f"Subset '{target}' already exists in CVAT dataset")
 
-    # Get categories for annotations, this was used consistently accross all subsets
-    name2id = {}
-    for _id, label in enumerate(annot_data["labels"]):
-        name2id[label["name"]] = _id
-
-    # Create annotations for each subset
-    # We will get the images along with its annotations before actually writing
-    # the annotations to the file. This will support resplitting
-    all_images: dict[str, dict] = {}
-
-    for subset in annot_data["subsets"]:
-        # Get images for each subset. The image data contains file_name, width and height
-        imgs = [img for img in annot_data["images"] if img["subset"] == subset]
-        images: dict[int, dict] = {}  # id: data
-        for img in imgs:
-            images[img["id"]] = {
-                "file_name": img["file_name"],
-                "width": img["width"],
-                "height": img["height"],
-                "subset": img["subset"],
-            }
-
-            all_images[f"{img['id']}_{img['subset']}"] = {
-                "image": images[img["id"]],
-                "annotations": [],
-                "subset": img["subset"],
-            }
-
-        # Process annotations of each subset. Each each annotation contains image_id, cls_id and bbox
-        image_ids = set(images.keys())
-        annots = [
-            annot
-            for annot in annot_data["annotations"]
-            if annot["image_id"] in image_ids  # Image in COCO start from 1
-        ]
-        annotations: dict[int, dict] = {}  # image_id: data
-        for annot in annots:
-            label = annot["label"]
-
-            # img_data = images[annot["image_id"]]
-            # imw = img_data["width"]
-            # imh = img_data["height"]
-
-            annotations[annot["image_id"]] = {
-                "label": label,
-            }
-
-            all_images[f"{annot['image_id']}_{subset}"]["annotations"].append(
-                annotations[annot["image_id"]],
+    # Only the images which changed since the previous run are copied
+    manifest = OutputManifest(output_dir)
+
+    with (
+        profiler.stage("transfer images") as transfer_stage,
+        open_file_transfer(transfer, workers, output_dir) as file_transfer,
+    ):
+        total_images = 0
+        output_names: set[str] = set()
+        for ds in chunks:
+            # Get image path of each image and check existence
+            with profiler.stage("check images", items=len(ds)):
+                for img_path in ds.image_paths():
+                    if not Path(img_path).exists():
+                        raise ValueError(f"Image file does not exist: {img_path}")
+
+            # Get the new subsets if split_ratio or subset_map is provided
+            if split_ratio:
+                ds = ds.resplit(split_ratio, split_seed, stratify)
+            elif subset_map:
+                ds = ds.map_subsets(subset_map)
+
+            total_images += len(ds)
+
+            # Images with the same name from different source subsets or
+            # directories would overwrite each other in their output subset
+            num_annots = ds.boxes_per_image + ds.polygons_per_image + ds.tags_per_image
+            ds.check_unique_file_names(
+                "imagenet", rows=np.flatnonzero(num_annots > 0), seen=output_names
             )
 
-    # if split_ratio is provided, calculate size for each subset first
-    if split_ratio:
-        keys = list(all_images.keys())
-
-        # make a list of position to split
-        split_pos = []
-
-        for subset, ratio in split_ratio.items():
-            split_size = round(len(all_images) * ratio)
-            split_pos.extend([subset] * split_size)
-
-        # shuffle the list
-        random.shuffle(split_pos)
-        for key in keys:
-            all_images[key]["subset"] = split_pos.pop()
-
-    # Get the new subsets if split_ratio or subset_map is provided
-    subsets = set(annot_data["subsets"])
-    if split_ratio:
-        subsets = set(split_ratio.keys())
-    elif subset_map:
-        for src, target in subset_map.items():
-            if src in subsets:
-                subsets.remove(src)
-                subsets.add(target)
-
-    print("Total images:", len(all_images))
-
-    # Copy images and write annotations to file
-    for key, data in all_images.items():
-        img_id, subset = key.split("_")
-
-        img = data["image"]
-        annotations: list[dict] = data["annotations"]
-
-        # skip images without annotations
-        if len(annotations) == 0:
-            # print("Skipping image without annotations:", img["file_name"])
-            continue
-
-        # map to new subset if provided
-        new_subset = subset
-
-        if split_ratio:
-            new_subset = data["subset"]
-        elif subset_map:
-            if subset_map and subset in subset_map:
-                new_subset = subset_map[subset]
-
-        # Make subdir for each subset
-        subset_img_src_dir = src_dir / "images" / img["subset"]
-        subset_img_dst_dir = output_dir / new_subset
-
-        # Write image to corresponding label dir
-        for annot in annotations:
-            img_path = subset_img_src_dir / img["file_name"]
-            output_path = subset_img_dst_dir / annot["label"] / img["file_name"]
-            output_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copyfile(img_path, output_path)
+            # Copy images to the directory of each label they are annotated with,
+            # images without annotations are skipped. Boxes, polygons and tags are all used
+            img_paths = ds.image_paths()
+            for label in ds.names:
+                for i in ds.label_image_rows(label).tolist():
+                    output_path = output_dir / ds.subsets[ds.subset_ids[i]] / label / ds.file_names[i]
+                    output_path.parent.mkdir(parents=True, exist_ok=True)
+                    manifest.transfer(file_transfer, img_paths[i], output_path)
+    transfer_stage.items += file_transfer.num_files
+    transfer_stage.bytes += file_transfer.num_bytes
 
+    with profiler.stage("finish manifest"):
+        manifest.finish()
+    print("Total images:", total_images)
 
 
 def main():
@@ -245,14 +207,29 @@ def main():
     if split_ratio and subset_map:
         raise ValueError("Subset map and split ratio cannot be used together")
 
+    if split_ratio and args.stratify and args.stream:
+        raise ValueError("Stratified split cannot be used with stream")
+
+    profiler = StageProfiler() if args.profile is not None else None
+
     convert_cvat_to_imagenet(
         src_dir=args.src,
         output_dir=args.output,
         force=args.force,
+        incremental=args.incremental,
         subset_map=subset_map,
         split_ratio=split_ratio,
+        split_seed=args.split_seed,
+        stratify=args.stratify,
+        stream=args.stream,
+        transfer=args.transfer,
+        workers=args.workers,
+        profiler=profiler,
     )
 
+    if profiler is not None:
+        profiler.finish(args.profile)
+
 
 if __name__ == "__main__":
     main()
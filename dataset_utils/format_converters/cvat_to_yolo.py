@@ -8,14 +8,30 @@ current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
 sys.path.append(current_dir)
 
 
-import random
-import shutil
 from argparse import ArgumentParser
 from pathlib import Path
+from time import perf_counter
 
+import numpy as np
 import yaml
-from cvat_utils import read_cvat_annotation_xml
-from utils.bbox_utils import xywh2yolo
+from cvat_utils import (
+    CvatProject,
+    iter_cvat_chunks,
+    read_cvat_annotation_xml,
+    read_cvat_project_meta,
+)
+from utils.bbox_utils import add_box_args
+from utils.manifest_utils import (
+    ImageDirLinks,
+    OutputManifest,
+    add_annotations_only_arg,
+    add_manifest_args,
+    prepare_output_dir,
+)
+from utils.pipeline_utils import Pipeline, batch_rows
+from utils.profile_utils import StageProfiler, add_profile_args
+from utils.split_utils import add_split_args
+from utils.transfer_utils import add_transfer_args, open_file_transfer
 
 StrPath = str | Path
 
@@ -58,6 +74,19 @@ def get_args():
         default=[],
     )
 
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read annotations.xml incrementally with bounded memory, cannot be used with --stratify",
+    )
+
+    add_split_args(parser)
+    add_transfer_args(parser)
+    add_box_args(parser)
+    add_manifest_args(parser)
+    add_annotations_only_arg(parser)
+    add_profile_args(parser)
+
     return parser.parse_args()
 
 
@@ -65,8 +94,17 @@ def convert_cvat_to_yolo_ultralytics(
     src_dir: StrPath,
     output_dir: StrPath,
     force: bool = False,
+    incremental: bool = False,
     subset_map: dict[str, str] | None = None,
     split_ratio: dict[str, float] | None = None,
+    split_seed: int = 0,
+    stratify: bool = False,
+    stream: bool = False,
+    transfer: str = "copy",
+    workers: int = 4,
+    annotations_only: bool = False,
+    clip_boxes: bool = False,
+    profiler: StageProfiler | None = None,
 ):
     """Convert dataset from CVAT for images format to YOLO Ultralytics format
 
@@ -77,8 +115,17 @@ def convert_cvat_to_yolo_ultralytics(
         src_dir (StrPath): directory of the CVAT dataset
         output_dir (StrPath): directory of the output YOLO Ultralytics dataset
         force (bool, optional): Overwrite existing output directory. Defaults to False.
+        incremental (bool, optional): Update an output directory written by a previous run, only files whose source changed are rewritten. Defaults to False.
         subset_map (dict[str, str], optional): Map subset names to new subset names. Defaults to None.
         split_ratio (dict[str, float], optional): Split dataset into subsets and specify the ratio of each subset. Defaults to None.
+        split_seed (int, optional): Seed of the split, the subset of an image is drawn from a hash of its file name and the seed. Defaults to 0.
+        stratify (bool, optional): Split the images of each class with the split ratio, images are grouped by their rarest class. Defaults to False.
+        stream (bool, optional): Read annotations.xml in chunks of images instead of all at once. Defaults to False.
+        transfer (str, optional): How images are transferred, one of "copy", "hardlink", "reflink", "symlink" and "pack". Defaults to "copy".
+        workers (int, optional): Number of threads used to transfer images. Defaults to 4.
+        annotations_only (bool, optional): Write only the labels, images are listed in <subset>.txt files and referenced through one symlink per source directory. Defaults to False.
+        clip_boxes (bool, optional): Clip boxes to their image and drop boxes left without area. Defaults to False.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage of the conversion. Defaults to None.
     """  # noqa: E501
 
     src_dir = Path(src_dir)
@@ -88,176 +135,205 @@ def convert_cvat_to_yolo_ultralytics(
         raise ValueError(f"Source is not a directory: {src_dir}")
 
     output_dir = Path(output_dir)
-    if not force:
-        if output_dir.exists():
-            raise ValueError("Output directory already exists")
+    prepare_output_dir(output_dir, force, incremental)
+    profiler = profiler or StageProfiler()
+
+    # Read the whole dataset at once, or chunk by chunk when streaming
+    xml_path = src_dir / "annotations.xml"
+    if stream:
+        if split_ratio and stratify:
+            raise ValueError("Stratified split cannot be used with stream")
+
+        with profiler.stage("read annotations", nbytes=xml_path.stat().st_size):
+            meta = read_cvat_project_meta(xml_path)
+        src_subsets = meta["subsets"]
+        names = [label["name"] for label in meta["labels"]]
+        chunks = iter_cvat_chunks(xml_path)
     else:
-        print("Output directory already exists. Removing existing output directory")
-        shutil.rmtree(str(output_dir), ignore_errors=True)
-        print("Creating new output directory")
-
-    annot_data = read_cvat_annotation_xml(src_dir / "annotations.xml")
-
-    # Get image path using 'images' in annot_data and check existence
-    for img in annot_data["images"]:
-        img_path = src_dir / "images" / img["subset"] / img["file_name"]
-        if not img_path.exists():
-            raise ValueError(f"Image file does not exist: {img_path}")
+        with profiler.stage("read annotations", nbytes=xml_path.stat().st_size) as stage:
+            ds = read_cvat_annotation_xml(xml_path)
+            stage.items += len(ds)
+        src_subsets = ds.subsets
+        names = ds.names
+        chunks = [ds]
 
     # Validate subset map if provided
     if subset_map:
         for src, target in subset_map.items():
-            if src not in annot_data["subsets"]:
+            if src not in src_subsets:
                 raise ValueError(f"Subset '{src}' does not exist in CVAT dataset")
-            if target in annot_data["subsets"]:
+            if target in src_subsets:
                 raise ValueError(f"Subset '{target}' already exists in CVAT dataset")
 
     # Create output directory
     # Create images and annotations folder
     out_imgs_dir = output_dir / "images"
     out_annots_dir = output_dir / "labels"
-    out_imgs_dir.mkdir(parents=True, exist_ok=False)
-    out_annots_dir.mkdir(parents=True, exist_ok=False)
-
-    # Get categories for annotations, this was used consistently accross all subsets
-    name2id = {}
-    for _id, label in enumerate(annot_data["labels"]):
-        name2id[label["name"]] = _id
-
-    # Create annotations for each subset
-    # We will get the images along with its annotations before actually writing
-    # the annotations to the file. This will support resplitting
-    all_images: dict[str, dict] = {}
-
-    for subset in annot_data["subsets"]:
-        # Get images for each subset. The image data contains file_name, width and height
-        imgs = [img for img in annot_data["images"] if img["subset"] == subset]
-        images: dict[int, dict] = {}  # id: data
-        for img in imgs:
-            images[img["id"]] = {
-                "file_name": img["file_name"],
-                "width": img["width"],
-                "height": img["height"],
-                "subset": img["subset"],
-            }
-
-            all_images[f"{img['id']}_{img['subset']}"] = {
-                "image": images[img["id"]],
-                "annotations": [],
-                "subset": img["subset"],
-            }
-
-        # Process annotations of each subset. Each each annotation contains image_id, cls_id and bbox
-        image_ids = set(images.keys())
-        annots = [
-            annot
-            for annot in annot_data["annotations"]
-            if annot["image_id"] in image_ids  # Image in COCO start from 1
-        ]
-        annotations: dict[int, dict] = {}  # image_id: data
-        for annot in annots:
-            x = annot["left"]
-            y = annot["top"]
-            width = annot["width"]
-            height = annot["height"]
-
-            img_data = images[annot["image_id"]]
-            imw = img_data["width"]
-            imh = img_data["height"]
-
-            annotations[annot["image_id"]] = {
-                "cls_id": name2id[annot["label"]],
-                "bbox": xywh2yolo(x, y, width, height, imw, imh),
-            }
-
-            all_images[f"{annot['image_id']}_{subset}"]["annotations"].append(
-                annotations[annot["image_id"]],
-            )
-
-    # if split_ratio is provided, calculate size for each subset first
-    if split_ratio:
-        keys = list(all_images.keys())
-
-        # make a list of position to split
-        split_pos = []
-
-        for subset, ratio in split_ratio.items():
-            split_size = round(len(all_images) * ratio)
-            split_pos.extend([subset] * split_size)
-
-        # shuffle the list
-        random.shuffle(split_pos)
-        for key in keys:
-            all_images[key]["subset"] = split_pos.pop()
+    out_imgs_dir.mkdir(parents=True, exist_ok=True)
+    out_annots_dir.mkdir(parents=True, exist_ok=True)
+
+    # Only the images and labels which changed since the previous run are written
+    manifest = OutputManifest(output_dir)
+
+    # In annotations only mode, images are listed per subset instead of copied
+    links = ImageDirLinks(out_imgs_dir, manifest) if annotations_only else None
+    image_lists: dict[str, list[str]] = {}
+    label_dirs: set[Path] = set()
+    subsets: list[str] = []
+    output_names: set[str] = set()
+    read_time, read_items = 0.0, 0
+
+    def subset_batches():
+        # Runs in the feeder thread of the pipeline, streamed chunks are
+        # parsed while the batches of the previous chunks are written
+        nonlocal read_time, read_items
+        iterator = iter(chunks)
+        while True:
+            start = perf_counter()
+            ds = next(iterator, None)
+            read_time += perf_counter() - start
+            if ds is None:
+                return
+            read_items += len(ds)
+
+            # Get the new subsets if split_ratio or subset_map is provided
+            if split_ratio:
+                ds = ds.resplit(split_ratio, split_seed, stratify)
+            elif subset_map:
+                ds = ds.map_subsets(subset_map)
+
+            # Clip boxes to their image and drop degenerate boxes, all at once
+            if clip_boxes:
+                ds = ds.clip_boxes()
+
+            # Images with the same name from different source subsets or
+            # directories would overwrite each other in their output subset
+            if links is None:
+                num_annots = ds.boxes_per_image + ds.polygons_per_image + ds.tags_per_image
+                ds.check_unique_file_names(
+                    "yolo", rows=np.flatnonzero(num_annots > 0), seen=output_names
+                )
 
-    # Get the new subsets if split_ratio or subset_map is provided
-    subsets = set(annot_data["subsets"])
-    if split_ratio:
-        subsets = set(split_ratio.keys())
-    elif subset_map:
-        for src, target in subset_map.items():
-            if src in subsets:
-                subsets.remove(src)
-                subsets.add(target)
+            # Make subdir for each subset
+            for subset in ds.subsets:
+                if subset not in subsets:
+                    if links is None:
+                        (out_imgs_dir / subset).mkdir(parents=True, exist_ok=True)
+                        (out_annots_dir / subset).mkdir(parents=True, exist_ok=True)
+                    subsets.append(subset)
 
-    # Copy images and write annotations to file
-    for key, data in all_images.items():
-        img_id, subset = key.split("_")
+            for subset in ds.subsets:
+                for rows in batch_rows(ds.subset_rows(subset)):
+                    yield ds.select(rows)
 
-        img = data["image"]
-        annotations = data["annotations"]
+    def check_images(batch: CvatProject) -> CvatProject:
+        # Get image path of each image and check existence
+        for img_path in batch.image_paths():
+            if not os.path.exists(img_path):
+                raise ValueError(f"Image file does not exist: {img_path}")
 
         # skip images without annotations
-        if len(annotations) == 0:
-            # print("Skipping image without annotations:", img["file_name"])
-            continue
-
-        # map to new subset if provided
-        new_subset = subset
-
-        if split_ratio:
-            new_subset = data["subset"]
-        elif subset_map:
-            if subset_map and subset in subset_map:
-                new_subset = subset_map[subset]
-
-        # Make subdir for each subset
-        subset_img_src_dir = src_dir / "images" / img["subset"]
-        subset_img_dst_dir = out_imgs_dir / new_subset
-        subset_annot_dst_dir = out_annots_dir / new_subset
-
-        subset_img_dst_dir.mkdir(parents=True, exist_ok=True)
-        subset_annot_dst_dir.mkdir(parents=True, exist_ok=True)
-
-        # Write annotations for each image
-        # Copy image
-        src_img_path = subset_img_src_dir / img["file_name"]
-        shutil.copy(str(src_img_path), str(subset_img_dst_dir / img["file_name"]))
-
-        # Write annotations to txt file
-        output_txt_file = (subset_annot_dst_dir / img["file_name"]).with_suffix(".txt")
-        with output_txt_file.open("w") as f:
-            for annot in annotations:
-                if annot["type"] != "rectangle":
-                    continue
-                f.write(
-                    f"{annot['cls_id']} {annot['bbox'][0]} {annot['bbox'][1]} {annot['bbox'][2]} {annot['bbox'][3]}\n"
+        num_annots = batch.boxes_per_image + batch.polygons_per_image + batch.tags_per_image
+        return batch.select(np.flatnonzero(num_annots > 0))
+
+    def write_labels(batch: CvatProject) -> CvatProject:
+        if len(batch) == 0:
+            return batch
+        subset = batch.subsets[batch.subset_ids[0]]
+
+        # Path of every image relative to the images directory
+        if links is not None:
+            img_names = links.image_names(batch)
+
+        # Convert all boxes at once, class ids are the index of labels in the project
+        yolo_boxes = batch.boxes_as("yolo")
+        box_offsets = batch.box_offsets.tolist()
+
+        # Copy images and write annotations to file
+        for i, file_name in enumerate(batch.file_names.tolist()):
+            if links is None:
+                # Copy image
+                manifest.transfer(
+                    file_transfer,
+                    batch.image_path(i),
+                    out_imgs_dir / subset / file_name,
+                )
+                label_name = f"{subset}/{file_name}"
+            else:
+                # Reference image through the link to its source directory
+                label_name = img_names[i]
+
+            output_txt_file = (out_annots_dir / label_name).with_suffix(".txt")
+            if output_txt_file.parent not in label_dirs:
+                output_txt_file.parent.mkdir(parents=True, exist_ok=True)
+                label_dirs.add(output_txt_file.parent)
+
+            # Write rectangle annotations to txt file
+            start, end = box_offsets[i], box_offsets[i + 1]
+            manifest.write_text(
+                output_txt_file,
+                "".join(
+                    f"{cls_id} {xc} {yc} {w} {h}\n"
+                    for cls_id, (xc, yc, w, h) in zip(
+                        batch.box_classes[start:end].tolist(),
+                        yolo_boxes[start:end].tolist(),
+                    )
+                ),
+            )
+        return batch
+
+    # Images are checked, labels written and images transferred at the same
+    # time, by batches of images of one subset, while the next chunk is read.
+    # Batches come out of the pipeline in order for the image lists
+    pipeline = Pipeline()
+    pipeline.add_stage("check images", check_images, workers=max(1, workers // 2))
+    pipeline.add_stage("write labels", write_labels, workers=max(1, workers // 2))
+
+    with (
+        profiler.stage("pipeline"),
+        open_file_transfer(transfer, workers, output_dir) as file_transfer,
+    ):
+        for batch in pipeline.run(subset_batches()):
+            if links is not None and len(batch):
+                subset = batch.subsets[batch.subset_ids[0]]
+                image_lists.setdefault(subset, []).extend(
+                    f"./images/{img_name}\n" for img_name in links.image_names(batch)
                 )
 
+    # Streamed chunks are parsed by the feeder thread of the pipeline
+    if stream:
+        profiler.record("read chunks", read_time, items=read_items, parent="pipeline")
+    pipeline.record(profiler, parent="pipeline")
+    profiler.record(
+        "transfer images",
+        file_transfer.time,
+        items=file_transfer.num_files,
+        nbytes=file_transfer.num_bytes,
+        parent="pipeline",
+    )
+
     # Create data.yaml file
     data_yml = {}
     for subset in subsets:
-        data_yml[subset] = f"./images/{subset}"
+        if links is None:
+            data_yml[subset] = f"./images/{subset}"
+        else:
+            manifest.write_text(output_dir / f"{subset}.txt", "".join(image_lists.get(subset, [])))
+            data_yml[subset] = f"./{subset}.txt"
 
     data_yml.update(
         {
-            "nc": len(name2id),
-            "names": {v: k for k, v in name2id.items()},
+            "nc": len(names),
+            "names": dict(enumerate(names)),
         }
     )
 
     with open(output_dir / "data.yaml", "w") as f:
         yaml.dump(data_yml, f, sort_keys=False)
+    manifest.add(output_dir / "data.yaml")
+
+    with profiler.stage("finish manifest"):
+        manifest.finish()
 
 
 def main():
@@ -282,14 +358,31 @@ def main():
     if split_ratio and subset_map:
         raise ValueError("Subset map and split ratio cannot be used together")
 
+    if split_ratio and args.stratify and args.stream:
+        raise ValueError("Stratified split cannot be used with stream")
+
+    profiler = StageProfiler() if args.profile is not None else None
+
     convert_cvat_to_yolo_ultralytics(
         src_dir=args.src,
         output_dir=args.output,
         force=args.force,
+        incremental=args.incremental,
         subset_map=subset_map,
         split_ratio=split_ratio,
+        split_seed=args.split_seed,
+        stratify=args.stratify,
+        stream=args.stream,
+        transfer=args.transfer,
+        workers=args.workers,
+        annotations_only=args.annotations_only,
+        clip_boxes=args.clip_boxes,
+        profiler=profiler,
     )
 
+    if profiler is not None:
+        profiler.finish(args.profile)
+
 
 if __name__ == "__main__":
     main()
@@ -1,32 +1,127 @@
+import datetime as dt
 import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from functools import cached_property
 from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+from columnar_utils import ColumnarBuilder, ColumnarDataset, group_rows
+from utils.manifest_utils import ImageDirLinks, OutputManifest
+from utils.transfer_utils import FileTransfer
 
 StrPath = str | Path
 
 
-def read_cvat_annotation_xml(xml_path: StrPath) -> dict:
-    """Read
+@dataclass
+class CvatProject(ColumnarDataset):
+    """ColumnarDataset of a CVAT project with lookups by subset, image id and label
 
-    Args:
-        xml_path (StrPath): path to the annotation xml file in CVAT dataset folder
+    Indices are built once on first use, in O(N log N), so every lookup after
+    that only slices precomputed arrays instead of scanning all images and
+    annotations again.
+    """
 
-    Raises:
-        ValueError: value error with explaination
+    @cached_property
+    def _subset_index(self) -> tuple[np.ndarray, np.ndarray]:
+        return group_rows(self.subset_ids, len(self.subsets))
 
-    Returns:
-        dict: dictionary containing all the data read from the CVAT XML file
-    """  # noqa: E501
+    @cached_property
+    def _image_id_index(self) -> np.ndarray:
+        return np.argsort(self.image_ids, kind="stable")
 
-    xml_path = Path(xml_path)
+    @cached_property
+    def _label_index(self) -> tuple[np.ndarray, np.ndarray]:
+        # rows of the image of every box, polygon and tag, grouped by label
+        annot_rows = np.concatenate(
+            [
+                self.box_image_index(),
+                np.repeat(np.arange(self.num_images), self.polygons_per_image),
+                np.repeat(np.arange(self.num_images), self.tags_per_image),
+            ]
+        )
+        annot_classes = np.concatenate(
+            [self.box_classes, self.polygon_classes, self.tag_classes]
+        )
+        order, offsets = group_rows(annot_classes, len(self.names))
+        return annot_rows[order], offsets
 
-    if not xml_path.exists():
-        raise ValueError(f"Annotation XML file does not exist: {xml_path}")
+    @cached_property
+    def _box_label_index(self) -> tuple[np.ndarray, np.ndarray]:
+        return group_rows(self.box_classes, len(self.names))
+
+    def subset_rows(self, subset: str) -> np.ndarray:
+        """Return the rows of the images of a subset, in dataset order"""
+        if subset not in self.subsets:
+            return np.empty(0, dtype=np.int64)
+
+        rows, offsets = self._subset_index
+        k = self.subsets.index(subset)
+        return rows[offsets[k] : offsets[k + 1]]
+
+    def image_rows(self, image_ids: np.ndarray) -> np.ndarray:
+        """Return the rows of the given CVAT image ids, -1 for unknown ids"""
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        order = self._image_id_index
+        pos = np.searchsorted(self.image_ids, image_ids, sorter=order)
+
+        rows = np.full(len(image_ids), -1, dtype=np.int64)
+        found = pos < len(order)
+        rows[found] = order[pos[found]]
+        found[found] = self.image_ids[rows[found]] == image_ids[found]
+        rows[~found] = -1
+        return rows
+
+    def image_row(self, image_id: int) -> int:
+        row = int(self.image_rows([image_id])[0])
+        if row < 0:
+            raise KeyError(f"Image id does not exist: {image_id}")
+        return row
+
+    def label_image_rows(self, label: str) -> np.ndarray:
+        """Return the unique rows of the images having any annotation of a label"""
+        rows, offsets = self._label_index
+        k = self.names.index(label)
+        return np.unique(rows[offsets[k] : offsets[k + 1]])
 
-    tree = ET.parse(str(xml_path))
-    root = tree.getroot()
+    def label_box_indices(self, label: str) -> np.ndarray:
+        """Return the indices of the boxes of a label"""
+        indices, offsets = self._box_label_index
+        k = self.names.index(label)
+        return indices[offsets[k] : offsets[k + 1]]
 
+
+def _iter_root_children(xml_path: StrPath) -> Iterator[ET.Element]:
+    """Iterate over the direct children of the root element of a XML file
+
+    Each child is yielded once it is completely parsed, then it is cleared
+    from the tree so the memory stays bounded by the size of one child.
+    """
+
+    context = ET.iterparse(str(xml_path), events=("start", "end"))
+    _, root = next(context)
+
+    depth = 0
+    for event, el in context:
+        if event == "start":
+            depth += 1
+            continue
+
+        if el is root:
+            break
+
+        depth -= 1
+        if depth == 0:
+            yield el
+            root.clear()
+
+
+def _parse_project_meta(meta_el: ET.Element) -> dict:
     # Read project metadata
-    project_meta_el = root.find("./meta/project")
+    project_meta_el = meta_el.find("project")
+    if project_meta_el is None:
+        raise ValueError("Project metadata not found in annotation XML file")
+
     project_name = project_meta_el.find("name").text
     subsets = project_meta_el.find("subsets").text.split("\n")
 
@@ -64,119 +159,365 @@ def read_cvat_annotation_xml(xml_path: StrPath) -> dict:
             }
         )
 
-    # Read all images element and its attributes
-    image_els = root.findall("./image")
-    images = []
-    annotations = []
-    for image_el in image_els:
-        img_id = int(image_el.get("id"))
-        img_name = image_el.get("name")
-        img_subset = image_el.get("subset")
-        img_width = int(image_el.get("width"))
-        img_height = int(image_el.get("height"))
-        img_task_id = int(image_el.get("task_id"))
-
-        images.append(
-            {
-                "id": img_id,
-                "file_name": img_name,
-                "width": img_width,
-                "height": img_height,
-                "subset": img_subset,
-                "task_id": img_task_id,
-            }
-        )
+    return {
+        "project_name": project_name,
+        "subsets": subsets,
+        "labels": labels,
+        "tasks": tasks,
+    }
 
-        # Read all rectangle annotations of current image
-        annotation_els = image_el.findall("./box")
-        for annot in annotation_els:
-            annot_label = annot.get("label")
-            annot_left = float(annot.get("xtl"))
-            annot_top = float(annot.get("ytl"))
-            annot_right = float(annot.get("xbr"))
-            annot_bottom = float(annot.get("ybr"))
-
-            annotations.append(
-                {
-                    "image_id": img_id,
-                    "label": annot_label,
-                    "type": "rectangle",
-                    "left": annot_left,
-                    "top": annot_top,
-                    "width": annot_right - annot_left,
-                    "height": annot_bottom - annot_top,
-                    "subset": img_subset,
-                }
-            )
 
-        # Read all polygon annotations of current image
-        poly_els = image_el.findall("polygon")
-        for poly_el in poly_els:
-            annot_label = poly_el.get("label")
-
-            points = []
-            _points_attr = poly_el.get("points")
-            if _points_attr is None:
-                raise ValueError("points not found")
-
-            _points = _points_attr.split(";")
-            for _pts in _points:
-                points.extend(_pts.split(","))
-            points = list(map(float, points))
-
-            # Do convert if needed
-            # Convert to rectangle box
-            # x1 = min(points[:-1:2])
-            # y1 = min(points[1::2])
-            # x2 = max(points[:-1:2])
-            # y2 = max(points[1::2])
-
-            # convert to YOLO format (xc, yc, w, h) normalized
-            # xc = (x1 + ((x2 - x1) / 2)) / imw
-            # yc = (y1 + ((y2 - y1) / 2)) / imh
-            # w = (x2 - x1) / imw
-            # h = (y2 - y1) / imh
-
-            annotations.append(
-                {
-                    "image_id": img_id,
-                    "label": annot_label,
-                    "type": "polygon",
-                    "left": None,
-                    "top": None,
-                    "width": None,
-                    "height": None,
-                    "points": points,
-                    "subset": img_subset,
-                }
+def _parse_image(image_el: ET.Element) -> dict:
+    # Read all rectangle annotations of current image
+    boxes = []
+    for annot in image_el.findall("box"):
+        boxes.append(
+            (
+                annot.get("label"),
+                [
+                    float(annot.get("xtl")),
+                    float(annot.get("ytl")),
+                    float(annot.get("xbr")),
+                    float(annot.get("ybr")),
+                ],
             )
+        )
 
-        # Read all tag annotations of current image
-        tag_els = image_el.findall("tag")
-        for tag_el in tag_els:
-            annot_label = tag_el.get("label")
-
-            annotations.append(
-                {
-                    "image_id": img_id,
-                    "label": annot_label,
-                    "type": "tag",
-                    "left": None,
-                    "top": None,
-                    "width": None,
-                    "height": None,
-                    "points": None,
-                    "subset": img_subset,
-                }
-            )
+    # Read all polygon annotations of current image
+    polygons = []
+    for poly_el in image_el.findall("polygon"):
+        _points_attr = poly_el.get("points")
+        if _points_attr is None:
+            raise ValueError("points not found")
 
-    result = {
-        "project_name": project_name,
-        "subsets": subsets,
-        "labels": labels,
-        "tasks": tasks,
-        "images": images,
-        "annotations": annotations,
+        points = []
+        for _pts in _points_attr.split(";"):
+            points.extend(_pts.split(","))
+
+        polygons.append((poly_el.get("label"), list(map(float, points))))
+
+    # Read all tag annotations of current image
+    tags = [tag_el.get("label") for tag_el in image_el.findall("tag")]
+
+    return {
+        "id": int(image_el.get("id")),
+        "file_name": image_el.get("name"),
+        "width": int(image_el.get("width")),
+        "height": int(image_el.get("height")),
+        "subset": image_el.get("subset"),
+        "task_id": int(image_el.get("task_id", -1)),
+        "boxes": boxes,
+        "polygons": polygons,
+        "tags": tags,
     }
 
-    return result
+
+def read_cvat_project_meta(xml_path: StrPath) -> dict:
+    """Read only the project metadata of a CVAT annotation XML file
+
+    The metadata is at the top of the file, so only the beginning of the file
+    is parsed.
+
+    Args:
+        xml_path (StrPath): path to the annotation xml file in CVAT dataset folder
+
+    Raises:
+        ValueError: value error with explaination
+
+    Returns:
+        dict: {
+            "project_name": str,
+            "subsets": list[str],
+            "labels": [{"name": str, "type": str, "color": str}, ...],
+            "tasks": [{"id": int, "name": str, "subset": str, "size": int}, ...],
+        }
+    """  # noqa: E501
+
+    xml_path = Path(xml_path)
+
+    if not xml_path.exists():
+        raise ValueError(f"Annotation XML file does not exist: {xml_path}")
+
+    for el in _iter_root_children(xml_path):
+        if el.tag == "meta":
+            return _parse_project_meta(el)
+        if el.tag == "image":
+            break
+
+    raise ValueError(f"Metadata not found before images in {xml_path}")
+
+
+def iter_cvat_images(xml_path: StrPath) -> Iterator[dict]:
+    """Read images of a CVAT annotation XML file one at a time
+
+    The file is parsed incrementally and processed elements are cleared, so
+    the memory stays flat whatever the size of the project.
+
+    Args:
+        xml_path (StrPath): path to the annotation xml file in CVAT dataset folder
+
+    Raises:
+        ValueError: value error with explaination
+
+    Yields:
+        dict: {
+            "id": int,
+            "file_name": str,
+            "width": int,
+            "height": int,
+            "subset": str,
+            "task_id": int,
+            "boxes": [(label, [xtl, ytl, xbr, ybr]), ...],
+            "polygons": [(label, [x1, y1, x2, y2, ...]), ...],
+            "tags": [label, ...],
+        }
+    """  # noqa: E501
+
+    xml_path = Path(xml_path)
+
+    if not xml_path.exists():
+        raise ValueError(f"Annotation XML file does not exist: {xml_path}")
+
+    for el in _iter_root_children(xml_path):
+        if el.tag == "image":
+            yield _parse_image(el)
+
+
+def _new_builder(meta: dict) -> ColumnarBuilder:
+    return ColumnarBuilder(
+        names=[label["name"] for label in meta["labels"]],
+        subsets=meta["subsets"],
+        box_format="xyxy",
+        meta={
+            "project_name": meta["project_name"],
+            "labels": meta["labels"],
+            "tasks": meta["tasks"],
+        },
+    )
+
+
+def _add_image(
+    builder: ColumnarBuilder,
+    img: dict,
+    name2id: dict[str, int],
+    images_dir: Path,
+):
+    builder.add_image(
+        file_name=img["file_name"],
+        dir_path=images_dir / img["subset"],
+        subset=img["subset"],
+        width=img["width"],
+        height=img["height"],
+        image_id=img["id"],
+        boxes=[box for _, box in img["boxes"]],
+        box_classes=[name2id[label] for label, _ in img["boxes"]],
+        tags=[name2id[label] for label in img["tags"]],
+        polygons=[(name2id[label], points) for label, points in img["polygons"]],
+    )
+
+
+def iter_cvat_chunks(xml_path: StrPath, chunk_size: int = 1024) -> Iterator[CvatProject]:
+    """Read a CVAT annotation XML file as a sequence of small ColumnarDataset
+
+    Every chunk has the same class names and contains at most chunk_size
+    images, so converters can process a project of any size with vectorized
+    operations and bounded memory.
+
+    Args:
+        xml_path (StrPath): path to the annotation xml file in CVAT dataset folder
+        chunk_size (int, optional): maximum number of images per chunk. Defaults to 1024.
+
+    Yields:
+        CvatProject: see read_cvat_annotation_xml
+    """  # noqa: E501
+
+    xml_path = Path(xml_path)
+    meta = read_cvat_project_meta(xml_path)
+    name2id = {label["name"]: i for i, label in enumerate(meta["labels"])}
+    images_dir = xml_path.parent / "images"
+
+    builder = _new_builder(meta)
+    for img in iter_cvat_images(xml_path):
+        _add_image(builder, img, name2id, images_dir)
+
+        if len(builder) >= chunk_size:
+            yield builder.build(CvatProject)
+            builder = _new_builder(meta)
+
+    if len(builder) > 0:
+        yield builder.build(CvatProject)
+
+
+def read_cvat_annotation_xml(xml_path: StrPath) -> CvatProject:
+    """Read CVAT for images annotation XML file
+
+    Args:
+        xml_path (StrPath): path to the annotation xml file in CVAT dataset folder
+
+    Raises:
+        ValueError: value error with explaination
+
+    Returns:
+        CvatProject: images with boxes in "xyxy" format, polygons and tags.
+            Images are expected in <xml dir>/images/<subset>/<name>. The project
+            name, labels and tasks are kept in meta.
+    """  # noqa: E501
+
+    xml_path = Path(xml_path)
+    meta = read_cvat_project_meta(xml_path)
+    name2id = {label["name"]: i for i, label in enumerate(meta["labels"])}
+    images_dir = xml_path.parent / "images"
+
+    result = _new_builder(meta)
+    for img in iter_cvat_images(xml_path):
+        _add_image(result, img, name2id, images_dir)
+
+    return result.build(CvatProject)
+
+
+def _label_type(ds: ColumnarDataset) -> str:
+    kinds = [
+        kind
+        for kind, count in (
+            ("rectangle", ds.num_boxes),
+            ("polygon", len(ds.polygon_classes)),
+            ("tag", len(ds.tag_classes)),
+        )
+        if count > 0
+    ]
+    return kinds[0] if len(kinds) == 1 else "any"
+
+
+def write_cvat_dataset(
+    ds: ColumnarDataset,
+    output_dir: StrPath,
+    file_transfer: FileTransfer,
+    manifest: OutputManifest,
+    annotations_only: bool = False,
+):
+    """Write a dataset in CVAT for images format
+
+    Images are transferred to <output_dir>/images/<subset>/ and boxes,
+    polygons and tags are written to <output_dir>/annotations.xml, with one
+    task per subset so the file can be read back by read_cvat_annotation_xml.
+
+    With annotations_only, images are not transferred: every source directory
+    is linked to <output_dir>/images/<subset>/<link>/ and the name of each
+    image is <link>/<file name>.
+
+    Args:
+        ds (ColumnarDataset): dataset to write, image sizes are required
+        output_dir (StrPath): directory of the output dataset
+        file_transfer (FileTransfer): transfer of the images
+        manifest (OutputManifest): manifest of the output directory, only
+            the images which changed are transferred
+        annotations_only (bool, optional): reference the source images
+            instead of transferring them. Defaults to False.
+    """
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Keep the colors of the labels of a CVAT project
+    colors = {label["name"]: label["color"] for label in ds.meta.get("labels", [])}
+    label_type = _label_type(ds)
+
+    root = ET.Element("annotations")
+
+    # CVAT for images version 1.1
+    version_el = ET.SubElement(root, "version")
+    version_el.text = "1.1"
+
+    meta_el = ET.SubElement(root, "meta")
+    meta_project_el = ET.SubElement(meta_el, "project")
+    name_el = ET.SubElement(meta_project_el, "name")
+    name_el.text = ds.meta.get("project_name") or output_dir.name
+
+    subsets_el = ET.SubElement(meta_project_el, "subsets")
+    subsets_el.text = "\n".join(ds.subsets)
+
+    # add labels to project
+    labels_el = ET.SubElement(meta_project_el, "labels")
+    for i, name in enumerate(ds.names):
+        label_el = ET.SubElement(labels_el, "label")
+        ET.SubElement(label_el, "name").text = name
+        ET.SubElement(label_el, "type").text = label_type
+        ET.SubElement(label_el, "color").text = colors.get(
+            name, f"#{(i * 2654435761) & 0xFFFFFF:06x}"
+        )
+        ET.SubElement(label_el, "attributes")
+
+    # one task per subset
+    tasks_el = ET.SubElement(meta_project_el, "tasks")
+    subset_sizes = np.bincount(ds.subset_ids, minlength=len(ds.subsets)).tolist()
+    for task_id, (subset, size) in enumerate(zip(ds.subsets, subset_sizes)):
+        task_el = ET.SubElement(tasks_el, "task")
+        ET.SubElement(task_el, "id").text = str(task_id)
+        ET.SubElement(task_el, "name").text = subset
+        ET.SubElement(task_el, "subset").text = subset
+        ET.SubElement(task_el, "size").text = str(size)
+
+    dumped_meta_el = ET.SubElement(meta_el, "dumped")
+    dumped_meta_el.text = dt.datetime.today().strftime("%Y-%m-%d %H:%M:%S.%f%z")
+
+    # Convert all boxes to absolute corners at once
+    xyxy_boxes = ds.boxes_as("xyxy").tolist()
+    box_classes = ds.box_classes.tolist()
+    box_offsets = ds.box_offsets.tolist()
+
+    for subset_id, subset in enumerate(ds.subsets):
+        rows = np.flatnonzero(ds.subset_ids == subset_id).tolist()
+        if len(rows) == 0:
+            continue
+
+        subset_imgs_out_dir = output_dir / "images" / subset
+        subset_imgs_out_dir.mkdir(parents=True, exist_ok=True)
+
+        if annotations_only:
+            links = ImageDirLinks(subset_imgs_out_dir, manifest)
+            image_names = links.image_names(ds.select(rows))
+        else:
+            image_names = ds.file_names[rows].tolist()
+
+        for idx, image_name in zip(rows, image_names):
+            if not annotations_only:
+                manifest.transfer(
+                    file_transfer, ds.image_path(idx), subset_imgs_out_dir / image_name
+                )
+
+            image_el = ET.SubElement(root, "image")
+            image_el.set("id", str(idx))
+            image_el.set("name", image_name)
+            image_el.set("subset", subset)
+            image_el.set("task_id", str(subset_id))
+            image_el.set("width", str(ds.widths[idx]))
+            image_el.set("height", str(ds.heights[idx]))
+
+            start, end = box_offsets[idx], box_offsets[idx + 1]
+            for cls_id, (x1, y1, x2, y2) in zip(
+                box_classes[start:end], xyxy_boxes[start:end]
+            ):
+                box_el = ET.SubElement(image_el, "box")
+                box_el.set("label", ds.names[cls_id])
+                box_el.set("occluded", "0")
+                box_el.set("xtl", str(x1))
+                box_el.set("ytl", str(y1))
+                box_el.set("xbr", str(x2))
+                box_el.set("ybr", str(y2))
+
+            for cls_id, points in ds.image_polygons(idx):
+                polygon_el = ET.SubElement(image_el, "polygon")
+                polygon_el.set("label", ds.names[cls_id])
+                polygon_el.set("occluded", "0")
+                polygon_el.set("points", ";".join(f"{x},{y}" for x, y in points.tolist()))
+
+            for cls_id in ds.image_tags(idx).tolist():
+                tag_el = ET.SubElement(image_el, "tag")
+                tag_el.set("label", ds.names[cls_id])
+                tag_el.set("source", "manual")
+
+    annotation_xml_path = output_dir / "annotations.xml"
+    tree = ET.ElementTree(root)
+    ET.indent(tree)
+    tree.write(str(annotation_xml_path), encoding="utf-8", xml_declaration=True)
+    manifest.add(annotation_xml_path)
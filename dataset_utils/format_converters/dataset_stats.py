@@ -0,0 +1,159 @@
+import os
+import sys
+
+# Get the current directory
+current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
+
+# Add the current directory to the search path
+sys.path.append(current_dir)
+
+
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+
+from convert import FORMATS, read_dataset
+from stats_utils import HAS_MATPLOTLIB, dataset_stats, plot_stats
+from utils.profile_utils import StageProfiler, add_profile_args
+
+StrPath = str | Path
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--from",
+        type=str,
+        dest="src_format",
+        choices=FORMATS,
+        help="Format of the dataset",
+        required=True,
+    )
+    parser.add_argument(
+        "--src",
+        type=str,
+        help="Path to the dataset directory",
+        required=True,
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Path to the output JSON file",
+        required=True,
+    )
+    parser.add_argument(
+        "--plots",
+        type=str,
+        help="Directory where PNG plots of the statistics are saved, requires matplotlib",
+        default=None,
+    )
+    parser.add_argument(
+        "--skip-missing",
+        action="store_true",
+        help="Skip images without label file, YOLO source only",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of threads used to read labels and image sizes",
+        default=4,
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the label and image metadata caches",
+    )
+
+    add_profile_args(parser)
+
+    return parser.parse_args()
+
+
+def compute_dataset_stats(
+    src_dir: StrPath,
+    src_format: str,
+    output_path: StrPath,
+    plot_dir: StrPath | None = None,
+    skip_missing: bool = False,
+    workers: int = 4,
+    cache: bool = True,
+    profiler: StageProfiler | None = None,
+) -> dict:
+    """Compute the statistics of a dataset and write them as JSON
+
+    See stats_utils.dataset_stats for the statistics, they are computed for
+    the whole dataset and for each subset.
+
+    Args:
+        src_dir (StrPath): directory of the dataset
+        src_format (str): format of the dataset, one of FORMATS
+        output_path (StrPath): path of the output JSON file
+        plot_dir (StrPath | None, optional): Directory of PNG plots of the statistics, requires matplotlib. Defaults to None.
+        skip_missing (bool, optional): Skip images without label file, YOLO source only. Defaults to False.
+        workers (int, optional): Number of threads used to read labels and image sizes. Defaults to 4.
+        cache (bool, optional): Use the label and image metadata caches. Defaults to True.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage. Defaults to None.
+
+    Returns:
+        dict: statistics of the dataset
+    """  # noqa: E501
+
+    src_dir = Path(src_dir)
+    if not src_dir.exists():
+        raise ValueError(f"Source directory does not exist: {src_dir}")
+    if not src_dir.is_dir():
+        raise ValueError(f"Source is not a directory: {src_dir}")
+    if plot_dir is not None and not HAS_MATPLOTLIB:
+        raise ValueError("matplotlib is required to plot statistics")
+
+    profiler = profiler or StageProfiler()
+
+    with profiler.stage("read annotations") as stage:
+        ds = read_dataset(src_format, src_dir, workers, cache, skip_missing)
+        stage.items += len(ds)
+
+    # Image sizes are required for resolutions and box sizes of YOLO datasets
+    with profiler.stage("probe image sizes", items=len(ds)):
+        ds.fill_image_sizes(workers, cache)
+
+    with profiler.stage("compute stats", items=ds.num_boxes):
+        stats = dataset_stats(ds)
+
+    with open(output_path, "w") as f:
+        json.dump(stats, f, indent=2)
+
+    if plot_dir is not None:
+        with profiler.stage("plot stats"):
+            plot_stats(stats, plot_dir)
+
+    for name, section in [("all", stats["all"]), *stats["by_subset"].items()]:
+        print(
+            f"{name}: {section['num_images']} images, {section['num_boxes']} boxes, "
+            f"{section['num_polygons']} polygons, {section['num_tags']} tags"
+        )
+
+    return stats
+
+
+def main():
+    args = get_args()
+
+    profiler = StageProfiler() if args.profile is not None else None
+
+    compute_dataset_stats(
+        src_dir=args.src,
+        src_format=args.src_format,
+        output_path=args.output,
+        plot_dir=args.plots,
+        skip_missing=args.skip_missing,
+        workers=args.workers,
+        cache=not args.no_cache,
+        profiler=profiler,
+    )
+
+    if profiler is not None:
+        profiler.finish(args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+from math import comb
+
+import numpy as np
+from columnar_utils import ColumnarDataset
+from PIL import Image
+from utils.packed_utils import open_image
+
+# Scopes of the duplicates dropped: inside each subset, or also across subsets
+DUPLICATE_SCOPES = ("subset", "all")
+
+# Number of bits of a perceptual hash
+HASH_BITS = 64
+
+# Side of the grayscale thumbnail JPEG images are decoded to before hashing
+_DRAFT_SIZE = 64
+
+# Number of bits set in every byte, to count the bits of a hash
+_POPCOUNT = np.array([bin(b).count("1") for b in range(256)], dtype=np.uint8)
+
+
+def add_duplicate_args(parser: ArgumentParser):
+    """Add --hash-radius and --hash-batch-size arguments to a parser"""
+
+    parser.add_argument(
+        "--hash-radius",
+        type=int,
+        help="Images whose perceptual hashes differ by at most this many bits "
+        "are duplicates, 0 only matches the same picture",
+        default=4,
+    )
+    parser.add_argument(
+        "--hash-batch-size",
+        type=int,
+        help="Number of images hashed per worker task",
+        default=256,
+    )
+
+
+def dhash(img_path: str) -> int:
+    """Return the 64 bits difference hash of an image
+
+    The image is reduced to a 9x8 grayscale thumbnail and every bit tells if
+    a pixel is brighter than its right neighbour, so the hash survives
+    re-encoding, resizing and small color changes. JPEG images are decoded
+    at a reduced resolution.
+    """
+
+    with open_image(img_path) as img:
+        img.draft("L", (_DRAFT_SIZE, _DRAFT_SIZE))
+        pixels = np.asarray(
+            img.convert("L").resize((9, 8), Image.Resampling.BOX), dtype=np.int16
+        )
+
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def _hash_batch(img_paths: list[str]) -> list[int]:
+    """Hash a batch of images in a worker"""
+
+    return [dhash(img_path) for img_path in img_paths]
+
+
+def perceptual_hashes(
+    img_paths: list[str], workers: int = 4, batch_size: int = 256
+) -> np.ndarray:
+    """Return the difference hash of every image, computed by a pool of processes
+
+    Args:
+        img_paths (list[str]): paths of the images
+        workers (int, optional): number of processes. Defaults to 4.
+        batch_size (int, optional): number of images per worker task. Defaults to 256.
+
+    Returns:
+        np.ndarray: uint64 hash of every image
+    """
+
+    batches = [img_paths[i : i + batch_size] for i in range(0, len(img_paths), batch_size)]
+    hashes: list[int] = []
+    if workers <= 1:
+        for batch in batches:
+            hashes += _hash_batch(batch)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # bound the number of pending batches, results are kept in order
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.submit(_hash_batch, batch))
+                if len(pending) >= workers * 2:
+                    hashes += pending.popleft().result()
+            while pending:
+                hashes += pending.popleft().result()
+
+    return np.array(hashes, dtype=np.uint64)
+
+
+def hamming_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Return the number of different bits between the uint64 hashes a and b"""
+
+    xor = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64)
+    return _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+
+def _band_masks(num_hashes: int, radius: int) -> list[int]:
+    """Return the masks of the keys of a multi-index over hashes within radius
+
+    The 64 bits are cut into m bands. Two hashes within radius differ in at
+    most radius bands, so they have the same bits in at least one group of
+    m - radius bands: each group is a key, and any pair within radius shares
+    at least one key. More bands make longer keys with fewer false
+    candidates but more groups to index, m is chosen from the estimated cost
+    of both for num_hashes hashes.
+    """
+
+    best_cost, best_bands = None, radius + 1
+    for num_bands in range(radius + 1, HASH_BITS + 1):
+        key_bits = (num_bands - radius) * HASH_BITS // num_bands
+        num_keys = comb(num_bands, radius)
+        cost = num_keys * (num_hashes + num_hashes**2 / 2.0**key_bits)
+        if best_cost is None or cost < best_cost:
+            best_cost, best_bands = cost, num_bands
+
+    bounds = np.linspace(0, HASH_BITS, best_bands + 1).round().astype(int).tolist()
+    bands = [((1 << (end - start)) - 1) << start for start, end in zip(bounds, bounds[1:])]
+    return [sum(group) for group in combinations(bands, best_bands - radius)]
+
+
+def _equal_key_pairs(keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return every pair of different rows with the same key"""
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    same = sorted_keys[1:] == sorted_keys[:-1]
+    if not same.any():
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # keep the rows of runs of at least two equal keys
+    in_run = np.r_[same, False] | np.r_[False, same]
+    order = order[in_run]
+    run_ids = np.cumsum(np.r_[True, ~same])[in_run]
+
+    # pair every row with the rows d positions after it in its run
+    firsts, seconds = [], []
+    rows = np.arange(len(order))
+    d = 1
+    while len(rows):
+        rows = rows[rows + d < len(order)]
+        rows = rows[run_ids[rows] == run_ids[rows + d]]
+        firsts.append(order[rows])
+        seconds.append(order[rows + d])
+        d += 1
+
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def hamming_pairs(hashes: np.ndarray, radius: int) -> tuple[np.ndarray, np.ndarray]:
+    """Return every pair (i, j), i < j, of distinct hashes within radius bits
+
+    Pairs are found with a multi-index on groups of bands of the hashes
+    instead of comparing every pair, so the cost grows with the number of
+    hashes and of near pairs, see _band_masks.
+
+    Args:
+        hashes (np.ndarray): uint64 hashes, without repeated values
+        radius (int): maximum number of different bits
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: rows i and j of every pair
+    """
+
+    if radius < 0 or radius >= HASH_BITS:
+        raise ValueError(f"Invalid Hamming radius: {radius}")
+
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    if radius == 0 or len(hashes) < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    n = len(hashes)
+    pairs = [np.empty(0, dtype=np.int64)]
+    for mask in _band_masks(n, radius):
+        a, b = _equal_key_pairs(hashes & np.uint64(mask))
+        near = hamming_distances(hashes[a], hashes[b]) <= radius
+        pairs.append(np.minimum(a, b)[near] * n + np.maximum(a, b)[near])
+
+    # a pair sharing several keys is found once per key
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs // n, pairs % n
+
+
+def _connected_components(n: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Return the smallest node of the component of every node of the graph (a, b)"""
+
+    labels = np.arange(n, dtype=np.int64)
+    while True:
+        low = np.minimum(labels[a], labels[b])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, a, low)
+        np.minimum.at(new_labels, b, low)
+
+        # pointer jumping, every node points to the label of its label
+        while True:
+            jumped = new_labels[new_labels]
+            if np.array_equal(jumped, new_labels):
+                break
+            new_labels = jumped
+
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def duplicate_groups(hashes: np.ndarray, radius: int = 4) -> np.ndarray:
+    """Group the images whose hashes are within radius bits, transitively
+
+    Args:
+        hashes (np.ndarray): uint64 perceptual hash of every image
+        radius (int, optional): maximum number of different bits. Defaults to 4.
+
+    Returns:
+        np.ndarray: group of every image, the smallest row of its group
+    """
+
+    unique_hashes, inverse = np.unique(hashes, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    a, b = hamming_pairs(unique_hashes, radius)
+    hash_groups = _connected_components(len(unique_hashes), a, b)
+
+    # the group of a hash is named by the first image with a hash of the group
+    first_rows = np.full(len(unique_hashes), len(hashes), dtype=np.int64)
+    np.minimum.at(first_rows, hash_groups[inverse], np.arange(len(hashes)))
+    return first_rows[hash_groups[inverse]]
+
+
+def find_duplicates(
+    ds: ColumnarDataset,
+    radius: int = 4,
+    workers: int = 4,
+    batch_size: int = 256,
+) -> np.ndarray:
+    """Hash the images of a dataset and group its near duplicates
+
+    Works on the output of any reader, the images are read from their paths.
+
+    Args:
+        ds (ColumnarDataset): dataset
+        radius (int, optional): maximum number of different bits of the hashes of duplicates. Defaults to 4.
+        workers (int, optional): number of processes hashing images. Defaults to 4.
+        batch_size (int, optional): number of images per worker task. Defaults to 256.
+
+    Returns:
+        np.ndarray: group of every image, see duplicate_groups
+    """  # noqa: E501
+
+    hashes = perceptual_hashes(ds.image_paths(), workers, batch_size)
+    return duplicate_groups(hashes, radius)
+
+
+def duplicate_rows(
+    ds: ColumnarDataset,
+    groups: np.ndarray,
+    scope: str = "all",
+    keep_subsets: list[str] | None = None,
+) -> np.ndarray:
+    """Return the rows of the duplicates to drop, one image of each group is kept
+
+    Args:
+        ds (ColumnarDataset): dataset
+        groups (np.ndarray): group of every image, see duplicate_groups
+        scope (str, optional): "subset" drops duplicates inside each subset,
+            "all" also drops the copies of an image found in other subsets.
+            Defaults to "all".
+        keep_subsets (list[str] | None, optional): subsets whose copies are
+            kept first across subsets, such as evaluation subsets, other
+            subsets follow in dataset order. Defaults to None.
+
+    Returns:
+        np.ndarray: sorted rows of the images to drop
+    """
+
+    if scope not in DUPLICATE_SCOPES:
+        raise ValueError(f"Unsupported duplicate scope: {scope}")
+
+    keep_subsets = keep_subsets or []
+    for subset in keep_subsets:
+        if subset not in ds.subsets:
+            raise ValueError(f"Subset '{subset}' does not exist in dataset")
+
+    priority = [ds.subsets.index(subset) for subset in keep_subsets]
+    priority += [i for i in range(len(ds.subsets)) if i not in priority]
+    subset_ranks = np.argsort(priority)[ds.subset_ids]
+
+    # the first image of each key, in subset priority then row order, is kept
+    keys = groups if scope == "all" else groups * len(ds.subsets) + ds.subset_ids
+    order = np.lexsort((np.arange(len(ds)), subset_ranks, keys))
+    sorted_keys = keys[order]
+    is_copy = np.r_[False, sorted_keys[1:] == sorted_keys[:-1]]
+    return np.sort(order[is_copy])
+
+
+def duplicate_report(ds: ColumnarDataset, groups: np.ndarray) -> dict:
+    """Summarize the duplicates inside and across the subsets of a dataset
+
+    Returns:
+        dict: number of images and of duplicate groups, the images to drop
+            inside each subset, the groups shared by each pair of subsets,
+            and the file path and subset of the images of every group
+    """
+
+    rows_by_group: dict[int, list[int]] = {}
+    for i, group in enumerate(groups.tolist()):
+        rows_by_group.setdefault(group, []).append(i)
+    dup_groups = [rows for rows in rows_by_group.values() if len(rows) > 1]
+
+    subset_ids = ds.subset_ids.tolist()
+    within = dict.fromkeys(ds.subsets, 0)
+    across: dict[str, int] = {}
+    for rows in dup_groups:
+        group_subsets = sorted({subset_ids[i] for i in rows})
+        for subset_id in group_subsets:
+            within[ds.subsets[subset_id]] += sum(subset_ids[i] == subset_id for i in rows) - 1
+        for s1, s2 in combinations(group_subsets, 2):
+            key = f"{ds.subsets[s1]}/{ds.subsets[s2]}"
+            across[key] = across.get(key, 0) + 1
+
+    return {
+        "num_images": len(ds),
+        "num_groups": len(dup_groups),
+        "num_duplicates": sum(len(rows) - 1 for rows in dup_groups),
+        "within_subsets": within,
+        "across_subsets": across,
+        "groups": [
+            [{"file_path": ds.image_path(i), "subset": ds.subsets[subset_ids[i]]} for i in rows]
+            for rows in dup_groups
+        ],
+    }
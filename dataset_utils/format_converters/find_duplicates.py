@@ -0,0 +1,145 @@
+import os
+import sys
+
+# Get the current directory
+current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
+
+# Add the current directory to the search path
+sys.path.append(current_dir)
+
+
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+
+from convert import FORMATS, read_dataset
+from dedupe_utils import add_duplicate_args, duplicate_report, find_duplicates
+from utils.profile_utils import StageProfiler, add_profile_args
+
+StrPath = str | Path
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--from",
+        type=str,
+        dest="src_format",
+        choices=FORMATS,
+        help="Format of the dataset",
+        required=True,
+    )
+    parser.add_argument(
+        "--src",
+        type=str,
+        help="Path to the dataset directory",
+        required=True,
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="Write the duplicate groups and their images to this JSON file",
+        default=None,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes hashing images",
+        default=4,
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the label and image metadata caches",
+    )
+
+    add_duplicate_args(parser)
+    add_profile_args(parser)
+
+    return parser.parse_args()
+
+
+def find_dataset_duplicates(
+    src_dir: StrPath,
+    src_format: str,
+    radius: int = 4,
+    workers: int = 4,
+    batch_size: int = 256,
+    cache: bool = True,
+    report_path: StrPath | None = None,
+    profiler: StageProfiler | None = None,
+) -> dict:
+    """Find the near duplicate images of a dataset, inside and across its subsets
+
+    Images are hashed with a perceptual hash by a pool of processes, and
+    images whose hashes differ by at most radius bits are grouped, see
+    dedupe_utils.
+
+    Args:
+        src_dir (StrPath): directory of the dataset
+        src_format (str): format of the dataset, one of FORMATS
+        radius (int, optional): Maximum number of different bits of the hashes of duplicates. Defaults to 4.
+        workers (int, optional): Number of processes hashing images. Defaults to 4.
+        batch_size (int, optional): Number of images per worker task. Defaults to 256.
+        cache (bool, optional): Use the label and image metadata caches. Defaults to True.
+        report_path (StrPath | None, optional): Write the report to this JSON file. Defaults to None.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage. Defaults to None.
+
+    Returns:
+        dict: report of the duplicates, see dedupe_utils.duplicate_report
+    """  # noqa: E501
+
+    src_dir = Path(src_dir)
+    if not src_dir.exists():
+        raise ValueError(f"Source directory does not exist: {src_dir}")
+    if not src_dir.is_dir():
+        raise ValueError(f"Source is not a directory: {src_dir}")
+
+    profiler = profiler or StageProfiler()
+
+    with profiler.stage("read annotations") as stage:
+        ds = read_dataset(src_format, src_dir, workers, cache)
+        stage.items += len(ds)
+
+    with profiler.stage("hash images", items=len(ds)):
+        groups = find_duplicates(ds, radius, workers, batch_size)
+
+    report = duplicate_report(ds, groups)
+    print(
+        f"Found {report['num_duplicates']} duplicates in {report['num_groups']} groups "
+        f"among {report['num_images']} images"
+    )
+    for subset, num_duplicates in report["within_subsets"].items():
+        print(f"  {subset}: {num_duplicates} duplicates")
+    for subsets, num_groups in report["across_subsets"].items():
+        print(f"  {subsets}: {num_groups} images in both subsets")
+
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+
+def main():
+    args = get_args()
+
+    profiler = StageProfiler() if args.profile is not None else None
+
+    find_dataset_duplicates(
+        src_dir=args.src,
+        src_format=args.src_format,
+        radius=args.hash_radius,
+        workers=args.workers,
+        batch_size=args.hash_batch_size,
+        cache=not args.no_cache,
+        report_path=args.report,
+        profiler=profiler,
+    )
+
+    if profiler is not None:
+        profiler.finish(args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,15 +9,21 @@ sys.path.append(current_dir)
 
 
 import datetime as dt
-import shutil
 import xml.etree.ElementTree as ET
 from argparse import ArgumentParser
 from pathlib import Path
 
-import imagesize
-from imagenet_utils import read_imagenet
-from utils.bbox_utils import yolo2xyxy
-from yolo_utils import read_yolo_data_yaml, validate_dataset_folder
+from imagenet_utils import ImagenetReader
+from utils.manifest_utils import (
+    ImageDirLinks,
+    OutputManifest,
+    add_annotations_only_arg,
+    add_manifest_args,
+    prepare_output_dir,
+)
+from utils.packed_utils import check_no_packed_images
+from utils.profile_utils import StageProfiler, add_profile_args
+from utils.transfer_utils import add_transfer_args, open_file_transfer
 
 StrPath = str | Path
 
@@ -42,6 +48,11 @@ def get_args():
         help="Overwrite existing output directory",
     )
 
+    add_transfer_args(parser)
+    add_manifest_args(parser)
+    add_annotations_only_arg(parser)
+    add_profile_args(parser)
+
     return parser.parse_args()
 
 
@@ -49,6 +60,11 @@ def convert_imagenet_to_cvat(
     src_dir: StrPath,
     output_dir: StrPath,
     force: bool = False,
+    incremental: bool = False,
+    transfer: str = "copy",
+    workers: int = 4,
+    annotations_only: bool = False,
+    profiler: StageProfiler | None = None,
 ):
     """Convert dataset from ImageNet format to CVAT for images format
 
@@ -56,6 +72,11 @@ def convert_imagenet_to_cvat(
         src_dir (StrPath): directory of the ImageNet dataset
         output_dir (StrPath): directory of the output dataset
         force (bool, optional): Overwrite existing output directory. Defaults to False.
+        incremental (bool, optional): Update an output directory written by a previous run, only files whose source changed are rewritten. Defaults to False.
+        transfer (str, optional): How images are transferred, one of "copy", "hardlink", "reflink", "symlink" and "pack". Defaults to "copy".
+        workers (int, optional): Number of threads used to read and transfer images. Defaults to 4.
+        annotations_only (bool, optional): Write only annotations.xml, images are referenced through one symlink per class directory inside the subset image directories. Defaults to False.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage of the conversion. Defaults to None.
     """  # noqa: E501
 
     src_dir = Path(src_dir)
@@ -63,20 +84,20 @@ def convert_imagenet_to_cvat(
         raise ValueError(f"Source directory does not exist: {src_dir}")
     if not src_dir.is_dir():
         raise ValueError(f"Source is not a directory: {src_dir}")
+    if annotations_only:
+        # packed images cannot be referenced through links to their directories
+        check_no_packed_images(src_dir, "referenced with --annotations-only")
 
     output_dir = Path(output_dir)
-    if not force:
-        if output_dir.exists():
-            raise ValueError("Output directory already exists")
-    else:
-        print("Output directory already exists. Removing existing output directory")
-        shutil.rmtree(str(output_dir), ignore_errors=True)
-        print("Creating new output directory")
+    prepare_output_dir(output_dir, force, incremental)
+    profiler = profiler or StageProfiler()
 
-    imnet_data = read_imagenet(src_dir)
+    # Only the classes and subsets are read here, images are streamed per subset
+    with profiler.stage("scan classes"):
+        reader = ImagenetReader(src_dir, workers=workers)
 
     # Create output directory
-    output_dir.mkdir(parents=True, exist_ok=not force)
+    output_dir.mkdir(parents=True, exist_ok=True)
 
     # Write result to xml file
     annotation_xml_path = output_dir / "annotations.xml"
@@ -92,7 +113,7 @@ def convert_imagenet_to_cvat(
 
     # add labels to project
     labels_el = ET.SubElement(meta_project_el, "labels")
-    for name in imnet_data["names"]:
+    for name in reader.names:
         label_el = ET.SubElement(labels_el, "label")
         name_el = ET.SubElement(label_el, "name")
         name_el.text = name
@@ -104,57 +125,89 @@ def convert_imagenet_to_cvat(
         ET.SubElement(label_el, "attributes")
 
     subsets_el = ET.SubElement(meta_project_el, "subsets")
-    subsets_el.text = "\n".join(imnet_data["subsets"])
+    subsets_el.text = "\n".join(reader.subsets)
 
     dumped_meta_el = ET.SubElement(meta_el, "dumped")
     dumped_meta_el.text = dt.datetime.today().strftime("%Y-%m-%d %H:%M:%S.%f%z")
 
-    # Start to process data and prepare to write to yaml file
-    for subset in imnet_data["subsets"]:
-        data: list[dict] = imnet_data[subset]
-
-        # Create subset image output directory
-        subset_subset_imgs_out_dir = output_dir / "images" / subset
-        subset_subset_imgs_out_dir.mkdir(parents=True, exist_ok=True)
-
-        for img_data in data:
-            image_path = img_data["file_path"]
-            label = img_data["label"]
-
-            # Copy image to output subset dir
-            output_img_path = subset_subset_imgs_out_dir / Path(image_path).name
-            # print(image_path, Path(image_path).exists(), output_img_path)
-            shutil.copyfile(image_path, output_img_path)
-
-            # Set image element's attributes
-            # imw, imh = imagesize.get(str(image_path))
-            imw, imh = img_data["width"], img_data["height"]
-            image_el = ET.SubElement(root, "image")
-            image_el.set("id", str(img_data["id"]))
-            image_el.set("name", Path(image_path).name)
-            image_el.set("subset", subset)
-            image_el.set("width", str(imw))
-            image_el.set("height", str(imh))
-
-            tag_el = ET.SubElement(image_el, "tag")
-            tag_el.set("label", label)
-            tag_el.set("source", "manual")
+    # Only the images which changed since the previous run are copied
+    manifest = OutputManifest(output_dir)
+
+    with (
+        profiler.stage("transfer images") as transfer_stage,
+        open_file_transfer(transfer, workers, output_dir) as file_transfer,
+    ):
+        image_id = 0
+
+        # Start to process data and prepare to write to yaml file
+        for subset in reader.subsets:
+            # Create subset image output directory
+            subset_subset_imgs_out_dir = output_dir / "images" / subset
+            subset_subset_imgs_out_dir.mkdir(parents=True, exist_ok=True)
+
+            # Reference images through the links to their class directories
+            links = ImageDirLinks(subset_subset_imgs_out_dir, manifest)
+
+            # Images are listed and their sizes probed while they are written
+            with profiler.stage("build annotations") as stage:
+                for img in reader.iter_images(subset, sizes=True):
+                    if annotations_only:
+                        image_name = f"{links.link(img.dir_path)}/{img.file_name}"
+                    else:
+                        # Copy image to output subset dir
+                        image_name = img.file_name
+                        output_img_path = subset_subset_imgs_out_dir / image_name
+                        manifest.transfer(file_transfer, img.path, output_img_path)
+
+                    # Set image element's attributes
+                    image_el = ET.SubElement(root, "image")
+                    image_el.set("id", str(image_id))
+                    image_el.set("name", image_name)
+                    image_el.set("subset", subset)
+                    image_el.set("width", str(img.width))
+                    image_el.set("height", str(img.height))
+
+                    tag_el = ET.SubElement(image_el, "tag")
+                    tag_el.set("label", reader.names[img.class_id])
+                    tag_el.set("source", "manual")
+
+                    image_id += 1
+                    stage.items += 1
+
+    transfer_stage.items += file_transfer.num_files
+    transfer_stage.bytes += file_transfer.num_bytes
 
     # This is not beaultifuly indented
-    tree = ET.ElementTree(root)
-    ET.indent(tree)
-    tree.write(str(annotation_xml_path), encoding="utf-8", xml_declaration=True)
+    with profiler.stage("write annotations") as stage:
+        tree = ET.ElementTree(root)
+        ET.indent(tree)
+        tree.write(str(annotation_xml_path), encoding="utf-8", xml_declaration=True)
+        manifest.add(annotation_xml_path)
+    stage.bytes += annotation_xml_path.stat().st_size
+
+    with profiler.stage("finish manifest"):
+        manifest.finish()
 
 
 def main():
     args = get_args()
 
+    profiler = StageProfiler() if args.profile is not None else None
+
     convert_imagenet_to_cvat(
         src_dir=args.src,
         output_dir=args.output,
         force=args.force,
+        incremental=args.incremental,
+        transfer=args.transfer,
+        workers=args.workers,
+        annotations_only=args.annotations_only,
+        profiler=profiler,
     )
 
+    if profiler is not None:
+        profiler.finish(args.profile)
+
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,19 @@
+import os
+from dataclasses import dataclass
 from pathlib import Path
 from pprint import pprint
+from typing import Iterator
 
-import imagesize
+import numpy as np
 import yaml
+from columnar_utils import ColumnarBuilder, ColumnarDataset
+from crop_utils import crop_dataset
+from utils.image_meta_utils import ImageMetaCache, get_image_metas
+from utils.manifest_utils import MANIFEST_FILE, OutputManifest
+from utils.packed_utils import PACK_FILES, open_packed_images
+from utils.transfer_utils import FileTransfer
+
+StrPath = str | Path
 
 
 def read_data_yaml(path: Path) -> dict:
@@ -52,111 +63,285 @@ def read_data_yaml(path: Path) -> dict:
     return data
 
 
-def read_imagenet(dataset_dir: Path) -> dict:
-    """Read data inside imagenet folder and return a dictionary
-
-    Args:
-        dataset_dir (Path): path to imagenet folder
-
-    Returns:
-        dict: data inside imagenet folder
-
-        {
-            "nc": <number of classes>,
-            "names": <list of class names>,
-            "<subset>: [
-                {
-                    "file_path": <file_path>,
-                    "filename": <filename>,
-                    "width": <width>,
-                    "height": <height>,
-                    "label": <label>,
-                    "id": <id>,
-                },
-                ...
-            ],
-        }
-    """
+@dataclass
+class ImagenetImage:
+    """Image of an imagenet folder, its size is -1 until it is probed"""
 
-    result = {}
+    file_name: str
+    dir_path: str
+    subset: str
+    class_id: int
+    width: int = -1
+    height: int = -1
 
-    if not dataset_dir.exists():
-        raise ValueError(f"Dataset directory does not exist: {dataset_dir}")
+    @property
+    def path(self) -> str:
+        return os.path.join(self.dir_path, self.file_name)
 
-    if not dataset_dir.is_dir():
-        raise ValueError(f"Dataset is not a directory: {dataset_dir}")
 
-    class_names: list | None = None
-    subsets = set()
+class ImagenetReader:
+    """Read an imagenet folder lazily
 
-    # read data.yaml file if exist
-    data_yaml_path = dataset_dir / "data.yaml"
-    if data_yaml_path.exists():
-        data_yaml = read_data_yaml(data_yaml_path)
-        pprint(data_yaml)
+    Class names and subsets are known as soon as the reader is created, only
+    data.yaml and the subset and class directories are read. Images are
+    listed by iter_images while they are consumed, and their sizes are only
+    probed when asked for, in batches through the metadata cache, so a huge
+    folder starts streaming at once and is never held in memory.
 
-        class_names = data_yaml["names"]
-        subsets = set(data_yaml.keys())
-        subsets.remove("names")
-        subsets.remove("nc")
+    Images can be stored in a packed image store at the root of the folder
+    (see utils.packed_utils) instead of in the class directories, their sizes
+    are then read from its index. Their image paths are not files, they are
+    read from the store through utils.packed_utils.find_packed_image.
 
-    pprint(class_names)
-    pprint(subsets)
+    Example:
+        reader = ImagenetReader(dataset_dir)
+        print(reader.names, reader.subsets)
+        for img in reader.iter_images("train", sizes=True):
+            print(img.path, img.width, img.height)
+    """
 
-    # List all directories inside dataset_dir, which is subsets
-    for subset in dataset_dir.iterdir():
-        if not subset.is_dir():
-            if subset.name not in ["data.yaml", "data.yml"]:
-                raise ValueError(f"Dataset is not a directory: {subset}")
+    def __init__(self, dataset_dir: StrPath, workers: int = 8, cache: bool = True):
+        """
+        Args:
+            dataset_dir (StrPath): path to imagenet folder
+            workers (int, optional): number of threads reading image sizes. Defaults to 8.
+            cache (bool, optional): use the image metadata cache. Defaults to True.
+        """
+
+        dataset_dir = Path(dataset_dir)
+        if not dataset_dir.exists():
+            raise ValueError(f"Dataset directory does not exist: {dataset_dir}")
+
+        if not dataset_dir.is_dir():
+            raise ValueError(f"Dataset is not a directory: {dataset_dir}")
+
+        self.dataset_dir = dataset_dir
+        self.workers = workers
+        self.cache = cache
+
+        class_names: list | None = None
+        subsets = set()
+
+        # read data.yaml file if exist
+        data_yaml_path = dataset_dir / "data.yaml"
+        if data_yaml_path.exists():
+            data_yaml = read_data_yaml(data_yaml_path)
+            pprint(data_yaml)
+
+            class_names = data_yaml["names"]
+            subsets = set(data_yaml.keys())
+            subsets.remove("names")
+            subsets.remove("nc")
+
+        pprint(class_names)
+        pprint(subsets)
+
+        # Class directories of every subset, their images are listed by iter_images
+        self._class_dirs: dict[str, list[Path]] = {}
+
+        # List all directories inside dataset_dir, which is subsets
+        for subset in dataset_dir.iterdir():
+            if not subset.is_dir():
+                if subset.name not in ["data.yaml", "data.yml", MANIFEST_FILE, *PACK_FILES]:
+                    raise ValueError(f"Dataset is not a directory: {subset}")
+                else:
+                    # skip data.yaml and manifest files
+                    continue
+
+            subsets.add(subset.name)
+
+            label_dirs = []
+            for label in subset.iterdir():
+                if not label.is_dir():
+                    raise ValueError(f"Dataset is not a directory: {label}")
+
+                label_dirs.append(label)
+
+            _names = [label.name for label in label_dirs]
+            if class_names is None:
+                class_names = _names
             else:
-                # skip data.yaml file
-                continue
-
-        subsets.add(subset.name)
-
-        _names = list()
-        for label in subset.iterdir():
-            if not label.is_dir():
-                raise ValueError(f"Dataset is not a directory: {label}")
+                # if class_names is not none, check if names of each directory are the same
+                if set(class_names).difference(set(_names)):
+                    raise ValueError(f"Class names are not the same: {class_names} != {_names}")
+
+            self._class_dirs[subset.name] = label_dirs
+
+        self.names: list[str] = list(class_names or [])
+        self.subsets: list[str] = sorted(subsets)
+        self.name2id = {name: i for i, name in enumerate(self.names)}
+
+        for label_dirs in self._class_dirs.values():
+            for label_dir in label_dirs:
+                if label_dir.name not in self.name2id:
+                    raise ValueError(f"Class name is not in data.yaml: {label_dir.name}")
+
+    def iter_images(
+        self,
+        subset: str | None = None,
+        sizes: bool = False,
+        batch_size: int = 4096,
+    ) -> Iterator[ImagenetImage]:
+        """Yield the images of a subset, or of every subset, while their directories are listed
+
+        Args:
+            subset (str | None, optional): subset of the images, all subsets in
+                the order of self.subsets if None. Defaults to None.
+            sizes (bool, optional): probe the width and height of the images,
+                batch_size images at a time. Defaults to False.
+            batch_size (int, optional): number of images listed and probed
+                before they are yielded. Defaults to 4096.
+        """
+
+        if subset is not None and subset not in self.subsets:
+            raise ValueError(f"Subset is not in the dataset: {subset}")
+        subsets = self.subsets if subset is None else [subset]
+
+        packed = open_packed_images(self.dataset_dir)
+
+        # One metadata cache is used for all the batches
+        meta_cache = ImageMetaCache(verbose=False) if sizes and self.cache else None
+
+        def probe(batch: list[ImagenetImage]) -> list[ImagenetImage]:
+            if sizes:
+                # Sizes of packed images are already read from the index of the store
+                todo = [img for img in batch if img.width < 0]
+                paths = [img.path for img in todo]
+                if meta_cache is not None:
+                    metas = meta_cache.get(paths, self.workers)
+                else:
+                    metas = get_image_metas(paths, self.workers, cache=False)
+                for img, meta in zip(todo, metas):
+                    img.width, img.height = meta.width, meta.height
+            return batch
+
+        try:
+            batch: list[ImagenetImage] = []
+            for subset in subsets:
+                for label_dir in self._class_dirs.get(subset, []):
+                    class_id = self.name2id[label_dir.name]
+                    dir_path = label_dir.as_posix()
+
+                    with os.scandir(label_dir) as entries:
+                        for entry in entries:
+                            if not entry.is_file():
+                                raise ValueError(f"Dataset is not a file: {entry.path}")
+
+                            batch.append(ImagenetImage(entry.name, dir_path, subset, class_id))
+                            if len(batch) >= batch_size:
+                                yield from probe(batch)
+                                batch = []
+
+                    # Packed images of the class, their keys are <subset>/<class>/<file name>
+                    if packed is not None:
+                        for file_name in packed.list_dir(f"{subset}/{label_dir.name}"):
+                            row = packed.find(f"{subset}/{label_dir.name}/{file_name}")
+                            batch.append(
+                                ImagenetImage(
+                                    file_name,
+                                    dir_path,
+                                    subset,
+                                    class_id,
+                                    int(packed.widths[row]),
+                                    int(packed.heights[row]),
+                                )
+                            )
+
+            yield from probe(batch)
+        finally:
+            if meta_cache is not None:
+                if meta_cache.num_hits + meta_cache.num_misses:
+                    print(
+                        f"Image metadata: {meta_cache.num_hits} cached, "
+                        f"{meta_cache.num_misses} probed"
+                    )
+                meta_cache.close()
+            if packed is not None:
+                packed.close()
+
+    def read(self) -> ColumnarDataset:
+        """Read every image with its size into a ColumnarDataset
+
+        Returns:
+            ColumnarDataset: images of all subsets without boxes, the class of
+                each image is stored as its only tag
+        """
+
+        result = ColumnarBuilder(names=self.names, subsets=self.subsets)
+        for img in self.iter_images(sizes=True):
+            result.add_image(
+                file_name=img.file_name,
+                dir_path=img.dir_path,
+                subset=img.subset,
+                width=img.width,
+                height=img.height,
+                tags=(img.class_id,),
+            )
+        return result.build()
+
+
+def read_imagenet(
+    dataset_dir: Path,
+    workers: int = 8,
+    cache: bool = True,
+) -> ColumnarDataset:
+    """Read data inside imagenet folder and return a ColumnarDataset
+
+    The whole folder is read with sizes, see ImagenetReader to stream its
+    images instead.
 
-            _names.append(label.name)
+    Args:
+        dataset_dir (Path): path to imagenet folder
+        workers (int, optional): number of threads reading image sizes. Defaults to 8.
+        cache (bool, optional): use the image metadata cache. Defaults to True.
 
-        if class_names is None:
-            class_names = _names
-        else:
-            # if class_names is not none, check if names of each directory are the same
-            if set(class_names).difference(set(_names)):
-                raise ValueError(f"Class names are not the same: {class_names} != {_names}")
+    Returns:
+        ColumnarDataset: images of all subsets without boxes, the class of
+            each image is stored as its only tag
+    """
 
-        idx = 0
-        imgs = []
+    return ImagenetReader(dataset_dir, workers, cache).read()
 
-        # Start to read all images inside each subset/label folder
-        for label_dir in subset.iterdir():
-            img_paths = label_dir.iterdir()
 
-            for img_path in img_paths:
-                if not img_path.is_file():
-                    raise ValueError(f"Dataset is not a file: {img_path}")
+def write_imagenet_dataset(
+    ds: ColumnarDataset,
+    output_dir: StrPath,
+    file_transfer: FileTransfer,
+    manifest: OutputManifest,
+    crop: bool = True,
+    workers: int = 4,
+    max_size: int | None = None,
+):
+    """Write a dataset in ImageNet format, <output_dir>/<subset>/<class name>/<image>
 
-                width, height = imagesize.get(img_path.as_posix())
+    Args:
+        ds (ColumnarDataset): dataset to write, image sizes are required to
+            crop "yolo" boxes
+        output_dir (StrPath): directory of the output dataset
+        file_transfer (FileTransfer): transfer of the images
+        manifest (OutputManifest): manifest of the output directory, only
+            the files which changed are written
+        crop (bool, optional): save every box as a crop, see crop_utils.crop_dataset.
+            Otherwise whole images are transferred to the directory of every
+            class they are annotated with (boxes, polygons and tags). Defaults to True.
+        workers (int, optional): number of processes cropping images. Defaults to 4.
+        max_size (int | None, optional): maximum size of the longest side of
+            the crops. Defaults to None.
+    """
 
-                imgs.append(
-                    {
-                        "file_path": img_path.as_posix(),
-                        "filename": img_path.name,
-                        "height": height,
-                        "width": width,
-                        "label": label_dir.name,
-                        "id": idx,
-                    }
-                )
-                idx += 1
+    output_dir = Path(output_dir)
 
-        result[subset.name] = imgs
+    if crop:
+        crop_dataset(ds, output_dir, workers=workers, max_size=max_size, manifest=manifest)
+        return
 
-    result["names"] = list(class_names or set())
-    result["nc"] = len(result["names"])
-    result["subsets"] = subsets
+    created_dirs: set[Path] = set()
+    for i in range(len(ds)):
+        subset_dir = output_dir / ds.subsets[ds.subset_ids[i]]
+        for cls_id in np.unique(ds.image_classes(i)).tolist():
+            label_dir = subset_dir / ds.names[cls_id]
+            if label_dir not in created_dirs:
+                label_dir.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(label_dir)
 
-    return result
+            manifest.transfer(file_transfer, ds.image_path(i), label_dir / ds.file_names[i])
@@ -1,8 +1,6 @@
 import os
 import sys
 
-from matplotlib import path
-
 # Get the current directory
 current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
 
@@ -10,14 +8,14 @@ current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
 sys.path.append(current_dir)
 
 
-import random
-import shutil
 from argparse import ArgumentParser
 from pathlib import Path
 
 import yaml
-from cvat_utils import read_cvat_annotation_xml
-from utils.bbox_utils import xywh2yolo
+from utils.manifest_utils import OutputManifest, add_manifest_args, prepare_output_dir
+from utils.profile_utils import StageProfiler, add_profile_args
+from utils.split_utils import add_split_args, hash_fractions, split_ids
+from utils.transfer_utils import add_transfer_args, open_file_transfer
 
 StrPath = str | Path
 
@@ -51,6 +49,11 @@ def get_args():
         default=[],
     )
 
+    add_split_args(parser, stratify=False)
+    add_transfer_args(parser)
+    add_manifest_args(parser)
+    add_profile_args(parser)
+
     return parser.parse_args()
 
 
@@ -58,7 +61,12 @@ def convert_images_dir_to_yolo_ultralytics(
     src_dir: StrPath,
     output_dir: StrPath,
     force: bool = False,
+    incremental: bool = False,
     split_ratio: dict[str, float] | None = None,
+    split_seed: int = 0,
+    transfer: str = "copy",
+    workers: int = 4,
+    profiler: StageProfiler | None = None,
 ):
     """Convert images dir to YOLO Ultralytics format
 
@@ -69,7 +77,12 @@ def convert_images_dir_to_yolo_ultralytics(
         src_dir (StrPath): directory of the CVAT dataset
         output_dir (StrPath): directory of the output YOLO Ultralytics dataset
         force (bool, optional): Overwrite existing output directory. Defaults to False.
+        incremental (bool, optional): Update an output directory written by a previous run, only files whose source changed are rewritten. Defaults to False.
         split_ratio (dict[str, float], optional): Split dataset into subsets and specify the ratio of each subset. Defaults to None.
+        split_seed (int, optional): Seed of the split, the subset of an image is drawn from a hash of its file name and the seed. Defaults to 0.
+        transfer (str, optional): How images are transferred, one of "copy", "hardlink", "reflink", "symlink" and "pack". Defaults to "copy".
+        workers (int, optional): Number of threads used to transfer images. Defaults to 4.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage of the conversion. Defaults to None.
     """  # noqa: E501
 
     src_dir = Path(src_dir)
@@ -79,16 +92,13 @@ def convert_images_dir_to_yolo_ultralytics(
         raise ValueError(f"Source is not a directory: {src_dir}")
 
     output_dir = Path(output_dir)
-    if not force:
-        if output_dir.exists():
-            raise ValueError("Output directory already exists")
-    else:
-        print("Output directory already exists. Removing existing output directory")
-        shutil.rmtree(str(output_dir), ignore_errors=True)
-        print("Creating new output directory")
+    prepare_output_dir(output_dir, force, incremental)
+    profiler = profiler or StageProfiler()
 
     # List all images
-    src_imgs = [f for f in src_dir.iterdir() if f.is_file()]
+    with profiler.stage("scan images") as stage:
+        src_imgs = [f for f in src_dir.iterdir() if f.is_file()]
+        stage.items += len(src_imgs)
     all_images = {}
     for idx, path in enumerate(src_imgs):
         all_images[str(idx)] = {
@@ -100,47 +110,52 @@ def convert_images_dir_to_yolo_ultralytics(
     # Create images and annotations folder
     out_imgs_dir = output_dir / "images"
     out_annots_dir = output_dir / "labels"
-    out_imgs_dir.mkdir(parents=True, exist_ok=False)
-    out_annots_dir.mkdir(parents=True, exist_ok=False)
+    out_imgs_dir.mkdir(parents=True, exist_ok=True)
+    out_annots_dir.mkdir(parents=True, exist_ok=True)
 
     if split_ratio:
-        keys = list(all_images.keys())
-
-        # make a list of position to split
-        split_pos = []
-
-        for subset, ratio in split_ratio.items():
-            split_size = round(len(all_images) * ratio)
-            split_pos.extend([subset] * split_size)
-
-        # shuffle the list
-        random.shuffle(split_pos)
-        for key in keys:
-            all_images[key]["subset"] = split_pos.pop()
+        # the subset of an image only depends on its file name and the seed
+        split_subsets = list(split_ratio.keys())
+        fractions = hash_fractions([data["file_name"] for data in all_images.values()], split_seed)
+        for data, subset_id in zip(
+            all_images.values(), split_ids(fractions, split_ratio.values()).tolist()
+        ):
+            data["subset"] = split_subsets[subset_id]
 
     subsets = {"train": 1.0}
     if split_ratio:
         subsets = set(split_ratio.keys())
 
-    # Copy images and write annotations to file
-    for img_id, data in all_images.items():
-        new_subset = data.get("subset", "train")
-
-        # Make subdir for each subset
-        subset_img_dst_dir = out_imgs_dir / new_subset
-        subset_annot_dst_dir = out_annots_dir / new_subset
-
-        subset_img_dst_dir.mkdir(parents=True, exist_ok=True)
-        subset_annot_dst_dir.mkdir(parents=True, exist_ok=True)
-
-        # Write annotations for each image
-        # Copy image
-        src_img_path = Path(data["img_path"])
-        shutil.copy(str(src_img_path), str(subset_img_dst_dir / data["file_name"]))
-
-        # Write annotations to txt file
-        output_txt_file = (subset_annot_dst_dir / data["file_name"]).with_suffix(".txt")
-        output_txt_file.touch()
+    # Only the images which changed since the previous run are copied
+    manifest = OutputManifest(output_dir)
+
+    with (
+        profiler.stage("transfer images") as stage,
+        open_file_transfer(transfer, workers, output_dir) as file_transfer,
+    ):
+        # Copy images and write annotations to file
+        for img_id, data in all_images.items():
+            new_subset = data.get("subset", "train")
+
+            # Make subdir for each subset
+            subset_img_dst_dir = out_imgs_dir / new_subset
+            subset_annot_dst_dir = out_annots_dir / new_subset
+
+            subset_img_dst_dir.mkdir(parents=True, exist_ok=True)
+            subset_annot_dst_dir.mkdir(parents=True, exist_ok=True)
+
+            # Write annotations for each image
+            # Copy image
+            src_img_path = Path(data["img_path"])
+            manifest.transfer(
+                file_transfer, src_img_path, subset_img_dst_dir / data["file_name"]
+            )
+
+            # Write annotations to txt file
+            output_txt_file = (subset_annot_dst_dir / data["file_name"]).with_suffix(".txt")
+            manifest.write_text(output_txt_file, "")
+    stage.items += file_transfer.num_files
+    stage.bytes += file_transfer.num_bytes
 
     # Create data.yaml file
     data_yml = {}
@@ -160,6 +175,10 @@ def convert_images_dir_to_yolo_ultralytics(
 
     with open(output_dir / "data.yaml", "w") as f:
         yaml.dump(data_yml, f, sort_keys=False)
+    manifest.add(output_dir / "data.yaml")
+
+    with profiler.stage("finish manifest"):
+        manifest.finish()
 
 
 def main():
@@ -175,13 +194,23 @@ def main():
     if split_ratio and (1 - sum(split_ratio.values())) > FAULT_TOLERANCE:
         raise ValueError("Sum of split ratios should be 1.0")
 
+    profiler = StageProfiler() if args.profile is not None else None
+
     convert_images_dir_to_yolo_ultralytics(
         src_dir=args.src,
         output_dir=args.output,
         force=args.force,
+        incremental=args.incremental,
         split_ratio=split_ratio,
+        split_seed=args.split_seed,
+        transfer=args.transfer,
+        workers=args.workers,
+        profiler=profiler,
     )
 
+    if profiler is not None:
+        profiler.finish(args.profile)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,266 @@
+import io
+import json
+import os
+import tarfile
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+import numpy as np
+from columnar_utils import ColumnarDataset
+from utils.manifest_utils import OutputManifest
+from utils.packed_utils import find_packed_image, open_image_file
+
+StrPath = str | Path
+
+# Name of the index file written at the root of a sharded dataset
+SHARD_INDEX_FILE = "shards.json"
+
+# Version of the index format
+SHARD_INDEX_VERSION = 1
+
+# Size of a tar block, every member is a header block followed by its data
+# padded to whole blocks
+_TAR_BLOCK = 512
+
+# Buffer size used to read shards sequentially
+_READ_BUFFER_SIZE = 1 << 20
+
+
+def add_shard_writer_args(parser: ArgumentParser):
+    """Add the --shard-size argument to a converter parser"""
+
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        help="Shards output only, maximum size of a shard in MB, an image larger "
+        "than this gets a shard of its own",
+        default=1024,
+    )
+
+
+@dataclass
+class ShardSample:
+    """Sample of a sharded dataset: an encoded image and its annotation"""
+
+    key: str
+    image_name: str
+    image: bytes
+    annotation: dict
+
+
+def _tar_member_size(size: int) -> int:
+    return _TAR_BLOCK + -(-size // _TAR_BLOCK) * _TAR_BLOCK
+
+
+def _image_annotation(ds: ColumnarDataset, i: int, subset: str, boxes: list) -> dict:
+    start, end = ds.box_offsets[i], ds.box_offsets[i + 1]
+    return {
+        "file_name": ds.file_names[i],
+        "subset": subset,
+        "image_id": int(ds.image_ids[i]),
+        "width": int(ds.widths[i]),
+        "height": int(ds.heights[i]),
+        "boxes": boxes[start:end],
+        "box_classes": ds.box_classes[start:end].tolist(),
+        "tags": ds.image_tags(i).tolist(),
+        "polygons": [
+            {"class": cls_id, "points": points.tolist()}
+            for cls_id, points in ds.image_polygons(i)
+        ],
+    }
+
+
+def _write_shard(path: Path, samples: list[tuple[str, str, bytes]]):
+    """Write the samples (key, image path, annotation json) to the tar file path, atomically"""
+
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tarfile.open(tmp_path, "w", format=tarfile.USTAR_FORMAT) as tar:
+        for key, img_path, annotation in samples:
+            # members have no owner and no date, so a shard only depends on its samples
+            with open_image_file(img_path) as f:
+                info = tarfile.TarInfo(key + os.path.splitext(img_path)[1].lower())
+                info.size = f.seek(0, os.SEEK_END)
+                f.seek(0)
+                info.mode = 0o644
+                tar.addfile(info, f)
+
+            info = tarfile.TarInfo(key + ".json")
+            info.size = len(annotation)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(annotation))
+    os.replace(tmp_path, path)
+
+
+def write_shard_dataset(
+    ds: ColumnarDataset,
+    output_dir: StrPath,
+    manifest: OutputManifest,
+    shard_size: int = 1 << 30,
+    workers: int = 4,
+):
+    """Write a dataset as tar shards, in the layout of WebDataset
+
+    The images of each subset are packed in order into
+    <output_dir>/<subset>/<subset>-<number>.tar, each shard is at most
+    shard_size bytes unless it holds a single larger image. Sample k of a
+    subset is the tar members <k>.<image extension> with the encoded image
+    and <k>.json with its annotation: file name, size, boxes in "xyxy" format
+    with their class ids, tags and polygons. <output_dir>/shards.json lists
+    the class names and the shards of each subset with their number of
+    samples.
+
+    Shards are written concurrently by `workers` threads. Shards are recorded
+    in the manifest with the fingerprints of their images and their
+    annotations, so an incremental run only rewrites the shards which changed.
+
+    Args:
+        ds (ColumnarDataset): dataset to write, image sizes are required
+            unless boxes are in "xyxy" or "xywh" format
+        output_dir (StrPath): directory of the output dataset
+        manifest (OutputManifest): manifest of the output directory
+        shard_size (int, optional): maximum size of a shard in bytes. Defaults to 1 GB.
+        workers (int, optional): number of threads writing shards. Defaults to 4.
+    """
+
+    output_dir = Path(output_dir)
+    boxes = ds.boxes_as("xyxy").tolist()
+
+    index = {
+        "version": SHARD_INDEX_VERSION,
+        "names": list(ds.names),
+        "box_format": "xyxy",
+        "subsets": {},
+    }
+    tasks: list[tuple[Path, list[tuple[str, str, bytes]]]] = []
+    for subset_id, subset in enumerate(ds.subsets):
+        rows = np.flatnonzero(ds.subset_ids == subset_id).tolist()
+        if len(rows) == 0:
+            continue
+
+        subset_dir = output_dir / subset
+        subset_dir.mkdir(parents=True, exist_ok=True)
+
+        # Cut the subset into shards from the sizes of the images
+        shards: list[list[tuple[str, str, bytes]]] = [[]]
+        fingerprints: list[list[str]] = [[]]
+        size = 0
+        for k, i in enumerate(rows):
+            img_path = ds.image_path(i)
+            try:
+                st = os.stat(img_path)
+                img_size, fingerprint = st.st_size, f"{st.st_size}:{st.st_mtime_ns}"
+            except FileNotFoundError:
+                found = find_packed_image(img_path)
+                if found is None:
+                    raise
+                store, row = found
+                img_size, fingerprint = len(store.get_bytes(row)), store.fingerprint(row)
+            annotation = json.dumps(
+                _image_annotation(ds, i, subset, boxes), separators=(",", ":")
+            ).encode("utf-8")
+
+            sample_size = _tar_member_size(img_size) + _tar_member_size(len(annotation))
+            if shards[-1] and size + sample_size > shard_size:
+                shards.append([])
+                fingerprints.append([])
+                size = 0
+
+            shards[-1].append((f"{k:09d}", img_path, annotation))
+            fingerprints[-1].append(f"{img_path}:{fingerprint}")
+            size += sample_size
+
+        entries = index["subsets"][subset] = []
+        for n, (samples, shard_fingerprints) in enumerate(zip(shards, fingerprints)):
+            shard_path = subset_dir / f"{subset}-{n:06d}.tar"
+            if not manifest.is_current(
+                shard_path, *shard_fingerprints, *(annotation for _, _, annotation in samples)
+            ):
+                tasks.append((shard_path, samples))
+            entries.append({"name": f"{subset}/{shard_path.name}", "num_samples": len(samples)})
+
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        for _ in executor.map(lambda task: _write_shard(*task), tasks):
+            pass
+
+    for entries in index["subsets"].values():
+        for entry in entries:
+            entry["size"] = os.path.getsize(output_dir / entry["name"])
+
+    manifest.write_text(output_dir / SHARD_INDEX_FILE, json.dumps(index, indent=2))
+
+
+def read_shard_index(shards_dir: StrPath) -> dict:
+    """Read the index of a sharded dataset written by write_shard_dataset"""
+
+    index_path = Path(shards_dir) / SHARD_INDEX_FILE
+    if not index_path.is_file():
+        raise ValueError(f"Shard index does not exist: {index_path}")
+
+    with index_path.open("r") as f:
+        index = json.load(f)
+    if index.get("version") != SHARD_INDEX_VERSION:
+        raise ValueError(f"Unsupported shard index version: {index.get('version')}")
+    return index
+
+
+def iter_shard(shard: StrPath | BinaryIO) -> Iterator[ShardSample]:
+    """Iterate the samples of one shard, reading it sequentially
+
+    The shard is read as a stream, it can be a path or any file object such
+    as the body of an object storage response.
+    """
+
+    def read(f: BinaryIO) -> Iterator[ShardSample]:
+        sample = None
+        with tarfile.open(fileobj=f, mode="r|", bufsize=_READ_BUFFER_SIZE) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+
+                key, _, ext = member.name.partition(".")
+                if sample is None or sample.key != key:
+                    if sample is not None:
+                        yield sample
+                    sample = ShardSample(key, "", b"", {})
+
+                data = tar.extractfile(member).read()
+                if ext == "json":
+                    sample.annotation = json.loads(data)
+                else:
+                    sample.image_name = member.name
+                    sample.image = data
+
+        if sample is not None:
+            yield sample
+
+    if hasattr(shard, "read"):
+        yield from read(shard)
+    else:
+        with open(shard, "rb", buffering=_READ_BUFFER_SIZE) as f:
+            yield from read(f)
+
+
+def iter_shard_samples(shards_dir: StrPath, subset: str | None = None) -> Iterator[ShardSample]:
+    """Iterate the samples of a sharded dataset, shard after shard
+
+    Args:
+        shards_dir (StrPath): directory written by write_shard_dataset
+        subset (str | None, optional): only iterate this subset. Defaults to all subsets.
+
+    Yields:
+        ShardSample: samples in the order they were written
+    """
+
+    shards_dir = Path(shards_dir)
+    index = read_shard_index(shards_dir)
+    if subset is not None and subset not in index["subsets"]:
+        raise ValueError(f"Subset '{subset}' does not exist in {shards_dir}")
+
+    for name, entries in index["subsets"].items():
+        if subset is not None and name != subset:
+            continue
+        for entry in entries:
+            yield from iter_shard(shards_dir / entry["name"])
@@ -0,0 +1,303 @@
+from pathlib import Path
+
+import numpy as np
+from columnar_utils import ColumnarDataset
+
+try:
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:  # optional, only needed for plots
+    plt = None
+
+HAS_MATPLOTLIB = plt is not None
+
+StrPath = str | Path
+
+# Upper bounds of the COCO small and medium box areas, in pixels
+COCO_AREA_RANGES = {"small": 32**2, "medium": 96**2}
+
+# Edges of the histograms of log2 of the box width and height in pixels, half octaves
+LOG_SIZE_EDGES = np.linspace(0.0, 14.0, 29)
+
+# Edges of the histogram of the box size relative to its image, sqrt(box area / image area)
+RELATIVE_SIZE_EDGES = np.linspace(0.0, 1.0, 21)
+
+# Edges of the histogram of log2 of the box aspect ratio, width / height
+LOG_ASPECT_EDGES = np.linspace(-4.0, 4.0, 17)
+
+# Percentiles reported for the distributions of image values, box values have
+# histograms instead as a selection over millions of boxes is much slower
+PERCENTILES = (0, 5, 25, 50, 75, 95, 100)
+
+# Number of most common image resolutions reported
+NUM_RESOLUTIONS = 20
+
+
+def _distribution(values: np.ndarray) -> dict:
+    """Return the mean and percentiles of values, empty values have none"""
+
+    if len(values) == 0:
+        return {"mean": None, "percentiles": {}}
+    percentiles = np.percentile(values, PERCENTILES)
+    return {
+        "mean": float(values.mean()),
+        "percentiles": {f"p{p}": float(v) for p, v in zip(PERCENTILES, percentiles)},
+    }
+
+
+def _histogram(values: np.ndarray, edges: np.ndarray) -> dict:
+    """Return the mean, range and counts of values between the evenly spaced edges
+
+    Values outside the edges go to the first or last bin, NaN are ignored.
+    """
+
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return {
+            "mean": None,
+            "min": None,
+            "max": None,
+            "edges": edges.round(6).tolist(),
+            "counts": [],
+        }
+
+    # evenly spaced bins are counted without a binary search
+    counts, _ = np.histogram(
+        np.clip(values, edges[0], edges[-1]), bins=len(edges) - 1, range=(edges[0], edges[-1])
+    )
+    return {
+        "mean": float(values.mean()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "edges": edges.round(6).tolist(),
+        "counts": counts.tolist(),
+    }
+
+
+def _class_counts(names: list[str], class_ids: np.ndarray) -> dict[str, int]:
+    return dict(zip(names, np.bincount(class_ids, minlength=len(names)).tolist()))
+
+
+def _image_stats(ds: ColumnarDataset, rows: np.ndarray | slice) -> dict:
+    """Statistics of the image rows: annotation counts and resolutions"""
+
+    boxes_per_image = ds.boxes_per_image[rows]
+    widths, heights = ds.widths[rows], ds.heights[rows]
+    known = (widths > 0) & (heights > 0)
+    widths, heights = widths[known].astype(np.int64), heights[known].astype(np.int64)
+
+    # count each resolution once with a single key per (width, height)
+    keys, counts = np.unique(widths << 32 | heights, return_counts=True)
+    top = np.argsort(-counts, kind="stable")[:NUM_RESOLUTIONS]
+
+    return {
+        "num_images": len(boxes_per_image),
+        "num_images_without_boxes": int(np.count_nonzero(boxes_per_image == 0)),
+        "num_tags": int(ds.tags_per_image[rows].sum()),
+        "num_polygons": int(ds.polygons_per_image[rows].sum()),
+        "boxes_per_image": {
+            **_distribution(boxes_per_image),
+            "counts": np.bincount(boxes_per_image, minlength=1).tolist(),
+        },
+        "image_width": _distribution(widths),
+        "image_height": _distribution(heights),
+        "megapixels": _distribution(widths * heights / 1e6),
+        "resolutions": [
+            {
+                "width": int(keys[k] >> 32),
+                "height": int(keys[k] & 0xFFFFFFFF),
+                "count": int(counts[k]),
+            }
+            for k in top.tolist()
+        ],
+        "num_images_without_size": int(np.count_nonzero(~known)),
+    }
+
+
+def _box_columns(ds: ColumnarDataset, box_images: np.ndarray) -> dict[str, np.ndarray]:
+    """Return the size, area, relative size and aspect ratio of every box
+
+    Values which cannot be computed, for degenerate boxes or images of
+    unknown size, are NaN.
+    """
+
+    xywh = ds.boxes_as("xywh")
+    widths = xywh[:, 2].astype(np.float64)
+    heights = xywh[:, 3].astype(np.float64)
+    areas = widths * heights
+
+    image_areas = ds.widths.astype(np.float64) * ds.heights.astype(np.float64)
+    image_areas = np.where(image_areas > 0, image_areas, np.nan)[box_images]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        valid = (widths > 0) & (heights > 0)
+        return {
+            "valid": valid,
+            "areas": areas,
+            "log_widths": np.where(valid, np.log2(widths), np.nan),
+            "log_heights": np.where(valid, np.log2(heights), np.nan),
+            "relative_sizes": np.where(valid, np.sqrt(areas / image_areas), np.nan),
+            "log_aspects": np.where(valid, np.log2(widths / heights), np.nan),
+        }
+
+
+def _box_stats(columns: dict[str, np.ndarray], box_rows: np.ndarray | slice) -> dict:
+    """Statistics of the boxes box_rows: sizes, aspect ratios and COCO areas"""
+
+    areas = columns["areas"][box_rows]
+    small, medium = COCO_AREA_RANGES["small"], COCO_AREA_RANGES["medium"]
+    return {
+        "num_boxes": len(areas),
+        "num_degenerate_boxes": int(len(areas) - np.count_nonzero(columns["valid"][box_rows])),
+        "log2_box_width": _histogram(columns["log_widths"][box_rows], LOG_SIZE_EDGES),
+        "log2_box_height": _histogram(columns["log_heights"][box_rows], LOG_SIZE_EDGES),
+        "relative_size": _histogram(columns["relative_sizes"][box_rows], RELATIVE_SIZE_EDGES),
+        "log2_aspect_ratio": _histogram(columns["log_aspects"][box_rows], LOG_ASPECT_EDGES),
+        "coco_areas": {
+            "small": int(np.count_nonzero(areas < small)),
+            "medium": int(np.count_nonzero((areas >= small) & (areas < medium))),
+            "large": int(np.count_nonzero(areas >= medium)),
+        },
+    }
+
+
+def dataset_stats(ds: ColumnarDataset) -> dict:
+    """Compute the statistics of a dataset in vectorized passes over its columns
+
+    Statistics are computed for the whole dataset and for each subset: class
+    histograms of boxes, polygons, tags and images, boxes per image, box
+    sizes in pixels and relative to their image, aspect ratios, COCO area
+    ranges and image resolutions. Box sizes in pixels require the image sizes
+    of "yolo" boxes, see ColumnarDataset.fill_image_sizes.
+
+    Args:
+        ds (ColumnarDataset): dataset, from any reader
+
+    Returns:
+        dict: {"names", "subsets", "all": stats, "by_subset": {subset: stats}}
+    """
+
+    box_images = ds.box_image_index()
+    box_columns = _box_columns(ds, box_images)
+
+    polygon_images = np.repeat(np.arange(len(ds)), ds.polygons_per_image)
+    tag_images = np.repeat(np.arange(len(ds)), ds.tags_per_image)
+
+    # images of every class, each image counts once per class it is annotated with.
+    # Annotations are grouped by image, so the keys are almost sorted already
+    num_classes = len(ds.names)
+    image_classes = np.sort(
+        np.concatenate(
+            [
+                box_images * num_classes + ds.box_classes,
+                polygon_images * num_classes + ds.polygon_classes,
+                tag_images * num_classes + ds.tag_classes,
+            ]
+        ),
+        kind="stable",
+    )
+    image_classes = image_classes[np.r_[True, image_classes[1:] != image_classes[:-1]]]
+    class_images = image_classes // num_classes if num_classes else image_classes
+
+    def section(image_mask: np.ndarray | None) -> dict:
+        # the whole dataset is selected with slices, which do not copy the columns
+        if image_mask is None:
+            rows = box_rows = polygon_mask = tag_mask = image_class_mask = slice(None)
+        else:
+            rows = np.flatnonzero(image_mask)
+            box_rows = np.flatnonzero(image_mask[box_images])
+            polygon_mask = image_mask[polygon_images]
+            tag_mask = image_mask[tag_images]
+            image_class_mask = image_mask[class_images]
+
+        return {
+            **_image_stats(ds, rows),
+            **_box_stats(box_columns, box_rows),
+            "classes": {
+                "boxes": _class_counts(ds.names, ds.box_classes[box_rows]),
+                "polygons": _class_counts(ds.names, ds.polygon_classes[polygon_mask]),
+                "tags": _class_counts(ds.names, ds.tag_classes[tag_mask]),
+                "images": _class_counts(
+                    ds.names, image_classes[image_class_mask] % max(num_classes, 1)
+                ),
+            },
+        }
+
+    return {
+        "names": list(ds.names),
+        "subsets": list(ds.subsets),
+        "all": section(None),
+        "by_subset": {
+            subset: section(ds.subset_ids == subset_id)
+            for subset_id, subset in enumerate(ds.subsets)
+        },
+    }
+
+
+def plot_stats(stats: dict, plot_dir: StrPath) -> list[Path]:
+    """Plot the statistics of the whole dataset as PNG files, requires matplotlib
+
+    Args:
+        stats (dict): statistics returned by dataset_stats
+        plot_dir (StrPath): directory of the PNG files
+
+    Returns:
+        list[Path]: paths of the PNG files
+    """
+
+    if not HAS_MATPLOTLIB:
+        raise ValueError("matplotlib is required to plot statistics")
+
+    plot_dir = Path(plot_dir)
+    plot_dir.mkdir(parents=True, exist_ok=True)
+    section = stats["all"]
+
+    def bar_plot(file_name: str, title: str, labels: list, counts: list, xlabel: str):
+        fig, ax = plt.subplots(figsize=(max(6.0, 0.3 * len(labels)), 4.0))
+        ax.bar(range(len(counts)), counts)
+        ax.set_xticks(range(len(labels)), [str(label) for label in labels], rotation=90)
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel("count")
+        fig.tight_layout()
+        fig.savefig(plot_dir / file_name)
+        plt.close(fig)
+        paths.append(plot_dir / file_name)
+
+    def edge_labels(edges: list[float]) -> list[str]:
+        return [f"{low:g}-{high:g}" for low, high in zip(edges, edges[1:])]
+
+    paths: list[Path] = []
+    for key in ("boxes", "images"):
+        classes = section["classes"][key]
+        bar_plot(
+            f"{key}_per_class.png", f"{key} per class", list(classes), list(classes.values()), "class"
+        )
+
+    counts = section["boxes_per_image"]["counts"]
+    bar_plot(
+        "boxes_per_image.png", "boxes per image", list(range(len(counts))), counts, "boxes"
+    )
+
+    for key, title in (
+        ("log2_box_width", "log2(box width in pixels)"),
+        ("log2_box_height", "log2(box height in pixels)"),
+        ("relative_size", "sqrt(box area / image area)"),
+        ("log2_aspect_ratio", "log2(box width / box height)"),
+    ):
+        hist = section[key]
+        if hist["counts"]:
+            bar_plot(f"{key}.png", title, edge_labels(hist["edges"]), hist["counts"], key)
+
+    resolutions = section["resolutions"]
+    bar_plot(
+        "resolutions.png",
+        "most common image resolutions",
+        [f"{r['width']}x{r['height']}" for r in resolutions],
+        [r["count"] for r in resolutions],
+        "resolution",
+    )
+
+    return paths
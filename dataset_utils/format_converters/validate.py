@@ -0,0 +1,196 @@
+import os
+import sys
+
+# Get the current directory
+current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
+
+# Add the current directory to the search path
+sys.path.append(current_dir)
+
+
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+
+from convert import FORMATS, read_dataset, write_dataset
+from utils.manifest_utils import OutputManifest, prepare_output_dir
+from utils.profile_utils import StageProfiler, add_profile_args
+from utils.transfer_utils import add_transfer_args, open_file_transfer
+from validate_utils import fix_dataset, validate_dataset
+
+StrPath = str | Path
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--from",
+        type=str,
+        dest="src_format",
+        choices=FORMATS,
+        help="Format of the dataset",
+        required=True,
+    )
+    parser.add_argument(
+        "--src",
+        type=str,
+        help="Path to the dataset directory",
+        required=True,
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="Write the problems found to this JSON file",
+        default=None,
+    )
+    parser.add_argument(
+        "--decode",
+        action="store_true",
+        help="Decode every image to find corrupt data, much slower than the header "
+        "and end marker checks",
+    )
+    parser.add_argument(
+        "--fix",
+        action="store_true",
+        help="Write a copy of the dataset to --output without the broken images, "
+        "with annotations of unknown classes dropped and boxes clipped to their image",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Path to the output directory of --fix",
+        default=None,
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Overwrite existing output directory",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Number of images checked per worker task",
+        default=64,
+    )
+
+    add_transfer_args(parser)
+    add_profile_args(parser)
+
+    return parser.parse_args()
+
+
+def validate_dataset_dir(
+    src_dir: StrPath,
+    src_format: str,
+    report_path: StrPath | None = None,
+    decode: bool = False,
+    fix: bool = False,
+    output_dir: StrPath | None = None,
+    force: bool = False,
+    transfer: str = "copy",
+    workers: int = 4,
+    batch_size: int = 64,
+    profiler: StageProfiler | None = None,
+) -> dict:
+    """Check the images and annotations of a dataset, and optionally write a fixed copy
+
+    Image files are checked for existence, a readable header and an end
+    marker, and fully decoded with decode, by a pool of processes.
+    Annotations are checked for unknown class ids, non finite, zero area and
+    out of bounds boxes, and annotated sizes which are not the sizes of the
+    files. See validate_utils for the checks and the fixes.
+
+    Args:
+        src_dir (StrPath): directory of the dataset
+        src_format (str): format of the dataset, one of FORMATS
+        report_path (StrPath | None, optional): Write the report to this JSON file. Defaults to None.
+        decode (bool, optional): Decode every image. Defaults to False.
+        fix (bool, optional): Write the fixed dataset to output_dir, in the same format. Defaults to False.
+        output_dir (StrPath | None, optional): directory of the fixed dataset. Defaults to None.
+        force (bool, optional): Overwrite existing output directory. Defaults to False.
+        transfer (str, optional): How images are transferred to the fixed dataset, one of "copy", "hardlink", "reflink", "symlink" and "pack". Defaults to "copy".
+        workers (int, optional): Number of processes checking images and threads transferring them. Defaults to 4.
+        batch_size (int, optional): Number of images checked per worker task. Defaults to 64.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage. Defaults to None.
+
+    Returns:
+        dict: report of the problems found, see validate_utils.validate_dataset
+    """  # noqa: E501
+
+    src_dir = Path(src_dir)
+    if not src_dir.exists():
+        raise ValueError(f"Source directory does not exist: {src_dir}")
+    if not src_dir.is_dir():
+        raise ValueError(f"Source is not a directory: {src_dir}")
+    if fix and output_dir is None:
+        raise ValueError("An output directory is required to fix a dataset")
+    if fix:
+        output_dir = Path(output_dir)
+        prepare_output_dir(output_dir, force)
+
+    profiler = profiler or StageProfiler()
+
+    # missing images are reported instead of stopping the reader
+    with profiler.stage("read annotations") as stage:
+        ds = read_dataset(src_format, src_dir, workers, check_images=False)
+        stage.items += len(ds)
+
+    with profiler.stage("validate", items=len(ds)):
+        report, masks = validate_dataset(ds, decode, workers, batch_size)
+
+    print(f"Checked {report['num_images']} images and {report['num_boxes']} boxes")
+    for kind, count in report["counts"].items():
+        if count:
+            print(f"  {kind}: {count}")
+
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if not fix:
+        return report
+
+    fixed = fix_dataset(ds, masks)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest = OutputManifest(output_dir)
+
+    with (
+        profiler.stage("write dataset", items=len(fixed)),
+        open_file_transfer(transfer, workers, output_dir) as file_transfer,
+    ):
+        # ImageNet datasets keep whole images
+        write_dataset(fixed, output_dir, src_format, file_transfer, manifest, crop=False)
+
+    manifest.finish()
+    print(
+        f"Wrote the fixed dataset: {len(fixed)} images and {fixed.num_boxes} boxes, "
+        f"{len(ds) - len(fixed)} images and {ds.num_boxes - fixed.num_boxes} boxes dropped"
+    )
+    return report
+
+
+def main():
+    args = get_args()
+
+    profiler = StageProfiler() if args.profile is not None else None
+
+    validate_dataset_dir(
+        src_dir=args.src,
+        src_format=args.src_format,
+        report_path=args.report,
+        decode=args.decode,
+        fix=args.fix,
+        output_dir=args.output,
+        force=args.force,
+        transfer=args.transfer,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        profiler=profiler,
+    )
+
+    if profiler is not None:
+        profiler.finish(args.profile)
+
+
+if __name__ == "__main__":
+    main()
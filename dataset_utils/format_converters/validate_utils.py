@@ -0,0 +1,323 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+
+import numpy as np
+from columnar_utils import ColumnarDataset
+from PIL import Image
+from utils.bbox_utils import xywh2xyxy_array, yolo2xyxy_array
+from utils.image_meta_utils import oriented_size
+from utils.packed_utils import find_packed_image
+
+# Problems found in images, the images are dropped by fix_dataset
+#   - "missing_image": the image file does not exist
+#   - "corrupt_image": the image cannot be opened, or decoded with decode=True
+#   - "truncated_image": a JPEG without its EOI marker or a PNG without its IEND chunk
+IMAGE_ERRORS = ("missing_image", "corrupt_image", "truncated_image")
+
+# Problems found in annotations, fix_dataset drops or clips the annotations
+#   - "size_mismatch": the annotated size is not the size of the image file
+#   - "unknown_class": class id outside of the class names
+#   - "invalid_box": box with coordinates which are not finite numbers
+#   - "zero_area_box": box without width or height
+#   - "out_of_bounds_box": box crossing the border of its image
+ANNOTATION_ERRORS = (
+    "size_mismatch",
+    "unknown_class",
+    "invalid_box",
+    "zero_area_box",
+    "out_of_bounds_box",
+)
+
+# Boxes may cross the border of their image by this many pixels, for rounding
+BOUNDS_TOLERANCE = 0.5
+
+# Number of bytes at the end of an image searched for its end marker, some
+# encoders pad the files after it
+_TAIL_SIZE = 1024
+
+# End markers of the formats checked for truncation
+_END_MARKERS = {"JPEG": b"\xff\xd9", "PNG": b"IEND"}
+
+
+def check_image(img_path: str, decode: bool = False) -> tuple[str | None, str, int, int]:
+    """Check that an image file exists and is complete
+
+    The header is read to get the size, once the EXIF orientation is applied
+    like annotation tools display the image, and the end of JPEG and PNG
+    files is searched for their end marker. With decode, the whole image is
+    decoded, which finds corrupt data inside the file but is much slower.
+
+    Returns:
+        tuple[str | None, str, int, int]: error from IMAGE_ERRORS or None, a
+            description of the error, width and height of the image (-1 if unknown)
+    """
+
+    # images of a packed store are checked in the store
+    found = None
+    if not os.path.isfile(img_path):
+        found = find_packed_image(img_path)
+        if found is None:
+            return "missing_image", "file does not exist", -1, -1
+
+    try:
+        with Image.open(img_path) if found is None else found[0].get_image(found[1]) as img:
+            width, height, _ = oriented_size(img)
+            img_format = img.format
+            if decode:
+                img.load()
+    except Exception as e:  # Pillow raises many kinds of errors for broken files
+        return "corrupt_image", f"{type(e).__name__}: {e}", -1, -1
+
+    marker = _END_MARKERS.get(img_format)
+    if marker is not None:
+        if found is None:
+            with open(img_path, "rb") as f:
+                f.seek(max(os.fstat(f.fileno()).st_size - _TAIL_SIZE, 0))
+                tail = f.read()
+        else:
+            tail = bytes(found[0].get_bytes(found[1])[-_TAIL_SIZE:])
+        if marker not in tail:
+            return "truncated_image", f"{img_format} end marker not found", width, height
+
+    return None, "", width, height
+
+
+def _check_batch(img_paths: list[str], decode: bool) -> list[tuple[str | None, str, int, int]]:
+    """Check a batch of images in a worker"""
+
+    return [check_image(img_path, decode) for img_path in img_paths]
+
+
+def check_images(
+    img_paths: list[str],
+    decode: bool = False,
+    workers: int = 4,
+    batch_size: int = 64,
+) -> list[tuple[str | None, str, int, int]]:
+    """Check every image with check_image in a pool of processes, results are in order
+
+    Args:
+        img_paths (list[str]): paths of the images
+        decode (bool, optional): decode every image. Defaults to False.
+        workers (int, optional): number of processes. Defaults to 4.
+        batch_size (int, optional): number of images per worker task. Defaults to 64.
+    """
+
+    batches = [img_paths[i : i + batch_size] for i in range(0, len(img_paths), batch_size)]
+    results = []
+    if workers <= 1:
+        for batch in batches:
+            results += _check_batch(batch, decode)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # bound the number of pending batches, results are kept in order
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.submit(_check_batch, batch, decode))
+                if len(pending) >= workers * 2:
+                    results += pending.popleft().result()
+            while pending:
+                results += pending.popleft().result()
+
+    return results
+
+
+def _boxes_xyxy(ds: ColumnarDataset, box_w: np.ndarray, box_h: np.ndarray) -> np.ndarray:
+    """Return the boxes as pixel corners, "yolo" boxes of images of unknown size are NaN"""
+
+    if ds.box_format == "yolo":
+        unknown = (box_w <= 0) | (box_h <= 0)
+        return yolo2xyxy_array(
+            ds.boxes, np.where(unknown, np.nan, box_w), np.where(unknown, np.nan, box_h)
+        )
+    if ds.box_format == "xywh":
+        return xywh2xyxy_array(ds.boxes)
+    return np.asarray(ds.boxes, dtype=np.float64)
+
+
+def check_annotations(ds: ColumnarDataset) -> dict[str, np.ndarray]:
+    """Check the annotations of a dataset with vectorized passes over its arrays
+
+    Image sizes are required for "yolo" boxes and bounds checks, images of
+    unknown size are not checked.
+
+    Returns:
+        dict[str, np.ndarray]: boolean mask of the boxes ("unknown_class",
+            "invalid_box", "zero_area_box", "out_of_bounds_box"), tags
+            ("unknown_tag_class") and polygons ("unknown_polygon_class")
+            which have the problem
+    """
+
+    num_classes = len(ds.names)
+    box_images = ds.box_image_index()
+    box_w = ds.widths[box_images].astype(np.float64)
+    box_h = ds.heights[box_images].astype(np.float64)
+    xyxy = _boxes_xyxy(ds, box_w, box_h)
+
+    with np.errstate(invalid="ignore"):
+        invalid = ~np.isfinite(ds.boxes).all(axis=1)
+        known_size = (box_w > 0) & (box_h > 0) & np.isfinite(xyxy).all(axis=1)
+        zero_area = ~invalid & (
+            (xyxy[:, 2] - xyxy[:, 0] <= 0) | (xyxy[:, 3] - xyxy[:, 1] <= 0)
+        )
+        out_of_bounds = (
+            known_size
+            & ~zero_area
+            & (
+                (xyxy[:, 0] < -BOUNDS_TOLERANCE)
+                | (xyxy[:, 1] < -BOUNDS_TOLERANCE)
+                | (xyxy[:, 2] > box_w + BOUNDS_TOLERANCE)
+                | (xyxy[:, 3] > box_h + BOUNDS_TOLERANCE)
+            )
+        )
+
+    return {
+        "unknown_class": (ds.box_classes < 0) | (ds.box_classes >= num_classes),
+        "invalid_box": invalid,
+        "zero_area_box": zero_area,
+        "out_of_bounds_box": out_of_bounds,
+        "unknown_tag_class": (ds.tag_classes < 0) | (ds.tag_classes >= num_classes),
+        "unknown_polygon_class": (ds.polygon_classes < 0) | (ds.polygon_classes >= num_classes),
+    }
+
+
+def validate_dataset(
+    ds: ColumnarDataset,
+    decode: bool = False,
+    workers: int = 4,
+    batch_size: int = 64,
+) -> tuple[dict, dict]:
+    """Check the images and annotations of a dataset
+
+    Images are checked by a pool of processes, see check_images, and the
+    annotations with vectorized passes, see check_annotations. The sizes of
+    the image files are used for the images whose size is not annotated.
+
+    Args:
+        ds (ColumnarDataset): dataset, from any reader
+        decode (bool, optional): decode every image. Defaults to False.
+        workers (int, optional): number of processes checking images. Defaults to 4.
+        batch_size (int, optional): number of images per worker task. Defaults to 64.
+
+    Returns:
+        tuple[dict, dict]: the report, with the number of problems of every
+            kind and one item per problem, and the masks of the problems
+            (the image errors, sizes of the image files and the masks of
+            check_annotations) to give to fix_dataset
+    """
+
+    results = check_images(ds.image_paths(), decode, workers, batch_size)
+    image_errors = np.array([error or "" for error, _, _, _ in results], dtype=object)
+    file_widths = np.array([width for _, _, width, _ in results], dtype=np.int32)
+    file_heights = np.array([height for _, _, _, height in results], dtype=np.int32)
+
+    known = (ds.widths > 0) & (ds.heights > 0)
+    readable = file_widths > 0
+    size_mismatch = (
+        known & readable & ((ds.widths != file_widths) | (ds.heights != file_heights))
+    )
+
+    # annotations are checked with the sizes of the files when they are not annotated
+    masks = check_annotations(
+        replace(
+            ds,
+            widths=np.where(known, ds.widths, file_widths).astype(np.int32),
+            heights=np.where(known, ds.heights, file_heights).astype(np.int32),
+        )
+    )
+
+    subsets = [ds.subsets[subset_id] for subset_id in ds.subset_ids.tolist()]
+    img_paths = ds.image_paths()
+    issues = []
+    for i in np.flatnonzero(image_errors != "").tolist():
+        issues.append(
+            {
+                "kind": image_errors[i],
+                "subset": subsets[i],
+                "file_path": img_paths[i],
+                "detail": results[i][1],
+            }
+        )
+    for i in np.flatnonzero(size_mismatch).tolist():
+        issues.append(
+            {
+                "kind": "size_mismatch",
+                "subset": subsets[i],
+                "file_path": img_paths[i],
+                "detail": f"annotated {ds.widths[i]}x{ds.heights[i]}, "
+                f"file {file_widths[i]}x{file_heights[i]}",
+            }
+        )
+
+    box_images = ds.box_image_index()
+    for kind in ("unknown_class", "invalid_box", "zero_area_box", "out_of_bounds_box"):
+        for k in np.flatnonzero(masks[kind]).tolist():
+            i = int(box_images[k])
+            issues.append(
+                {
+                    "kind": kind,
+                    "subset": subsets[i],
+                    "file_path": img_paths[i],
+                    "box": k - int(ds.box_offsets[i]),
+                    "detail": f"class {ds.box_classes[k]}, box {ds.boxes[k].tolist()}",
+                }
+            )
+    for kind, offsets, classes in (
+        ("unknown_tag_class", ds.tag_offsets, ds.tag_classes),
+        ("unknown_polygon_class", ds.polygon_offsets, ds.polygon_classes),
+    ):
+        item_images = np.repeat(np.arange(len(ds)), np.diff(offsets))
+        for k in np.flatnonzero(masks[kind]).tolist():
+            i = int(item_images[k])
+            issues.append(
+                {
+                    "kind": "unknown_class",
+                    "subset": subsets[i],
+                    "file_path": img_paths[i],
+                    "detail": f"{kind.split('_')[1]} class {classes[k]}",
+                }
+            )
+
+    counts = dict.fromkeys(IMAGE_ERRORS + ANNOTATION_ERRORS, 0)
+    for issue in issues:
+        counts[issue["kind"]] += 1
+
+    report = {
+        "num_images": len(ds),
+        "num_boxes": ds.num_boxes,
+        "num_issues": len(issues),
+        "counts": counts,
+        "issues": issues,
+    }
+    masks.update(
+        image_errors=image_errors != "",
+        size_mismatch=size_mismatch,
+        file_widths=file_widths,
+        file_heights=file_heights,
+    )
+    return report, masks
+
+
+def fix_dataset(ds: ColumnarDataset, masks: dict) -> ColumnarDataset:
+    """Return a new dataset without the problems found by validate_dataset
+
+    Images which are missing, corrupt or truncated are dropped, image sizes
+    are replaced by the sizes of the files, annotations of unknown classes
+    and invalid boxes are dropped, and boxes are clipped to their image,
+    boxes left without area are dropped.
+    """
+
+    ds = ds.filter_annotations(
+        keep_boxes=~(masks["unknown_class"] | masks["invalid_box"]),
+        keep_tags=~masks["unknown_tag_class"],
+        keep_polygons=~masks["unknown_polygon_class"],
+    )
+
+    readable = masks["file_widths"] > 0
+    ds.widths = np.where(readable, masks["file_widths"], ds.widths).astype(np.int32)
+    ds.heights = np.where(readable, masks["file_heights"], ds.heights).astype(np.int32)
+
+    ds = ds.select(np.flatnonzero(~masks["image_errors"]))
+    return ds.clip_boxes()
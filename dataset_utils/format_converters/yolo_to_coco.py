@@ -1,4 +1,3 @@
-import json
 import os
 import sys
 
@@ -9,14 +8,31 @@ current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
 sys.path.append(current_dir)
 
 
-import datetime as dt
-import shutil
-import xml.etree.ElementTree as ET
 from argparse import ArgumentParser
+from contextlib import ExitStack
+from dataclasses import replace
 from pathlib import Path
 
-import imagesize
-from utils.bbox_utils import yolo2xywh
+import numpy as np
+from coco_utils import (
+    CocoJsonWriter,
+    add_coco_images,
+    add_coco_writer_args,
+    default_coco_info,
+)
+from columnar_utils import ColumnarDataset
+from utils.bbox_utils import add_box_args
+from utils.manifest_utils import (
+    ImageDirLinks,
+    OutputManifest,
+    add_annotations_only_arg,
+    add_manifest_args,
+    prepare_output_dir,
+)
+from utils.packed_utils import check_no_packed_images
+from utils.pipeline_utils import Pipeline, batch_rows
+from utils.profile_utils import StageProfiler, add_profile_args
+from utils.transfer_utils import add_transfer_args, open_file_transfer
 from yolo_utils import read_yolo_data_yaml, validate_dataset_folder
 
 StrPath = str | Path
@@ -46,6 +62,18 @@ def get_args():
         action="store_true",
         help="Skip missing images/labels",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the label and image metadata caches",
+    )
+
+    add_coco_writer_args(parser)
+    add_transfer_args(parser)
+    add_box_args(parser)
+    add_manifest_args(parser)
+    add_annotations_only_arg(parser)
+    add_profile_args(parser)
 
     return parser.parse_args()
 
@@ -54,7 +82,16 @@ def convert_yolo_ultralytics_to_coco(
     src_dir: StrPath,
     output_dir: StrPath,
     force: bool = False,
+    incremental: bool = False,
     skip_missing: bool = False,
+    transfer: str = "copy",
+    workers: int = 4,
+    cache: bool = True,
+    compact: bool = False,
+    json_encoder: str = "auto",
+    annotations_only: bool = False,
+    clip_boxes: bool = False,
+    profiler: StageProfiler | None = None,
 ):
     """Convert dataset from YOLO Ultralytics format to COCO format
 
@@ -65,6 +102,15 @@ def convert_yolo_ultralytics_to_coco(
         src_dir (StrPath): directory of the CVAT dataset
         output_dir (StrPath): directory of the output YOLO Ultralytics dataset
         force (bool, optional): Overwrite existing output directory. Defaults to False.
+        incremental (bool, optional): Update an output directory written by a previous run, only files whose source changed are rewritten. Defaults to False.
+        transfer (str, optional): How images are transferred, one of "copy", "hardlink", "reflink", "symlink" and "pack". Defaults to "copy".
+        workers (int, optional): Number of threads used to read labels and transfer images. Defaults to 4.
+        cache (bool, optional): Reuse labels and image sizes read by previous runs from the label cache of the source directory and the image metadata cache. Defaults to True.
+        compact (bool, optional): Write json files without indentation. Defaults to False.
+        json_encoder (str, optional): Json encoder, one of "auto", "json" and "orjson". Defaults to "auto".
+        annotations_only (bool, optional): Write only the json files, images are referenced through one symlink per source directory inside the images directory. Defaults to False.
+        clip_boxes (bool, optional): Clip boxes to their image and drop boxes left without area. Defaults to False.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage of the conversion. Defaults to None.
     """  # noqa: E501
 
     src_dir = Path(src_dir)
@@ -72,22 +118,24 @@ def convert_yolo_ultralytics_to_coco(
         raise ValueError(f"Source directory does not exist: {src_dir}")
     if not src_dir.is_dir():
         raise ValueError(f"Source is not a directory: {src_dir}")
+    if annotations_only:
+        # packed images cannot be referenced through links to their directories
+        check_no_packed_images(src_dir, "referenced with --annotations-only")
 
     output_dir = Path(output_dir)
-    if not force:
-        if output_dir.exists():
-            raise ValueError("Output directory already exists")
-    else:
-        print("Output directory already exists. Removing existing output directory")
-        shutil.rmtree(str(output_dir), ignore_errors=True)
-        print("Creating new output directory")
+    prepare_output_dir(output_dir, force, incremental)
+    profiler = profiler or StageProfiler()
 
     data_yml_file = src_dir / "data.yaml"
     if not data_yml_file.exists():
         raise ValueError(f"data.yaml does not exist: {data_yml_file}")
 
     data_yml = read_yolo_data_yaml(data_yml_file)
-    ds_data = validate_dataset_folder(data_yml, src_dir, skip_missing)
+    with profiler.stage("read labels") as stage:
+        ds = validate_dataset_folder(
+            data_yml, src_dir, skip_missing, workers=workers, cache=cache
+        )
+        stage.items += len(ds)
 
     print(data_yml)
 
@@ -97,76 +145,114 @@ def convert_yolo_ultralytics_to_coco(
     annotations_output_dir.mkdir(parents=True, exist_ok=True)
     images_output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Convert names to categories for COCO
-    class_names = {}
-    for idx, name in enumerate(data_yml["names"], start=1):
-        class_names[idx] = name
-
-    for subset, data in ds_data.items():
-        subset_info = {
-            "info": {
-                "description": "COCO Dataset",
-                "url": "https://khiemle.dev",
-                "version": "1.0",
-                "year": dt.datetime.now().year,
-                "contributor": "Khiem Le",
-                "date_created": dt.datetime.now().strftime("%Y/%m/%d"),
-            },
-            "licenses": [],
-            "images": [],
-            "annotations": [],
-            "categories": [{"id": k, "name": v} for k, v in class_names.items()],
-        }
-
-        for img in data:
-            img_path = Path(img["image"])
-            labels = img["labels"]
-
-            # Copy image to output directory
-            shutil.copy(img_path, images_output_dir / img_path.name)
-
-            # Get image size
-            imw, imh = imagesize.get(str(img_path))
-
-            # Add image info
-            subset_info["images"].append({
-                "id": len(subset_info["images"]) + 1,
-                "file_name": img_path.name,
-                "width": imw,
-                "height": imh,
-            })
-
-            # Convert labels to COCO format
-            for label in labels:
-                x, y, w, h = yolo2xywh(*label[1:], imw, imh)
-                category_id = label[0] + 1
-                annotation = {
-                    "id": len(subset_info["annotations"]) + 1,
-                    "image_id": len(subset_info["images"]),
-                    "category_id": category_id,
-                    "segmentation": [],
-                    "area": w * h,
-                    "bbox": [x, y, w, h],
-                    "iscrowd": 0,
-                }
-                subset_info["annotations"].append(annotation)
-
-        # Write result to json output
-        json_output_path = annotations_output_dir / f"instances_{subset}.json"
-        with json_output_path.open("w") as f:
-            json.dump(subset_info, f, indent=2)
+    # Convert names to categories for COCO, id in COCO starts from 1
+    categories = [{"id": i, "name": name} for i, name in enumerate(ds.names, start=1)]
+
+    # Only the images which changed since the previous run are copied
+    manifest = OutputManifest(output_dir)
+    links = ImageDirLinks(images_output_dir, manifest)
+
+    def probe_sizes(rows: np.ndarray) -> ColumnarDataset:
+        # Get image sizes, they are required to convert boxes to absolute
+        # coordinates, and clip boxes to their image
+        ds.fill_image_sizes(workers, cache, rows=rows, verbose=False)
+        batch = ds.select(rows)
+        return batch.clip_boxes() if clip_boxes else batch
+
+    def transfer_images(batch: ColumnarDataset) -> ColumnarDataset:
+        if not annotations_only:
+            # Copy images to output directory
+            for img_path in batch.image_paths():
+                manifest.transfer(
+                    file_transfer, img_path, images_output_dir / Path(img_path).name
+                )
+        return batch
+
+    # Image sizes are probed, images transferred and json encoded at the same
+    # time, by batches of images of one subset. Batches come out of the
+    # pipeline in order, so image and annotation ids follow the dataset order
+    pipeline = Pipeline()
+    pipeline.add_stage("probe image sizes", probe_sizes)
+    pipeline.add_stage("queue transfers", transfer_images, workers=max(1, workers // 2))
+
+    with (
+        profiler.stage("pipeline"),
+        open_file_transfer(transfer, workers, output_dir) as file_transfer,
+        ExitStack() as writers,
+    ):
+        # One json file per subset, written while the batches come out
+        subset_writers = []
+        for subset in ds.subsets:
+            json_output_path = annotations_output_dir / f"instances_{subset}.json"
+            manifest.add(json_output_path)
+            subset_writers.append(
+                writers.enter_context(
+                    CocoJsonWriter(
+                        json_output_path,
+                        categories,
+                        info=default_coco_info(),
+                        compact=compact,
+                        encoder=json_encoder,
+                    )
+                )
+            )
+
+        subset_batches = (
+            rows
+            for subset_id in range(len(ds.subsets))
+            for rows in batch_rows(np.flatnonzero(ds.subset_ids == subset_id))
+        )
+        for batch in pipeline.run(subset_batches):
+            writer = subset_writers[batch.subset_ids[0]]
+            image_ids = np.arange(1, len(batch) + 1) + writer.num_images
+
+            if annotations_only:
+                # Reference images through the links to their source directories
+                batch = replace(
+                    batch, file_names=np.array(links.image_names(batch), dtype=object)
+                )
+
+            # Write result to json output
+            with profiler.stage("write annotations", items=len(batch)):
+                add_coco_images(writer, batch, image_ids)
+
+    pipeline.record(profiler, parent="pipeline")
+    profiler.record(
+        "transfer images",
+        file_transfer.time,
+        items=file_transfer.num_files,
+        nbytes=file_transfer.num_bytes,
+        parent="pipeline",
+    )
+
+    with profiler.stage("finish manifest"):
+        manifest.finish()
 
 
 def main():
     args = get_args()
 
+    profiler = StageProfiler() if args.profile is not None else None
+
     convert_yolo_ultralytics_to_coco(
         src_dir=args.src,
         output_dir=args.output,
         force=args.force,
+        incremental=args.incremental,
         skip_missing=args.skip_missing,
+        transfer=args.transfer,
+        workers=args.workers,
+        cache=not args.no_cache,
+        compact=args.compact,
+        json_encoder=args.json_encoder,
+        annotations_only=args.annotations_only,
+        clip_boxes=args.clip_boxes,
+        profiler=profiler,
     )
 
+    if profiler is not None:
+        profiler.finish(args.profile)
+
 
 if __name__ == "__main__":
     main()
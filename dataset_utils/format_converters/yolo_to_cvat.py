@@ -9,13 +9,24 @@ sys.path.append(current_dir)
 
 
 import datetime as dt
-import shutil
 import xml.etree.ElementTree as ET
 from argparse import ArgumentParser
 from pathlib import Path
 
-import imagesize
-from utils.bbox_utils import yolo2xyxy
+import numpy as np
+from columnar_utils import ColumnarDataset
+from utils.bbox_utils import add_box_args
+from utils.manifest_utils import (
+    ImageDirLinks,
+    OutputManifest,
+    add_annotations_only_arg,
+    add_manifest_args,
+    prepare_output_dir,
+)
+from utils.packed_utils import check_no_packed_images
+from utils.pipeline_utils import Pipeline, batch_rows
+from utils.profile_utils import StageProfiler, add_profile_args
+from utils.transfer_utils import add_transfer_args, open_file_transfer
 from yolo_utils import read_yolo_data_yaml, validate_dataset_folder
 
 StrPath = str | Path
@@ -40,6 +51,17 @@ def get_args():
         action="store_true",
         help="Overwrite existing output directory",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the label and image metadata caches",
+    )
+
+    add_transfer_args(parser)
+    add_box_args(parser)
+    add_manifest_args(parser)
+    add_annotations_only_arg(parser)
+    add_profile_args(parser)
 
     return parser.parse_args()
 
@@ -48,6 +70,13 @@ def convert_yolo_ultralytics_to_cvat(
     src_dir: StrPath,
     output_dir: StrPath,
     force: bool = False,
+    incremental: bool = False,
+    transfer: str = "copy",
+    workers: int = 4,
+    cache: bool = True,
+    annotations_only: bool = False,
+    clip_boxes: bool = False,
+    profiler: StageProfiler | None = None,
 ):
     """Convert dataset from YOLO Ultralytics format to CVAT for images format
 
@@ -58,6 +87,13 @@ def convert_yolo_ultralytics_to_cvat(
         src_dir (StrPath): directory of the YOLO Ultralytics dataset
         output_dir (StrPath): directory of the output dataset
         force (bool, optional): Overwrite existing output directory. Defaults to False.
+        incremental (bool, optional): Update an output directory written by a previous run, only files whose source changed are rewritten. Defaults to False.
+        transfer (str, optional): How images are transferred, one of "copy", "hardlink", "reflink", "symlink" and "pack". Defaults to "copy".
+        workers (int, optional): Number of threads used to read labels and transfer images. Defaults to 4.
+        cache (bool, optional): Reuse labels and image sizes read by previous runs from the label cache of the source directory and the image metadata cache. Defaults to True.
+        annotations_only (bool, optional): Write only annotations.xml, images are referenced through one symlink per source directory inside the subset image directories. Defaults to False.
+        clip_boxes (bool, optional): Clip boxes to their image and drop boxes left without area. Defaults to False.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage of the conversion. Defaults to None.
     """  # noqa: E501
 
     src_dir = Path(src_dir)
@@ -65,25 +101,25 @@ def convert_yolo_ultralytics_to_cvat(
         raise ValueError(f"Source directory does not exist: {src_dir}")
     if not src_dir.is_dir():
         raise ValueError(f"Source is not a directory: {src_dir}")
+    if annotations_only:
+        # packed images cannot be referenced through links to their directories
+        check_no_packed_images(src_dir, "referenced with --annotations-only")
 
     output_dir = Path(output_dir)
-    if not force:
-        if output_dir.exists():
-            raise ValueError("Output directory already exists")
-    else:
-        print("Output directory already exists. Removing existing output directory")
-        shutil.rmtree(str(output_dir), ignore_errors=True)
-        print("Creating new output directory")
+    prepare_output_dir(output_dir, force, incremental)
+    profiler = profiler or StageProfiler()
 
     data_yml_file = src_dir / "data.yaml"
     if not data_yml_file.exists():
         raise ValueError(f"data.yaml does not exist: {data_yml_file}")
 
     data_yml = read_yolo_data_yaml(data_yml_file)
-    ds_data = validate_dataset_folder(data_yml, src_dir)
+    with profiler.stage("read labels") as stage:
+        ds = validate_dataset_folder(data_yml, src_dir, workers=workers, cache=cache)
+        stage.items += len(ds)
 
     # Create output directory
-    output_dir.mkdir(parents=True, exist_ok=not force)
+    output_dir.mkdir(parents=True, exist_ok=True)
 
     # Write result to xml file
     annotation_xml_path = output_dir / "annotations.xml"
@@ -113,62 +149,125 @@ def convert_yolo_ultralytics_to_cvat(
     dumped_meta_el = ET.SubElement(meta_el, "dumped")
     dumped_meta_el.text = dt.datetime.today().strftime("%Y-%m-%d %H:%M:%S.%f%z")
 
-    # Start to process data and prepare to write to yaml file
-    for subset, data in ds_data.items():
-        # Create subset image output directory
-        subset_subset_imgs_out_dir = output_dir / "images" / subset
-        subset_subset_imgs_out_dir.mkdir(parents=True)
-
-        for idx, img_data in enumerate(data):
-            image_path = img_data["image"]
-            labels = img_data["labels"]
-
-            # Copy image to output subset dir
-            output_img_path = subset_subset_imgs_out_dir / Path(image_path).name
-            shutil.copyfile(image_path, output_img_path)
-
-            # Set image element's attributes
-            imw, imh = imagesize.get(str(image_path))
-            image_el = ET.SubElement(root, "image")
-            image_el.set("id", str(idx))
-            image_el.set("name", Path(image_path).name)
-            image_el.set("subset", subset)
-            image_el.set("width", str(imw))
-            image_el.set("height", str(imh))
-            image_el.set("z_order", "0")
-
-            # Append boxes to image
-            for label in labels:
-                # label: cls_id, xcn, ycn, bwn, bhn
-                x1, y1, x2, y2 = yolo2xyxy(
-                    *label[1:],
-                    imw,
-                    imh,
-                )
-
-                box_el = ET.SubElement(image_el, "box")
-                box_el.set("occluded", "0")
-                box_el.set("label", data_yml["names"][label[0]])
-                box_el.set("xtl", str(x1))
-                box_el.set("ytl", str(y1))
-                box_el.set("xbr", str(x2))
-                box_el.set("ybr", str(y2))
+    # Only the images which changed since the previous run are copied
+    manifest = OutputManifest(output_dir)
+
+    # Create subset image output directories
+    subset_dirs = [output_dir / "images" / subset for subset in ds.subsets]
+    for subset_dir in subset_dirs:
+        subset_dir.mkdir(parents=True, exist_ok=True)
+
+    # Reference images through the links to their source directories
+    links = [ImageDirLinks(subset_dir, manifest) for subset_dir in subset_dirs]
+
+    def probe_sizes(rows: np.ndarray) -> ColumnarDataset:
+        # Get image sizes, boxes of the batch are clipped to their image
+        ds.fill_image_sizes(workers, cache, rows=rows, verbose=False)
+        batch = ds.select(rows)
+        return batch.clip_boxes() if clip_boxes else batch
+
+    def transfer_images(batch: ColumnarDataset) -> ColumnarDataset:
+        if not annotations_only:
+            # Copy images to output subset dir
+            for i, img_path in enumerate(batch.image_paths()):
+                subset_dir = subset_dirs[batch.subset_ids[i]]
+                manifest.transfer(file_transfer, img_path, subset_dir / batch.file_names[i])
+        return batch
+
+    # Image sizes are probed, images transferred and annotations built at the
+    # same time, by batches of images of one subset. Batches come out of the
+    # pipeline in order, so images are written by subset with increasing ids
+    pipeline = Pipeline()
+    pipeline.add_stage("probe image sizes", probe_sizes)
+    pipeline.add_stage("queue transfers", transfer_images, workers=max(1, workers // 2))
+
+    with (
+        profiler.stage("pipeline"),
+        open_file_transfer(transfer, workers, output_dir) as file_transfer,
+    ):
+        subset_batches = (
+            rows
+            for subset_id in range(len(ds.subsets))
+            for rows in batch_rows(np.flatnonzero(ds.subset_ids == subset_id))
+        )
+        for batch in pipeline.run(subset_batches):
+            subset_id = int(batch.subset_ids[0])
+            subset = ds.subsets[subset_id]
+            if annotations_only:
+                image_names = links[subset_id].image_names(batch)
+            else:
+                image_names = batch.file_names.tolist()
+
+            xyxy_boxes = batch.boxes_as("xyxy")
+            box_offsets = batch.box_offsets.tolist()
+
+            with profiler.stage("build annotations", items=len(batch)):
+                for i, image_name in enumerate(image_names):
+                    # Set image element's attributes
+                    image_el = ET.SubElement(root, "image")
+                    image_el.set("id", str(batch.image_ids[i]))
+                    image_el.set("name", image_name)
+                    image_el.set("subset", subset)
+                    image_el.set("width", str(batch.widths[i]))
+                    image_el.set("height", str(batch.heights[i]))
+                    image_el.set("z_order", "0")
+
+                    # Append boxes to image
+                    start, end = box_offsets[i], box_offsets[i + 1]
+                    for cls_id, (x1, y1, x2, y2) in zip(
+                        batch.box_classes[start:end].tolist(),
+                        xyxy_boxes[start:end].tolist(),
+                    ):
+                        box_el = ET.SubElement(image_el, "box")
+                        box_el.set("occluded", "0")
+                        box_el.set("label", ds.names[cls_id])
+                        box_el.set("xtl", str(x1))
+                        box_el.set("ytl", str(y1))
+                        box_el.set("xbr", str(x2))
+                        box_el.set("ybr", str(y2))
+
+    pipeline.record(profiler, parent="pipeline")
+    profiler.record(
+        "transfer images",
+        file_transfer.time,
+        items=file_transfer.num_files,
+        nbytes=file_transfer.num_bytes,
+        parent="pipeline",
+    )
 
     # This is not beaultifuly indented
-    tree = ET.ElementTree(root)
-    ET.indent(tree)
-    tree.write(str(annotation_xml_path), encoding="utf-8", xml_declaration=True)
+    with profiler.stage("write annotations") as stage:
+        tree = ET.ElementTree(root)
+        ET.indent(tree)
+        tree.write(str(annotation_xml_path), encoding="utf-8", xml_declaration=True)
+        manifest.add(annotation_xml_path)
+    stage.bytes += annotation_xml_path.stat().st_size
+
+    with profiler.stage("finish manifest"):
+        manifest.finish()
 
 
 def main():
     args = get_args()
 
+    profiler = StageProfiler() if args.profile is not None else None
+
     convert_yolo_ultralytics_to_cvat(
         src_dir=args.src,
         output_dir=args.output,
         force=args.force,
+        incremental=args.incremental,
+        transfer=args.transfer,
+        workers=args.workers,
+        cache=not args.no_cache,
+        annotations_only=args.annotations_only,
+        clip_boxes=args.clip_boxes,
+        profiler=profiler,
     )
 
+    if profiler is not None:
+        profiler.finish(args.profile)
+
 
 if __name__ == "__main__":
     main()
@@ -8,14 +8,16 @@ current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
 sys.path.append(current_dir)
 
 
-import shutil
 from argparse import ArgumentParser
 from pathlib import Path
 
-from PIL import Image
-from utils.bbox_utils import yolo2xyxy
+from crop_utils import crop_dataset
+from utils.bbox_utils import add_box_args
+from utils.manifest_utils import OutputManifest, add_manifest_args, prepare_output_dir
+from utils.profile_utils import StageProfiler, add_profile_args
 from yolo_utils import read_yolo_data_yaml, validate_dataset_folder
 
+
 StrPath = str | Path
 
 
@@ -38,6 +40,26 @@ def get_args():
         action="store_true",
         help="Overwrite existing output directory",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of threads reading labels and processes cropping images",
+        default=4,
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the label and image metadata caches",
+    )
+    parser.add_argument(
+        "--max-size",
+        type=int,
+        help="Downscale crops so their longest side is at most this size",
+        default=None,
+    )
+    add_box_args(parser)
+    add_manifest_args(parser)
+    add_profile_args(parser)
 
     return parser.parse_args()
 
@@ -46,6 +68,12 @@ def convert_yolo_ultralytics_to_imagenet(
     src_dir: StrPath,
     output_dir: StrPath,
     force: bool = False,
+    incremental: bool = False,
+    workers: int = 4,
+    cache: bool = True,
+    max_size: int | None = None,
+    clip_boxes: bool = False,
+    profiler: StageProfiler | None = None,
 ):
     """Convert dataset from YOLO Ultralytics format to ImageNet format
 
@@ -56,6 +84,12 @@ def convert_yolo_ultralytics_to_imagenet(
         src_dir (StrPath): directory of the YOLO Ultralytics dataset
         output_dir (StrPath): directory of the output dataset
         force (bool, optional): Overwrite existing output directory. Defaults to False.
+        incremental (bool, optional): Update an output directory written by a previous run, only files whose source changed are rewritten. Defaults to False.
+        workers (int, optional): Number of threads reading labels and processes cropping images. Defaults to 4.
+        cache (bool, optional): Reuse labels and image sizes read by previous runs from the label cache of the source directory and the image metadata cache. Defaults to True.
+        max_size (int | None, optional): Downscale crops so their longest side is at most max_size, which allows reduced-resolution JPEG decode. Defaults to None.
+        clip_boxes (bool, optional): Clip boxes to their image and drop boxes left without area. Defaults to False.
+        profiler (StageProfiler | None, optional): Record the time, items, bytes and peak memory growth of every stage of the conversion. Defaults to None.
     """  # noqa: E501
 
     src_dir = Path(src_dir)
@@ -65,57 +99,55 @@ def convert_yolo_ultralytics_to_imagenet(
         raise ValueError(f"Source is not a directory: {src_dir}")
 
     output_dir = Path(output_dir)
-    if not force:
-        if output_dir.exists():
-            raise ValueError("Output directory already exists")
-    else:
-        print("Output directory already exists. Removing existing output directory")
-        shutil.rmtree(str(output_dir), ignore_errors=True)
-        print("Creating new output directory")
+    prepare_output_dir(output_dir, force, incremental)
+    profiler = profiler or StageProfiler()
 
     data_yml_file = src_dir / "data.yaml"
     if not data_yml_file.exists():
         raise ValueError(f"data.yaml does not exist: {data_yml_file}")
 
     data_yml = read_yolo_data_yaml(data_yml_file)
-    ds_data = validate_dataset_folder(data_yml, src_dir)
-
-    idx2name = {k: v for k, v in enumerate(data_yml.get("names"))}
-
-    for subset, data in ds_data.items():
-        subset_dir = output_dir / subset
+    with profiler.stage("read labels") as stage:
+        ds = validate_dataset_folder(data_yml, src_dir, workers=workers, cache=cache)
+        stage.items += len(ds)
 
-        # make dir for each class name
-        for class_name in data_yml.get("names"):
-            (subset_dir / class_name).mkdir(parents=True, exist_ok=True)
+    # Get image sizes, they are required to convert boxes to absolute corners
+    with profiler.stage("probe image sizes", items=len(ds)):
+        ds.fill_image_sizes(workers, cache)
 
-        # crop images
-        for img_data in data:
-            img_path = Path(img_data["image"])
-            labels = img_data["labels"]
+    # Clip boxes to their image and drop degenerate boxes, all at once
+    if clip_boxes:
+        ds = ds.clip_boxes()
 
-            img = Image.open(img_path)
-            imw, imh = img.size
-            for i, (cls_id, xc, yc, w, h) in enumerate(labels):
-                x1, y1, x2, y2 = yolo2xyxy(xc, yc, w, h, imw, imh)
-                roi = img.crop((x1, y1, x2, y2))
-
-                roi_save_path = (
-                    subset_dir / idx2name[cls_id] / f"{img_path.stem}_{i}.jpg"
-                )
-                roi.save(roi_save_path)
-                print(roi_save_path)
+    # Crop every box with a pool of processes, only the crops which changed
+    # since the previous run are written
+    manifest = OutputManifest(output_dir)
+    with profiler.stage("crop images", items=ds.num_boxes):
+        crop_dataset(ds, output_dir, workers=workers, max_size=max_size, manifest=manifest)
+    with profiler.stage("finish manifest"):
+        manifest.finish()
 
 
 def main():
     args = get_args()
 
+    profiler = StageProfiler() if args.profile is not None else None
+
     convert_yolo_ultralytics_to_imagenet(
         src_dir=args.src,
         output_dir=args.output,
         force=args.force,
+        incremental=args.incremental,
+        workers=args.workers,
+        cache=not args.no_cache,
+        max_size=args.max_size,
+        clip_boxes=args.clip_boxes,
+        profiler=profiler,
     )
 
+    if profiler is not None:
+        profiler.finish(args.profile)
+
 
 if __name__ == "__main__":
     main()
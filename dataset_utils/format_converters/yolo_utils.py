@@ -1,11 +1,24 @@
+import fnmatch
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterable, Iterator
 
+import numpy as np
 import yaml
+from columnar_utils import ColumnarBuilder, ColumnarDataset
+from utils.manifest_utils import ImageDirLinks, OutputManifest
+from utils.packed_utils import open_packed_images
+from utils.transfer_utils import FileTransfer
 
 StrPath = str | Path
 
 SUPPORTED_IMG_EXTS = ("jpg", "jpeg", "png")
 
+LABEL_CACHE_FILE = "labels.cache"
+
 
 def read_yolo_data_yaml(path: StrPath) -> dict:
     """Read data inside data.yaml file and return a dictionary
@@ -54,30 +67,333 @@ def read_yolo_data_yaml(path: StrPath) -> dict:
     return data
 
 
-def validate_dataset_folder(data_yml: dict, root_dir: StrPath, skip_missing: False) -> dict:
-    """_summary_
+def read_label_file(txt_path: StrPath) -> tuple[np.ndarray, np.ndarray]:
+    """Read a YOLO label file
+
+    Args:
+        txt_path (StrPath): path to the label file
+
+    Raises:
+        ValueError: if a line does not contain cls_id, xcn, ycn, bwn, bhn
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: boxes [xcn, ycn, bwn, bhn] of shape (n, 4)
+            and class ids of shape (n,)
+    """
+
+    with open(txt_path, "r") as f:
+        labels = [l.split() for l in f if l.strip() != ""]
+
+    if len(labels) == 0:
+        return np.empty((0, 4), dtype=np.float64), np.empty(0, dtype=np.int32)
+
+    if any(len(label) != 5 for label in labels):
+        raise ValueError(f"Label file {txt_path} must have 5 values per line")
+
+    values = np.array(labels, dtype=np.float64)
+
+    # cls_id is int, not float
+    return values[:, 1:], values[:, 0].astype(np.int32)
+
+
+class YoloLabelCache:
+    """Binary cache of the parsed label files of a YOLO dataset
+
+    The cache is a single numpy archive in the dataset directory with the
+    boxes and class ids of all label files packed in two arrays, an offset
+    index into them and the (size, mtime) of every file when it was parsed.
+    A label file is parsed again only when its size or mtime changed.
+
+    The cache only keeps the files read by the last run, and it is rebuilt
+    from scratch when it cannot be read or was written by another version.
+
+    Example:
+        cache = YoloLabelCache(root_dir)
+        boxes, classes = cache.read(txt_path)
+        cache.save()
+    """
+
+    VERSION = 1
+
+    def __init__(self, root_dir: StrPath):
+        self.root_dir = Path(root_dir)
+        self.path = self.root_dir / LABEL_CACHE_FILE
+        self.num_hits = 0
+        self.num_misses = 0
+
+        self._prefix = self.root_dir.as_posix() + "/"
+        self._lock = threading.Lock()
+        self._index: dict[str, int] = {}
+        self._fingerprints = np.empty((0, 2), dtype=np.int64)
+        self._boxes = np.empty((0, 4), dtype=np.float64)
+        self._classes = np.empty(0, dtype=np.int32)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._used: dict[str, tuple[int, int, np.ndarray, np.ndarray]] = {}
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if int(data["version"]) != self.VERSION:
+                    raise ValueError(f"version {int(data['version'])}")
+
+                keys = data["keys"].tobytes().decode("utf-8").split("\n")
+                fingerprints = data["fingerprints"]
+                boxes = data["boxes"]
+                classes = data["classes"]
+                offsets = data["offsets"]
+
+            if not (
+                len(keys) == len(fingerprints) == len(offsets) - 1
+                and offsets[-1] == len(boxes) == len(classes)
+            ):
+                raise ValueError("inconsistent arrays")
+        except Exception as e:
+            print(f"Ignoring invalid label cache {self.path}: {e}")
+            return
+
+        self._fingerprints = fingerprints
+        self._boxes = boxes
+        self._classes = classes
+        self._offsets = offsets
+        self._index = {key: i for i, key in enumerate(keys) if key}
+
+    def _key(self, txt_path: str) -> str:
+        # keys are relative to the dataset, so the cache survives moving it
+        if txt_path.startswith(self._prefix):
+            return txt_path[len(self._prefix) :]
+        return txt_path
+
+    def read(self, txt_path: StrPath) -> tuple[np.ndarray, np.ndarray]:
+        """Read a label file from the cache, or parse it if it changed
+
+        Same as `read_label_file`, this method can be called from many threads.
+        """
+
+        txt_path = os.fspath(txt_path)
+        key = self._key(txt_path)
+        st = os.stat(txt_path)
+
+        i = self._index.get(key)
+        fingerprint = (st.st_size, st.st_mtime_ns)
+        if i is not None and tuple(self._fingerprints[i].tolist()) == fingerprint:
+            start, end = self._offsets[i], self._offsets[i + 1]
+            boxes, classes = self._boxes[start:end], self._classes[start:end]
+            hit = True
+        else:
+            boxes, classes = read_label_file(txt_path)
+            hit = False
+
+        with self._lock:
+            self._used[key] = (*fingerprint, boxes, classes)
+            self.num_hits += hit
+            self.num_misses += not hit
+
+        return boxes, classes
+
+    def save(self):
+        """Write the label files read since the cache was loaded
+
+        Nothing is written when every file was a hit and none was removed. A
+        cache that cannot be written (e.g. read-only dataset) is only reported.
+        """
+
+        if self.num_misses == 0 and len(self._used) == len(self._index):
+            return
+
+        keys = list(self._used)
+        values = list(self._used.values())
+        counts = np.array([len(v[3]) for v in values], dtype=np.int64)
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        tmp_path = self.path.with_name(f".{LABEL_CACHE_FILE}.{os.getpid()}.tmp")
+        try:
+            with tmp_path.open("wb") as f:
+                np.savez(
+                    f,
+                    version=np.array(self.VERSION),
+                    keys=np.frombuffer("\n".join(keys).encode("utf-8"), dtype=np.uint8),
+                    fingerprints=np.array(
+                        [(v[0], v[1]) for v in values], dtype=np.int64
+                    ).reshape(-1, 2),
+                    boxes=np.concatenate(
+                        [np.empty((0, 4), dtype=np.float64)] + [v[2] for v in values]
+                    ),
+                    classes=np.concatenate(
+                        [np.empty(0, dtype=np.int32)] + [v[3] for v in values]
+                    ),
+                    offsets=offsets,
+                )
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Cannot write label cache {self.path}: {e}")
+            tmp_path.unlink(missing_ok=True)
+
+
+def _list_dir(path: str) -> list[str]:
+    """Return the names of the entries of a directory in listing order"""
+    try:
+        with os.scandir(path) as it:
+            return [entry.name for entry in it]
+    except FileNotFoundError:
+        return []
+
+
+def _list_label_dir(path: str) -> set[str]:
+    """Return the names of the existing entries of a labels directory
+
+    Broken symlinks are left out, like `Path.exists()` does.
+    """
+    try:
+        with os.scandir(path) as it:
+            return {
+                entry.name
+                for entry in it
+                if not entry.is_symlink() or os.path.exists(entry.path)
+            }
+    except FileNotFoundError:
+        return set()
+
+
+def _label_name(img_name: str) -> str:
+    """Return the label file name of an image, same as Path.with_suffix(".txt")"""
+    i = img_name.rfind(".")
+    if 0 < i < len(img_name) - 1:
+        img_name = img_name[:i]
+    return img_name + ".txt"
+
+
+class _LabelDirs:
+    """Resolve label files of images with one listing per labels directory"""
+
+    def __init__(self):
+        self._listings: dict[Path, tuple[str, set[str]]] = {}
+
+    def find(self, img_dir: Path, img_name: str) -> tuple[str, bool]:
+        """Return the label file of an image and whether it exists
+
+        The label file is the image path with "/images/" replaced by "/labels/"
+        and its suffix replaced by ".txt".
+        """
+        listing = self._listings.get(img_dir)
+        if listing is None:
+            label_dir = (img_dir.as_posix() + "/").replace("/images/", "/labels/")
+            listing = self._listings[img_dir] = (label_dir, _list_label_dir(label_dir))
+
+        label_dir, names = listing
+        label_name = _label_name(img_name)
+        return label_dir + label_name, label_name in names
+
+
+def _iter_label_files(
+    txt_paths: Iterable[StrPath],
+    workers: int = 1,
+    cache: YoloLabelCache | None = None,
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """Read label files with a pool of threads, results are yielded in order
+
+    At most `workers * 16` files are read ahead, so memory stays bounded
+    whatever the number of files.
+    """
+
+    read = cache.read if cache is not None else read_label_file
+
+    if workers <= 1:
+        for txt_path in txt_paths:
+            yield read(txt_path)
+        return
+
+    max_pending = workers * 16
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="labels") as pool:
+        pending = deque()
+        for txt_path in txt_paths:
+            pending.append(pool.submit(read, txt_path))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def _add_subset_images(
+    result: ColumnarBuilder,
+    subset: str,
+    images: list[tuple[Path, str]],
+    skip_missing: bool,
+    workers: int,
+    cache: YoloLabelCache | None,
+):
+    """Check label files of images and add the images with their labels to result
+
+    Labels are checked against one listing per labels directory instead of a
+    stat call per image, then label files are parsed by `workers` threads.
+    Errors are raised for the first faulty image in order, exactly like
+    reading the images one by one.
+
+    Args:
+        images (list[tuple[Path, str]]): directory and file name of every image
+    """
+
+    label_dirs = _LabelDirs()
+    items = [
+        (img_dir, img_name, *label_dirs.find(img_dir, img_name))
+        for img_dir, img_name in images
+    ]
+
+    labels = _iter_label_files(
+        (txt_path for _, _, txt_path, exists in items if exists), workers, cache
+    )
+    for img_dir, img_name, txt_path, exists in items:
+        if not exists:
+            if not skip_missing:
+                raise ValueError(f"Label file {txt_path} not found")
+
+            continue
+
+        boxes, classes = next(labels)
+        result.add_image(
+            file_name=img_name,
+            dir_path=img_dir,
+            subset=subset,
+            boxes=boxes,
+            box_classes=classes,
+        )
+
+
+def validate_dataset_folder(
+    data_yml: dict,
+    root_dir: StrPath,
+    skip_missing: bool = False,
+    workers: int = 1,
+    cache: bool = False,
+) -> ColumnarDataset:
+    """Validate YOLO dataset folder and read all labels
+
+    Every images and labels directory is listed once, and label files are
+    parsed by a pool of threads when workers > 1. Images can be stored in a
+    packed image store at the root of the dataset (see utils.packed_utils),
+    the sizes of these images are then read from its index. Their image
+    paths are not files, they are read from the store through
+    utils.packed_utils.find_packed_image.
 
     Args:
         data_yml (dict): data inside yaml file
         root_dir (StrPath): path to dataset directory
         skip_missing (bool, optional): skip missing images. Defaults to False.
+        workers (int, optional): number of threads parsing label files. Defaults to 1.
+        cache (bool, optional): reuse the labels parsed by previous runs from
+            the label cache in root_dir, see YoloLabelCache. Defaults to False.
 
     Raises:
         ValueError: description about the error
     Returns:
-        dict: {
-            "<subset>": [
-                {
-                    "image": <path_to_image>,
-                    "labels": [
-                        [cls_id, xcn, ycn, bwn, bhn],
-                        ...
-                    ],
-                },
-                ...
-            ],
-            ...
-        }
+        ColumnarDataset: images of all subsets with boxes in "yolo" format
+            [xcn, ycn, bwn, bhn]. Image sizes are unknown (-1) unless the
+            images are packed.
     """
 
     root_dir = Path(root_dir)
@@ -103,16 +419,15 @@ def validate_dataset_folder(data_yml: dict, root_dir: StrPath, skip_missing: Fal
             f"Dataset set contains invalid subsets: {subsets - allowed_subsets}"
         )
 
-    result = {}
+    result = ColumnarBuilder(names=data_yml["names"], box_format="yolo")
+    label_cache = YoloLabelCache(root_dir) if cache else None
+    packed = open_packed_images(root_dir)
 
     # There are two kind of data in data.yaml file.
     # First, the subset key contains relative path to subset images directory
     # Second, the subset key contains relative path to the file which contains
     # relative paths to subset image path
     for subset in subsets:
-        if subset not in result:
-            result[subset] = []
-
         if data_yml[subset].endswith(".txt"):
             # Second type
             print("Second type of data.yaml")
@@ -140,37 +455,28 @@ def validate_dataset_folder(data_yml: dict, root_dir: StrPath, skip_missing: Fal
                         f"Image path inside {subset_txt} is absolute: {test_path}"
                     )
 
-                test_path = root_dir / test_path
-                if test_path.exists() is False:
-                    raise ValueError(f"Image path does not exist: {test_path}")
+                # Packed images are only in the store
+                if packed is None or packed.find(test_path.as_posix()) < 0:
+                    test_path = root_dir / test_path
+                    if test_path.exists() is False:
+                        raise ValueError(f"Image path does not exist: {test_path}")
 
-                if not test_path.is_file():
-                    raise ValueError(f"Image path is not a file: {test_path}")
+                    if not test_path.is_file():
+                        raise ValueError(f"Image path is not a file: {test_path}")
 
                 # For each image, check label in txt file and append labels to result
-                for img_path in img_paths:
-                    img_path = root_dir / img_path
-
-                    txt_path = Path(
-                        img_path.as_posix().replace("/images/", "/labels/")
-                    ).with_suffix(".txt")
-                    if not txt_path.exists():
-                        raise ValueError(f"Label file {txt_path} not found")
-
-                    with txt_path.open("r") as f:
-                        labels = [l.strip().split(" ") for l in f if l.strip() != ""]
-
-                        # cls_id is int, not float
-                        for i in range(len(labels)):
-                            labels[i] = list(map(float, labels[i]))
-                            labels[i][0] = int(labels[i][0])
-
-                        result[subset].append(
-                            {
-                                "image": str(img_path),
-                                "labels": labels,
-                            }
-                        )
+                # Missing labels are never skipped with this type of data.yaml
+                _add_subset_images(
+                    result,
+                    subset,
+                    [
+                        (img_path.parent, img_path.name)
+                        for img_path in (root_dir / e for e in img_paths)
+                    ],
+                    skip_missing=False,
+                    workers=workers,
+                    cache=label_cache,
+                )
         else:
             # First type
             print("First type of data.yaml")
@@ -190,39 +496,146 @@ def validate_dataset_folder(data_yml: dict, root_dir: StrPath, skip_missing: Fal
                     f"Subset images path is not a directory: {subset_imgs_path}"
                 )
 
-            # List all images inside images directory
+            # List all images inside images directory, in the same order as
+            # globbing every extension one after the other
+            names = _list_dir(subset_imgs_path)
+            if packed is not None:
+                names += packed.list_dir(data_yml[subset])
             img_paths = []
             for ext in SUPPORTED_IMG_EXTS:
-                _img_paths = list(subset_imgs_path.glob(f"*.{ext}"))
-                img_paths.extend(_img_paths)
+                _img_names = fnmatch.filter(names, f"*.{ext}")
+                img_paths.extend((subset_imgs_path, name) for name in _img_names)
 
             if len(img_paths) == 0:
                 raise ValueError(f"No image found in subset {subset}")
 
             # For each image, check label in txt file and append labels to result
-            for img_path in img_paths:
-                txt_path = Path(
-                    img_path.as_posix().replace("/images/", "/labels/")
-                ).with_suffix(".txt")
-                if not txt_path.exists():
-                    if not skip_missing:
-                        raise ValueError(f"Label file {txt_path} not found")
-
-                    continue
-
-                with txt_path.open("r") as f:
-                    labels = [l.strip().split(" ") for l in f if l.strip() != ""]
-
-                    # cls_id is int, not float
-                    for i in range(len(labels)):
-                        labels[i] = list(map(float, labels[i]))
-                        labels[i][0] = int(labels[i][0])
-
-                    result[subset].append(
-                        {
-                            "image": str(img_path),
-                            "labels": labels,
-                        }
+            _add_subset_images(
+                result, subset, img_paths, skip_missing, workers, label_cache
+            )
+
+    if label_cache is not None:
+        print(
+            f"Label cache: {label_cache.num_hits} files reused, "
+            f"{label_cache.num_misses} files parsed"
+        )
+        label_cache.save()
+
+    ds = result.build()
+
+    # Sizes of packed images are read from the index of the store
+    if packed is not None:
+        with packed:
+            rows = packed.find_all(
+                os.path.relpath(img_path, root_dir).replace(os.sep, "/")
+                for img_path in ds.image_paths()
+            )
+            found = rows >= 0
+            ds.widths[found] = packed.widths[rows[found]]
+            ds.heights[found] = packed.heights[rows[found]]
+
+    return ds
+
+
+def write_yolo_dataset(
+    ds: ColumnarDataset,
+    output_dir: StrPath,
+    file_transfer: FileTransfer,
+    manifest: OutputManifest,
+    annotations_only: bool = False,
+):
+    """Write a dataset in YOLO Ultralytics format
+
+    Images are transferred to <output_dir>/images/<subset>/ and the boxes of
+    each image are written to <output_dir>/labels/<subset>/<image stem>.txt,
+    images without boxes get an empty label file. Polygons and tags are not
+    written.
+
+    With annotations_only, images are not transferred: every source directory
+    is linked to <output_dir>/images/<link>/, labels are written to
+    <output_dir>/labels/<link>/ and the images of each subset are listed in
+    <output_dir>/<subset>.txt, the second type of data.yaml.
+
+    Args:
+        ds (ColumnarDataset): dataset to write, image sizes are required
+            unless boxes are in "yolo" format
+        output_dir (StrPath): directory of the output dataset
+        file_transfer (FileTransfer): transfer of the images
+        manifest (OutputManifest): manifest of the output directory, only
+            the files which changed are written
+        annotations_only (bool, optional): reference the source images
+            instead of transferring them. Defaults to False.
+    """
+
+    output_dir = Path(output_dir)
+    out_imgs_dir = output_dir / "images"
+    out_labels_dir = output_dir / "labels"
+
+    # Convert all boxes at once
+    yolo_boxes = ds.boxes_as("yolo").tolist()
+    box_classes = ds.box_classes.tolist()
+    box_offsets = ds.box_offsets.tolist()
+
+    # Path of every image relative to the images and labels directories
+    if annotations_only:
+        img_names = ImageDirLinks(out_imgs_dir, manifest).image_names(ds)
+    else:
+        img_names = [
+            f"{ds.subsets[subset_id]}/{file_name}"
+            for subset_id, file_name in zip(ds.subset_ids.tolist(), ds.file_names.tolist())
+        ]
+
+    subsets: list[str] = []
+    label_dirs: set[str] = set()
+    for subset_id, subset in enumerate(ds.subsets):
+        rows = np.flatnonzero(ds.subset_ids == subset_id).tolist()
+        if len(rows) == 0:
+            continue
+        subsets.append(subset)
+
+        if not annotations_only:
+            (out_imgs_dir / subset).mkdir(parents=True, exist_ok=True)
+
+        for i in rows:
+            img_name = img_names[i]
+            if not annotations_only:
+                manifest.transfer(file_transfer, ds.image_path(i), out_imgs_dir / img_name)
+
+            label_dir, file_name = os.path.split(img_name)
+            if label_dir not in label_dirs:
+                (out_labels_dir / label_dir).mkdir(parents=True, exist_ok=True)
+                label_dirs.add(label_dir)
+
+            start, end = box_offsets[i], box_offsets[i + 1]
+            manifest.write_text(
+                out_labels_dir / label_dir / _label_name(file_name),
+                "".join(
+                    f"{cls_id} {xc} {yc} {w} {h}\n"
+                    for cls_id, (xc, yc, w, h) in zip(
+                        box_classes[start:end], yolo_boxes[start:end]
                     )
+                ),
+            )
+
+        # List the images of the subset, relative to the dataset directory
+        if annotations_only:
+            manifest.write_text(
+                output_dir / f"{subset}.txt",
+                "".join(f"./images/{img_names[i]}\n" for i in rows),
+            )
+
+    # Create data.yaml file
+    data_yml = {}
+    for subset in subsets:
+        data_yml[subset] = f"./{subset}.txt" if annotations_only else f"./images/{subset}"
+
+    data_yml.update(
+        {
+            "nc": len(ds.names),
+            "names": dict(enumerate(ds.names)),
+        }
+    )
 
-    return result
+    with open(output_dir / "data.yaml", "w") as f:
+        yaml.dump(data_yml, f, sort_keys=False)
+    manifest.add(output_dir / "data.yaml")
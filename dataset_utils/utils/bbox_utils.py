@@ -1,3 +1,19 @@
+from argparse import ArgumentParser
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+
+def add_box_args(parser: ArgumentParser):
+    """Add the --clip-boxes argument to a converter parser"""
+
+    parser.add_argument(
+        "--clip-boxes",
+        action="store_true",
+        help="Clip boxes to their image and drop boxes left without area",
+    )
+
+
 def xywh2yolo(
     x1: int,
     y1: int,
@@ -54,3 +70,90 @@ def xywh2xyxy(
     x2 = x1 + box_w
     y2 = y1 + box_h
     return x1, y1, x2, y2
+
+
+# Array versions of the functions above, they take boxes of shape (N, 4) and
+# image sizes which are either scalars or arrays of shape (N,), one per box.
+# All the boxes of a dataset are converted with one call.
+
+
+def _as_boxes(boxes: np.ndarray) -> np.ndarray:
+    boxes = np.asarray(boxes, dtype=np.float64)
+    if boxes.ndim != 2 or boxes.shape[1] != 4:
+        raise ValueError(f"Boxes must have shape (N, 4), got {boxes.shape}")
+    return boxes
+
+
+def xywh2yolo_array(boxes: np.ndarray, img_w: ArrayLike, img_h: ArrayLike) -> np.ndarray:
+    boxes = _as_boxes(boxes)
+    out = np.empty_like(boxes)
+    out[:, 0] = (boxes[:, 0] + boxes[:, 2] / 2) / img_w
+    out[:, 1] = (boxes[:, 1] + boxes[:, 3] / 2) / img_h
+    out[:, 2] = boxes[:, 2] / img_w
+    out[:, 3] = boxes[:, 3] / img_h
+    return out
+
+
+def yolo2xyxy_array(boxes: np.ndarray, img_w: ArrayLike, img_h: ArrayLike) -> np.ndarray:
+    boxes = _as_boxes(boxes)
+    out = np.empty_like(boxes)
+    out[:, 0] = (boxes[:, 0] - boxes[:, 2] / 2) * img_w
+    out[:, 1] = (boxes[:, 1] - boxes[:, 3] / 2) * img_h
+    out[:, 2] = (boxes[:, 0] + boxes[:, 2] / 2) * img_w
+    out[:, 3] = (boxes[:, 1] + boxes[:, 3] / 2) * img_h
+    return out
+
+
+def yolo2xywh_array(boxes: np.ndarray, img_w: ArrayLike, img_h: ArrayLike) -> np.ndarray:
+    return xyxy2xywh_array(yolo2xyxy_array(boxes, img_w, img_h))
+
+
+def xywh2xyxy_array(boxes: np.ndarray) -> np.ndarray:
+    boxes = _as_boxes(boxes)
+    out = boxes.copy()
+    out[:, 2] = boxes[:, 0] + boxes[:, 2]
+    out[:, 3] = boxes[:, 1] + boxes[:, 3]
+    return out
+
+
+def xyxy2xywh_array(boxes: np.ndarray) -> np.ndarray:
+    boxes = _as_boxes(boxes)
+    out = boxes.copy()
+    out[:, 2] = boxes[:, 2] - boxes[:, 0]
+    out[:, 3] = boxes[:, 3] - boxes[:, 1]
+    return out
+
+
+def xyxy2yolo_array(boxes: np.ndarray, img_w: ArrayLike, img_h: ArrayLike) -> np.ndarray:
+    return xywh2yolo_array(xyxy2xywh_array(boxes), img_w, img_h)
+
+
+def clip_boxes_xyxy(
+    boxes: np.ndarray,
+    img_w: ArrayLike,
+    img_h: ArrayLike,
+    min_size: float = 1.0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Clip boxes to their image and find the boxes which keep an area
+
+    Args:
+        boxes (np.ndarray): boxes (x1, y1, x2, y2) in pixels, shape (N, 4)
+        img_w (ArrayLike): image width, a scalar or one per box
+        img_h (ArrayLike): image height, a scalar or one per box
+        min_size (float, optional): boxes narrower or lower than min_size pixels once clipped are degenerate. Defaults to 1.0.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: clipped boxes of shape (N, 4) and a
+            boolean mask of shape (N,) of the boxes which are not degenerate
+    """  # noqa: E501
+
+    boxes = _as_boxes(boxes)
+    out = np.empty_like(boxes)
+    np.clip(boxes[:, 0], 0, img_w, out=out[:, 0])
+    np.clip(boxes[:, 1], 0, img_h, out=out[:, 1])
+    np.clip(boxes[:, 2], 0, img_w, out=out[:, 2])
+    np.clip(boxes[:, 3], 0, img_h, out=out[:, 3])
+
+    # NaN boxes compare False and are dropped as well
+    keep = (out[:, 2] - out[:, 0] >= min_size) & (out[:, 3] - out[:, 1] >= min_size)
+    return out, keep
@@ -0,0 +1,271 @@
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+
+import imagesize
+from PIL import Image
+from utils.packed_utils import open_image
+
+StrPath = str | Path
+
+# Path of the cache database, can be changed with the IMAGE_META_CACHE
+# environment variable
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "dataset_utils" / "image_meta.sqlite3"
+
+# EXIF tag of the image orientation, 1 means no rotation
+EXIF_ORIENTATION = 0x0112
+
+# Number of images looked up and written to the database at once
+_BATCH_SIZE = 4096
+
+# Maximum number of variables in one sqlite statement
+_MAX_SQL_VARS = 500
+
+
+# EXIF orientations rotating the image by 90 or 270 degrees
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+@dataclass
+class ImageMeta:
+    """Metadata of an image
+
+    width and height are the size of the image once the EXIF orientation is
+    applied, like imagesize returns them.
+    """
+
+    width: int
+    height: int
+    format: str
+    orientation: int = 1
+
+
+def oriented_size(img: Image.Image) -> tuple[int, int, int]:
+    """Return the width and height of an open image once its EXIF orientation is applied, and the orientation"""  # noqa: E501
+
+    width, height = img.size
+    orientation = int(img.getexif().get(EXIF_ORIENTATION, 1))
+    if orientation in _TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    return width, height, orientation
+
+
+def probe_image(path: StrPath) -> ImageMeta:
+    """Read the size, format and EXIF orientation of an image from its header
+
+    The pixels are not decoded. Files that Pillow cannot identify are probed
+    with imagesize, their format is empty and the size is -1 if unknown.
+    Images of a packed store are probed from the store, see
+    utils.packed_utils.find_packed_image.
+
+    Args:
+        path (StrPath): path to the image
+
+    Returns:
+        ImageMeta: metadata of the image
+    """
+
+    try:
+        with open_image(path) as img:
+            width, height, orientation = oriented_size(img)
+            return ImageMeta(width, height, img.format or "", orientation)
+    except (OSError, SyntaxError, ValueError):
+        width, height = imagesize.get(os.fspath(path))
+        return ImageMeta(width, height, "")
+
+
+def _fingerprint(path: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class ImageMetaCache:
+    """Persistent cache of image metadata in a sqlite database
+
+    Metadata are keyed by the absolute path of the image and are valid as
+    long as the size and mtime of the file do not change, so repeated scans of
+    a dataset only stat the images. Images that are not in the cache are
+    probed by a pool of threads, the database is only used from the calling
+    thread.
+
+    Example:
+        with ImageMetaCache() as cache:
+            metas = cache.get(img_paths, workers=8)
+    """
+
+    def __init__(self, db_path: StrPath | None = None, verbose: bool = True):
+        if db_path is None:
+            db_path = os.environ.get("IMAGE_META_CACHE") or DEFAULT_CACHE_PATH
+
+        self.db_path = Path(db_path)
+        self.verbose = verbose
+        self.num_hits = 0
+        self.num_misses = 0
+
+        try:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path)
+            self._init_db()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Cannot open image metadata cache {self.db_path}: {e}")
+            self._conn = sqlite3.connect(":memory:")
+            self._init_db()
+
+    def _init_db(self):
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS image_meta (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                format TEXT NOT NULL,
+                orientation INTEGER NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.commit()
+
+    def _lookup(self, paths: list[str]) -> dict[str, tuple]:
+        rows = {}
+        for i in range(0, len(paths), _MAX_SQL_VARS):
+            chunk = paths[i : i + _MAX_SQL_VARS]
+            placeholders = ",".join("?" * len(chunk))
+            for row in self._conn.execute(
+                "SELECT path, size, mtime_ns, width, height, format, orientation "
+                f"FROM image_meta WHERE path IN ({placeholders})",
+                chunk,
+            ):
+                rows[row[0]] = row[1:]
+        return rows
+
+    def _get_batch(
+        self,
+        paths: list[str],
+        pool: ThreadPoolExecutor | None,
+    ) -> list[ImageMeta]:
+        _map = pool.map if pool is not None else map
+
+        fingerprints = list(_map(_fingerprint, paths))
+        rows = self._lookup(paths)
+
+        result: list[ImageMeta | None] = [None] * len(paths)
+        misses = []
+        for i, (path, fingerprint) in enumerate(zip(paths, fingerprints)):
+            row = rows.get(path)
+            if row is not None and row[:2] == fingerprint:
+                result[i] = ImageMeta(*row[2:])
+            else:
+                misses.append(i)
+
+        metas = list(_map(probe_image, [paths[i] for i in misses]))
+        updates = []
+        for i, meta in zip(misses, metas):
+            result[i] = meta
+            # missing files are probed (size -1) but never cached
+            if fingerprints[i] is not None:
+                updates.append(
+                    (
+                        paths[i],
+                        *fingerprints[i],
+                        meta.width,
+                        meta.height,
+                        meta.format,
+                        meta.orientation,
+                    )
+                )
+
+        if updates:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO image_meta VALUES (?, ?, ?, ?, ?, ?, ?)",
+                updates,
+            )
+            self._conn.commit()
+
+        self.num_hits += len(paths) - len(misses)
+        self.num_misses += len(misses)
+        return result
+
+    def get(self, paths: Iterable[StrPath], workers: int = 8) -> list[ImageMeta]:
+        """Return the metadata of images, in the same order as paths
+
+        Args:
+            paths (Iterable[StrPath]): paths to the images
+            workers (int, optional): number of threads probing the images not
+                in the cache. Defaults to 8.
+
+        Returns:
+            list[ImageMeta]: metadata of every image
+        """
+
+        paths = [os.path.abspath(p) for p in paths]
+
+        pool = None
+        if workers > 1:
+            pool = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="image_meta"
+            )
+
+        result = []
+        try:
+            for i in range(0, len(paths), _BATCH_SIZE):
+                result.extend(self._get_batch(paths[i : i + _BATCH_SIZE], pool))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        if self.verbose and paths:
+            print(
+                f"Image metadata: {self.num_hits} cached, {self.num_misses} probed"
+            )
+
+        return result
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self) -> "ImageMetaCache":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_image_metas(
+    paths: Iterable[StrPath],
+    workers: int = 8,
+    cache: bool = True,
+    verbose: bool = True,
+) -> list[ImageMeta]:
+    """Return the metadata of images, using the persistent cache by default
+
+    Args:
+        paths (Iterable[StrPath]): paths to the images
+        workers (int, optional): number of threads probing images. Defaults to 8.
+        cache (bool, optional): read and update the metadata cache, see
+            ImageMetaCache. Defaults to True.
+        verbose (bool, optional): print the number of cached and probed
+            images. Defaults to True.
+
+    Returns:
+        list[ImageMeta]: metadata of every image, in the same order as paths
+    """
+
+    if not cache:
+        paths = list(paths)
+        if workers <= 1:
+            return [probe_image(p) for p in paths]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(probe_image, paths))
+
+    with ImageMetaCache(verbose=verbose) as meta_cache:
+        return meta_cache.get(paths, workers)
@@ -1,8 +1,12 @@
+import os
 from pathlib import Path
+from typing import Iterator
 
-import imagesize
 import yaml
+from image_meta_utils import ImageMetaCache, get_image_metas
 from loguru import logger
+from manifest_utils import MANIFEST_FILE
+from packed_utils import PACK_FILES, open_packed_images
 
 
 def read_data_yaml(path: Path) -> dict:
@@ -54,11 +58,202 @@ def read_data_yaml(path: Path) -> dict:
     return data
 
 
-def read_imagenet(dataset_dir: Path) -> dict:
+class ImagenetReader:
+    """Read an imagenet folder lazily
+
+    Class names and subsets are known as soon as the reader is created, only
+    data.yaml and the subset and class directories are read. Images are
+    listed by iter_images while they are consumed, and their sizes are only
+    probed when asked for, in batches through the metadata cache. Images of a
+    packed image store at the root (see packed_utils) are listed as well.
+
+    Example:
+        reader = ImagenetReader(dataset_dir)
+        for img in reader.iter_images("train"):
+            print(img["file_path"], img["label"])
+    """
+
+    def __init__(self, dataset_dir: Path, workers: int = 8, cache: bool = True):
+        """
+        Args:
+            dataset_dir (Path): path to imagenet folder
+            workers (int, optional): number of threads reading image sizes. Defaults to 8.
+            cache (bool, optional): use the image metadata cache. Defaults to True.
+        """
+
+        dataset_dir = Path(dataset_dir)
+        if not dataset_dir.exists():
+            logger.error("Dataset directory does not exist: %s" % dataset_dir)
+            raise ValueError(f"Dataset directory does not exist: {dataset_dir}")
+
+        if not dataset_dir.is_dir():
+            logger.error("Dataset is not a directory: %s" % dataset_dir)
+            raise ValueError(f"Dataset is not a directory: {dataset_dir}")
+
+        self.dataset_dir = dataset_dir
+        self.workers = workers
+        self.cache = cache
+
+        class_names: list | None = None
+        subsets = set()
+
+        # read data.yaml file if exist
+        data_yaml_path = dataset_dir / "data.yaml"
+        if data_yaml_path.exists():
+            logger.info("Found data.yaml file: %s" % data_yaml_path)
+            data_yaml = read_data_yaml(data_yaml_path)
+
+            class_names = data_yaml["names"]
+            subsets = set(data_yaml.keys())
+            subsets.remove("names")
+            subsets.remove("nc")
+
+            logger.info("data.yaml file read successfully")
+
+        logger.info("Class names: %s" % class_names)
+        logger.info("Subsets: %s" % subsets)
+
+        # Class directories of every subset, their images are listed by iter_images
+        self.label_dirs: dict[str, list[Path]] = {}
+
+        # List all directories inside dataset_dir, which is subsets
+        for subset in dataset_dir.iterdir():
+            if not subset.is_dir():
+                if subset.name not in ["data.yaml", "data.yml", MANIFEST_FILE, *PACK_FILES]:
+                    logger.error("Dataset subset is not a directory: %s" % subset)
+                    raise ValueError(f"Dataset is not a directory: {subset}")
+                else:
+                    # skip data.yaml, manifest and packed image store files, the
+                    # images of the store are listed with their class directory
+                    continue
+
+            subsets.add(subset.name)
+
+            label_dirs = []
+            for label in subset.iterdir():
+                if not label.is_dir():
+                    logger.error(
+                        "Dataset subset label is not a directory: %s" % label,
+                    )
+                    raise ValueError(
+                        f"Dataset subset label is not a directory: {label}",
+                    )
+
+                label_dirs.append(label)
+
+            _names = [label.name for label in label_dirs]
+            if class_names is None:
+                class_names = _names
+            else:
+                # if class_names is not none, check if names of each directory are the same
+                if set(class_names).difference(set(_names)):
+                    logger.error("Class names are not the same: %s" % _names)
+                    raise ValueError(
+                        f"Class names are not the same: {class_names} != {_names}",
+                    )
+
+            self.label_dirs[subset.name] = label_dirs
+
+        self.names: list[str] = list(class_names or set())
+        self.subsets: set[str] = subsets
+
+    def iter_images(
+        self,
+        subset: str,
+        sizes: bool = False,
+        batch_size: int = 4096,
+    ) -> Iterator[dict]:
+        """Yield the images of a subset while its class directories are listed
+
+        Args:
+            subset (str): subset of the images
+            sizes (bool, optional): read the width and height of the images,
+                batch_size images at a time. Defaults to False.
+            batch_size (int, optional): number of images listed and probed
+                before they are yielded. Defaults to 4096.
+
+        Yields:
+            dict: {"file_path", "filename", "label", "id"}, and "width" and
+                "height" with sizes, id is the index of the image in its subset
+        """
+
+        # One metadata cache is used for all the batches
+        meta_cache = ImageMetaCache(verbose=False) if sizes and self.cache else None
+
+        def probe(batch: list[dict]) -> list[dict]:
+            if sizes:
+                paths = [img["file_path"] for img in batch]
+                if meta_cache is not None:
+                    metas = meta_cache.get(paths, self.workers)
+                else:
+                    metas = get_image_metas(paths, self.workers, cache=False)
+                for img, meta in zip(batch, metas):
+                    img["height"] = meta.height
+                    img["width"] = meta.width
+            return batch
+
+        # Images of a packed store at the root are listed after the files of
+        # their class directory, their paths are read through the store
+        packed = open_packed_images(self.dataset_dir)
+
+        try:
+            idx = 0
+            batch: list[dict] = []
+
+            # Start to read all images inside each subset/label folder
+            for label_dir in self.label_dirs.get(subset, []):
+                with os.scandir(label_dir) as entries:
+                    file_names = []
+                    for entry in entries:
+                        if not entry.is_file():
+                            logger.error(
+                                "Dataset image path is not a file: %s" % entry.path,
+                            )
+                            raise ValueError(
+                                f"Dataset image path is not a file: {entry.path}",
+                            )
+                        file_names.append(entry.name)
+
+                if packed is not None:
+                    file_names += packed.list_dir(f"{subset}/{label_dir.name}")
+
+                for file_name in file_names:
+                    batch.append(
+                        {
+                            "file_path": (label_dir / file_name).as_posix(),
+                            "filename": file_name,
+                            "label": label_dir.name,
+                            "id": idx,
+                        },
+                    )
+                    idx += 1
+                    if len(batch) >= batch_size:
+                        yield from probe(batch)
+                        batch = []
+
+            yield from probe(batch)
+        finally:
+            if meta_cache is not None:
+                meta_cache.close()
+            if packed is not None:
+                packed.close()
+
+
+def read_imagenet(
+    dataset_dir: Path,
+    workers: int = 8,
+    cache: bool = True,
+    sizes: bool = True,
+) -> dict:
     """Read data inside imagenet folder and return a dictionary
 
+    The whole folder is read, see ImagenetReader to stream its images instead.
+
     Args:
         dataset_dir (Path): path to imagenet folder
+        workers (int, optional): number of threads reading image sizes. Defaults to 8.
+        cache (bool, optional): use the image metadata cache. Defaults to True.
+        sizes (bool, optional): read the width and height of every image. Defaults to True.
 
     Returns:
         dict: data inside imagenet folder
@@ -81,103 +276,14 @@ def read_imagenet(dataset_dir: Path) -> dict:
         }
     """
 
-    result = {}
+    reader = ImagenetReader(dataset_dir, workers, cache)
 
-    if not dataset_dir.exists():
-        logger.error("Dataset directory does not exist: %s" % dataset_dir)
-        raise ValueError(f"Dataset directory does not exist: {dataset_dir}")
-
-    if not dataset_dir.is_dir():
-        logger.error("Dataset is not a directory: %s" % dataset_dir)
-        raise ValueError(f"Dataset is not a directory: {dataset_dir}")
-
-    class_names: list | None = None
-    subsets = set()
-
-    # read data.yaml file if exist
-    data_yaml_path = dataset_dir / "data.yaml"
-    if data_yaml_path.exists():
-        logger.info("Found data.yaml file: %s" % data_yaml_path)
-        data_yaml = read_data_yaml(data_yaml_path)
-
-        class_names = data_yaml["names"]
-        subsets = set(data_yaml.keys())
-        subsets.remove("names")
-        subsets.remove("nc")
-
-        logger.info("data.yaml file read successfully")
-
-    logger.info("Class names: %s" % class_names)
-    logger.info("Subsets: %s" % subsets)
-
-    # List all directories inside dataset_dir, which is subsets
-    for subset in dataset_dir.iterdir():
-        if not subset.is_dir():
-            if subset.name not in ["data.yaml", "data.yml"]:
-                logger.error("Dataset subset is not a directory: %s" % subset)
-                raise ValueError(f"Dataset is not a directory: {subset}")
-            else:
-                # skip data.yaml file
-                continue
-
-        subsets.add(subset.name)
-
-        _names = list()
-        for label in subset.iterdir():
-            if not label.is_dir():
-                logger.error(
-                    "Dataset subset label is not a directory: %s" % label,
-                )
-                raise ValueError(
-                    f"Dataset subset label is not a directory: {label}",
-                )
-
-            _names.append(label.name)
-
-        if class_names is None:
-            class_names = _names
-        else:
-            # if class_names is not none, check if names of each directory are the same
-            if set(class_names).difference(set(_names)):
-                logger.error("Class names are not the same: %s" % _names)
-                raise ValueError(
-                    f"Class names are not the same: {class_names} != {_names}",
-                )
-
-        idx = 0
-        imgs = []
-
-        # Start to read all images inside each subset/label folder
-        for label_dir in subset.iterdir():
-            img_paths = label_dir.iterdir()
-
-            for img_path in img_paths:
-                if not img_path.is_file():
-                    logger.error(
-                        "Dataset image path is not a file: %s" % img_path,
-                    )
-                    raise ValueError(
-                        f"Dataset image path is not a file: {img_path}",
-                    )
-
-                width, height = imagesize.get(img_path.as_posix())
-
-                imgs.append(
-                    {
-                        "file_path": img_path.as_posix(),
-                        "filename": img_path.name,
-                        "height": height,
-                        "width": width,
-                        "label": label_dir.name,
-                        "id": idx,
-                    },
-                )
-                idx += 1
-
-        result[subset.name] = imgs
+    result = {}
+    for subset in reader.label_dirs:
+        result[subset] = list(reader.iter_images(subset, sizes))
 
-    result["names"] = list(class_names or set())
+    result["names"] = reader.names
     result["nc"] = len(result["names"])
-    result["subsets"] = subsets
+    result["subsets"] = reader.subsets
 
     return result
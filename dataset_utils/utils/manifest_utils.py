@@ -0,0 +1,388 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from argparse import ArgumentParser
+from pathlib import Path
+
+from utils.packed_utils import find_packed_image
+
+StrPath = str | Path
+
+# Name of the manifest file written at the root of every converted dataset
+MANIFEST_FILE = ".manifest.json"
+
+# Version of the manifest format, manifests of other versions are ignored
+MANIFEST_VERSION = 1
+
+# Digest recorded for the symlinks to source directories
+_LINK = "link"
+
+
+def add_manifest_args(parser: ArgumentParser):
+    """Add the --incremental argument to a converter parser"""
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Update an output directory written by a previous run in place, "
+        "only files whose source changed are rewritten",
+    )
+
+
+def add_annotations_only_arg(parser: ArgumentParser):
+    """Add the --annotations-only argument to a converter parser"""
+
+    parser.add_argument(
+        "--annotations-only",
+        action="store_true",
+        help="Write only the annotation files, images are referenced in place "
+        "through one symlink per source image directory",
+    )
+
+
+def check_output_dir(output_dir: Path, force: bool = False, incremental: bool = False):
+    """Check that the output directory of a converter can be written, without changing it
+
+    Converters which read and check their source for a long time call it
+    first, then prepare_output_dir once nothing can fail before writing.
+
+    Args:
+        output_dir (Path): output directory of the converter
+        force (bool, optional): Remove an existing output directory. Defaults to False.
+        incremental (bool, optional): Keep an existing output directory with a manifest. Defaults to False.
+
+    Raises:
+        ValueError: the output directory exists and cannot be reused
+    """  # noqa: E501
+
+    if incremental and (output_dir / MANIFEST_FILE).is_file():
+        return
+
+    if not force and output_dir.exists():
+        if incremental:
+            raise ValueError(
+                "Output directory already exists and has no manifest, "
+                "use --force to rebuild it"
+            )
+        raise ValueError("Output directory already exists")
+
+
+def prepare_output_dir(output_dir: Path, force: bool = False, incremental: bool = False):
+    """Check the output directory of a converter before it is written
+
+    An existing output directory is an error, unless force is given and it is
+    removed. With incremental, an output directory with a manifest is kept and
+    updated in place.
+
+    Args:
+        output_dir (Path): output directory of the converter
+        force (bool, optional): Remove an existing output directory. Defaults to False.
+        incremental (bool, optional): Keep an existing output directory with a manifest. Defaults to False.
+
+    Raises:
+        ValueError: the output directory exists and cannot be reused
+    """  # noqa: E501
+
+    check_output_dir(output_dir, force, incremental)
+    if incremental and (output_dir / MANIFEST_FILE).is_file():
+        print("Output directory already exists. Updating it from its manifest")
+        return
+
+    if force:
+        print("Output directory already exists. Removing existing output directory")
+        shutil.rmtree(str(output_dir), ignore_errors=True)
+        print("Creating new output directory")
+
+
+def file_fingerprint(path: StrPath) -> str:
+    """Return a fingerprint of a source file, from its size and modification time
+
+    Images of a packed store are fingerprinted from their place in the store.
+    """
+
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        found = find_packed_image(path)
+        if found is None:
+            raise
+        store, row = found
+        return store.fingerprint(row)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def _digest(parts: tuple) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class OutputManifest:
+    """Record of the files written to an output directory and of their sources
+
+    Each output file is recorded with a digest of everything it is made of: the
+    fingerprint of its source image, the content of a label file, a crop box...
+    A converter asks the manifest whether an output is current before writing
+    it, so a rerun only rewrites files whose digest changed. Files recorded by
+    the previous run and not produced by this one are removed by `finish`.
+
+    The manifest file is removed while the output directory is updated and
+    written again by `finish`, an interrupted run leaves no manifest and the
+    next run has to rebuild the output with --force.
+
+    Outputs can be recorded and written by several threads, like the stages
+    of a utils.pipeline_utils.Pipeline.
+
+    Example:
+        manifest = OutputManifest(output_dir)
+        with FileTransfer(mode, workers) as file_transfer:
+            for src, dst in files:
+                manifest.transfer(file_transfer, src, dst)
+        manifest.write_text(label_path, text)
+        manifest.finish()
+    """
+
+    def __init__(self, output_dir: StrPath):
+        self.output_dir = Path(output_dir)
+        self.path = self.output_dir / MANIFEST_FILE
+
+        self.num_written = 0
+        self.num_current = 0
+        self.num_removed = 0
+
+        self._prefix = os.path.join(os.fspath(self.output_dir), "")
+        self._previous: dict[str, str] = {}
+        self._files: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+        if self.path.is_file():
+            try:
+                with self.path.open("r") as f:
+                    data = json.load(f)
+            except ValueError:
+                data = {}
+            if data.get("version") == MANIFEST_VERSION:
+                self._previous = data["files"]
+            self.path.unlink()
+
+        # Links to source directories are recreated by every run, they are
+        # removed first so no file is ever written through them. They are not
+        # stale outputs anymore, a run without links may write a directory
+        # of images in their place
+        for key in [key for key, digest in self._previous.items() if digest == _LINK]:
+            path = os.path.join(self._prefix, key)
+            if os.path.islink(path):
+                os.unlink(path)
+            del self._previous[key]
+
+    def _key(self, dst: StrPath) -> str:
+        dst = os.fspath(dst)
+        if dst.startswith(self._prefix):
+            return dst[len(self._prefix) :]
+        return os.path.relpath(dst, self.output_dir)
+
+    def is_current(self, dst: StrPath, *parts) -> bool:
+        """Record dst as an output made of parts, return whether it is up to date
+
+        dst is up to date when it exists and the previous run recorded it with
+        the same parts. Otherwise the caller must write it.
+        """
+
+        key = self._key(dst)
+        digest = _digest(parts)
+        current = self._previous.get(key) == digest and os.path.lexists(dst)
+
+        with self._lock:
+            self._files[key] = digest
+            if current:
+                self.num_current += 1
+            else:
+                self.num_written += 1
+        return current
+
+    def add(self, dst: StrPath):
+        """Record dst as an output which is written by every run"""
+
+        with self._lock:
+            self._files[self._key(dst)] = ""
+            self.num_written += 1
+
+    def add_link(self, dst: StrPath, src_dir: StrPath):
+        """Replace dst by a symlink to the directory src_dir, and record it
+
+        A directory of images transferred by a previous run is removed first.
+        """
+
+        dst = os.fspath(dst)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        elif os.path.lexists(dst):
+            os.unlink(dst)
+
+        os.symlink(os.path.abspath(src_dir), dst, target_is_directory=True)
+        with self._lock:
+            self._files[self._key(dst)] = _LINK
+            self.num_written += 1
+
+    def transfer(self, file_transfer, src: StrPath, dst: StrPath):
+        """Submit the transfer of src to dst unless dst is up to date
+
+        Args:
+            file_transfer (FileTransfer): transfer of the converter
+            src (StrPath): source image
+            dst (StrPath): output image
+        """
+
+        src = os.path.abspath(src)
+        if not self.is_current(dst, file_transfer.mode, src, file_fingerprint(src)):
+            file_transfer.submit(src, dst)
+
+    def submit_tree(self, file_transfer, src_dir: StrPath, dst_dir: StrPath):
+        """Transfer every file inside src_dir to dst_dir, like FileTransfer.submit_tree"""
+
+        src_dir = Path(src_dir)
+        dst_dir = Path(dst_dir)
+        for root, _, files in os.walk(src_dir):
+            out_dir = dst_dir / Path(root).relative_to(src_dir)
+            out_dir.mkdir(parents=True, exist_ok=True)
+
+            for file_name in files:
+                self.transfer(file_transfer, os.path.join(root, file_name), out_dir / file_name)
+
+    def write_text(self, dst: StrPath, text: str):
+        """Write text to dst unless dst already has this content"""
+
+        if not self.is_current(dst, text):
+            with open(dst, "w") as f:
+                f.write(text)
+
+    def remove_stale(self) -> int:
+        """Remove the outputs of the previous run which are not produced anymore
+
+        Directories left empty are removed as well.
+
+        Returns:
+            int: number of removed files
+        """
+
+        # never remove files through a link to a source directory
+        real_output_dir = os.path.join(os.path.realpath(self.output_dir), "")
+
+        dirs = set()
+        for key in self._previous.keys() - self._files.keys():
+            path = os.path.join(self._prefix, key)
+            parent = os.path.realpath(os.path.dirname(path))
+            if not os.path.join(parent, "").startswith(real_output_dir):
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            self.num_removed += 1
+            dirs.add(os.path.dirname(path))
+
+        # deepest directories first, so their parents may be empty as well
+        output_dir = os.path.abspath(self.output_dir)
+        while dirs:
+            parents = set()
+            for path in sorted(dirs, key=len, reverse=True):
+                if not os.path.abspath(path).startswith(output_dir + os.sep):
+                    continue
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    continue
+                parents.add(os.path.dirname(path))
+            dirs = parents
+
+        self._previous = {}
+        return self.num_removed
+
+    def save(self):
+        """Write the manifest file, atomically"""
+
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(
+                {"version": MANIFEST_VERSION, "files": self._files},
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, self.path)
+
+    def finish(self, verbose: bool = True):
+        """Remove stale outputs and save the manifest, once every output is written"""
+
+        self.remove_stale()
+        self.save()
+        if verbose:
+            print(self.report())
+
+    def report(self) -> str:
+        return (
+            f"Manifest: {self.num_written} files written, {self.num_current} up to date, "
+            f"{self.num_removed} stale files removed"
+        )
+
+
+class ImageDirLinks:
+    """Reference source images through one symlink per source directory
+
+    Used by the annotations only mode of the converters: instead of
+    transferring every image, each source directory is linked once into
+    images_dir and images are referenced as <link name>/<file name>. Link
+    names are the names of the source directories, with a number appended
+    when two of them have the same name.
+
+    Example:
+        links = ImageDirLinks(output_dir / "images", manifest)
+        names = links.image_names(ds)  # ["train/0001.jpg", ...]
+    """
+
+    def __init__(self, images_dir: StrPath, manifest: OutputManifest):
+        self.images_dir = Path(images_dir)
+        self.manifest = manifest
+
+        self._names: dict[str, str] = {}
+        self._used: set[str] = set()
+        self._lock = threading.Lock()
+
+    def link(self, src_dir: StrPath) -> str:
+        """Link src_dir into images_dir on first use and return the link name"""
+
+        src_dir = os.path.abspath(src_dir)
+        name = self._names.get(src_dir)
+        if name is not None:
+            return name
+
+        with self._lock:
+            # another thread may have linked the directory in the meantime
+            name = self._names.get(src_dir)
+            if name is not None:
+                return name
+
+            base = name = os.path.basename(src_dir) or "images"
+            k = 1
+            while name in self._used:
+                name = f"{base}_{k}"
+                k += 1
+
+            self.images_dir.mkdir(parents=True, exist_ok=True)
+            self.manifest.add_link(self.images_dir / name, src_dir)
+
+            self._used.add(name)
+            self._names[src_dir] = name
+            return name
+
+    def image_names(self, ds) -> list[str]:
+        """Return the path of every image of a ColumnarDataset relative to images_dir"""
+
+        dir_names = {d: self.link(ds.dirs[d]) for d in sorted(set(ds.dir_ids.tolist()))}
+        return [
+            f"{dir_names[d]}/{file_name}"
+            for d, file_name in zip(ds.dir_ids.tolist(), ds.file_names.tolist())
+        ]
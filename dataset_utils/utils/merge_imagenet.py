@@ -11,14 +11,21 @@ current_dir = os.getcwd()  # Use os.getcwd() instead of %cd%
 sys.path.append(current_dir)
 
 
+import hashlib
 import shutil
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from imagenet_util import read_imagenet
+from imagenet_util import ImagenetReader
+from packed_utils import find_packed_image, open_image_file
+from transfer_utils import add_transfer_args, open_file_transfer
 
 StrPath = str | Path
 
+# Size of the blocks read to hash a file
+_HASH_BLOCK_SIZE = 1 << 20
+
 
 def get_args():
     parser = ArgumentParser()
@@ -40,21 +47,94 @@ def get_args():
         action="store_true",
         help="Overwrite existing output directory",
     )
+    parser.add_argument(
+        "--no-dedupe",
+        action="store_true",
+        help="Keep every copy of images with the same content in the same subset and class",
+    )
+
+    add_transfer_args(parser)
 
     return parser.parse_args()
 
 
+def file_digest(path: StrPath) -> str:
+    """Return the blake2b digest of the content of a file, or of an image of a packed store"""
+
+    h = hashlib.blake2b(digest_size=16)
+    with open_image_file(path) as f:
+        while block := f.read(_HASH_BLOCK_SIZE):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        found = find_packed_image(path)
+        if found is None:
+            raise
+    store, row = found
+    return len(store.get_bytes(row))
+
+
+def _scan_source(src_dir: Path) -> tuple[dict, list[tuple[str, str, str, str, int]]]:
+    """Stream the images of a source dataset and stat them, image sizes are not read
+
+    Returns:
+        tuple: the names and subsets of the dataset, and (subset, label, file
+            name, path, size) of every image
+    """
+
+    reader = ImagenetReader(src_dir)
+    images = []
+    for subset in sorted(reader.subsets):
+        for img_info in reader.iter_images(subset):
+            path = img_info["file_path"]
+            images.append(
+                (subset, img_info["label"], img_info["filename"], path, _file_size(path))
+            )
+    return {"names": reader.names, "subsets": reader.subsets}, images
+
+
+def _collision_name(file_name: str, digest: str, taken: set) -> str:
+    """Return a new name for an image whose name is taken, from its content digest"""
+
+    stem, suffix = os.path.splitext(file_name)
+    name = f"{stem}-{digest[:8]}{suffix}"
+    k = 1
+    while name in taken:
+        name = f"{stem}-{digest[:8]}-{k}{suffix}"
+        k += 1
+    return name
+
+
 def merge_imagenet_datasets(
     src_dirs: list[StrPath],
     output_dir: StrPath,
     force: bool = False,
+    transfer: str = "copy",
+    workers: int = 4,
+    dedupe: bool = True,
 ):
     """Merge ImageNet datasets into one new dataset
 
+    Sources are scanned in parallel and images are transferred by a pool of
+    `workers` threads. Inside each subset and class, images with the same
+    content are transferred once, the first source wins. An image whose name
+    is already taken by an image with another content is renamed to
+    <stem>-<first 8 hex digits of its blake2b digest><suffix>, so the
+    name only depends on its content. Files are only hashed when another file
+    of the same subset and class has the same size or the same name.
+
     Args:
         src_dirs (list[StrPath]): list of directory of the ImageNet dataset
         output_dir (StrPath): directory of the output dataset
         force (bool, optional): Overwrite existing output directory. Defaults to False.
+        transfer (str, optional): How images are transferred, one of "copy", "hardlink", "reflink", "symlink" and "pack". Defaults to "copy".
+        workers (int, optional): Number of threads used to scan sources, hash and transfer images. Defaults to 4.
+        dedupe (bool, optional): Transfer images with the same content in the same subset and class once. Defaults to True.
     """  # noqa: E501
 
     src_dirs = [Path(src_dir) for src_dir in src_dirs]
@@ -75,15 +155,13 @@ def merge_imagenet_datasets(
         print("Creating new output directory")
 
     print("Scanning source directorie label...")
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        scans = list(executor.map(_scan_source, src_dirs))
+
     subsets: list[str] | None = None
     names: list[str] | None = None
     name2id: dict[str, int] = {}
-    dataset_infos: list[tuple[Path, dict]] = []
-    for src_dir in src_dirs:
-        src_dir = Path(src_dir)
-
-        dataset_data = read_imagenet(src_dir)
-        dataset_infos.append((src_dir, dataset_data))
+    for src_dir, (dataset_data, _) in zip(src_dirs, scans):
         if names is None:
             names = dataset_data["names"]
             name2id = {name: i for i, name in enumerate(names)} # type: ignore
@@ -110,16 +188,55 @@ def merge_imagenet_datasets(
                     f"Subsets in the datasets do not match: {set(subsets)} - {set(dataset_data['subsets'])}"
                 )
 
+    # Images of all sources in order, only the images which may be a copy of
+    # another one or whose name collides with another one are hashed
+    images = [image for _, source_images in scans for image in source_images]
+    by_size: dict[tuple[str, str, int], int] = {}
+    by_name: dict[tuple[str, str, str], int] = {}
+    for subset, label, file_name, _, size in images:
+        by_size[subset, label, size] = by_size.get((subset, label, size), 0) + 1
+        by_name[subset, label, file_name] = by_name.get((subset, label, file_name), 0) + 1
+
+    to_hash = sorted(
+        {
+            path
+            for subset, label, file_name, path, size in images
+            if (dedupe and by_size[subset, label, size] > 1) or by_name[subset, label, file_name] > 1
+        }
+    )
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        digests = dict(zip(to_hash, executor.map(file_digest, to_hash)))
+
     # start to merge dataset
-    for src_dir, dataset_info in dataset_infos:
-        for subset in dataset_info["subsets"]:
-            subset_dir = output_dir / subset
-            subset_dir.mkdir(parents=True, exist_ok=True)
-            for img_info in dataset_info[subset]:
-                src_img = src_dir / subset / img_info["label"] / img_info["filename"]
-                dst_img = output_dir / subset / img_info["label"] / img_info["filename"]
-                dst_img.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy(src_img, dst_img)
+    taken: dict[tuple[str, str], set[str]] = {}
+    contents: set[tuple[str, str, int, str]] = set()
+    num_duplicates = 0
+    num_renamed = 0
+    with open_file_transfer(transfer, workers, output_dir) as file_transfer:
+        for subset, label, file_name, path, size in images:
+            digest = digests.get(path)
+            if dedupe and digest is not None:
+                if (subset, label, size, digest) in contents:
+                    num_duplicates += 1
+                    continue
+                contents.add((subset, label, size, digest))
+
+            label_names = taken.get((subset, label))
+            if label_names is None:
+                label_names = taken[subset, label] = set()
+                (output_dir / subset / label).mkdir(parents=True, exist_ok=True)
+
+            if file_name in label_names:
+                file_name = _collision_name(file_name, digest, label_names)
+                num_renamed += 1
+            label_names.add(file_name)
+
+            file_transfer.submit(path, output_dir / subset / label / file_name)
+
+    print(
+        f"Merged {len(images)} images: {num_duplicates} duplicates skipped, "
+        f"{num_renamed} renamed after a name collision"
+    )
 
     if subsets is None:
         raise ValueError("No subsets found")
@@ -151,6 +268,9 @@ def main():
         src_dirs=args.src,
         output_dir=args.output,
         force=args.force,
+        transfer=args.transfer,
+        workers=args.workers,
+        dedupe=not args.no_dedupe,
     )
 
 
@@ -0,0 +1,324 @@
+import io
+import json
+import mmap
+import os
+import posixpath
+import threading
+from pathlib import Path
+from typing import BinaryIO, Iterable
+
+import numpy as np
+from PIL import Image
+
+StrPath = str | Path
+
+# Files of a packed image store, written at the root of a dataset:
+#   - images.pack: the encoded images concatenated
+#   - images.pack.npy: index of the images, one PACK_INDEX_DTYPE row per image
+#   - images.pack.json: path of every image relative to the root, in index order
+PACK_DATA_FILE = "images.pack"
+PACK_INDEX_FILE = "images.pack.npy"
+PACK_KEYS_FILE = "images.pack.json"
+PACK_FILES = (PACK_DATA_FILE, PACK_INDEX_FILE, PACK_KEYS_FILE)
+
+# Version of the packed store format
+PACK_VERSION = 1
+
+PACK_INDEX_DTYPE = np.dtype(
+    [("offset", "<u8"), ("length", "<u8"), ("width", "<i4"), ("height", "<i4")]
+)
+
+
+def has_packed_images(root_dir: StrPath) -> bool:
+    return (Path(root_dir) / PACK_INDEX_FILE).is_file()
+
+
+class PackedImagesWriter:
+    """Write a packed image store, images can be added by several threads
+
+    Images are appended to images.pack as they are added, the index and the
+    keys are written when the writer is closed. Files are written next to
+    their final path and renamed at the end, so an interrupted run leaves the
+    previous store untouched. A key added twice refers to its last image.
+
+    Example:
+        with PackedImagesWriter(output_dir) as writer:
+            writer.add("images/train/0001.jpg", data, width, height)
+    """
+
+    def __init__(self, root_dir: StrPath):
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+
+        self._tmp_path = self.root_dir / (PACK_DATA_FILE + ".tmp")
+        self._file = self._tmp_path.open("wb")
+        self._lock = threading.Lock()
+        self._rows: dict[str, tuple[int, int, int, int]] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def add(self, key: str, data: bytes, width: int = -1, height: int = -1):
+        """Append the encoded image data as key, a path relative to the root"""
+
+        with self._lock:
+            self._file.write(data)
+            self._rows.pop(key, None)
+            self._rows[key] = (self._size, len(data), width, height)
+            self._size += len(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+
+        index = np.array(list(self._rows.values()), dtype=PACK_INDEX_DTYPE)
+        np.save(self.root_dir / (PACK_INDEX_FILE + ".tmp.npy"), index)
+        with (self.root_dir / (PACK_KEYS_FILE + ".tmp")).open("w") as f:
+            json.dump({"version": PACK_VERSION, "keys": list(self._rows)}, f)
+
+        # the index is renamed last, it marks the store as complete
+        os.replace(self._tmp_path, self.root_dir / PACK_DATA_FILE)
+        os.replace(self.root_dir / (PACK_KEYS_FILE + ".tmp"), self.root_dir / PACK_KEYS_FILE)
+        os.replace(
+            self.root_dir / (PACK_INDEX_FILE + ".tmp.npy"), self.root_dir / PACK_INDEX_FILE
+        )
+
+    def abort(self):
+        """Close the writer and remove the images added, the previous store is kept"""
+
+        if not self._file.closed:
+            self._file.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "PackedImagesWriter":
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class PackedImages:
+    """Read a packed image store with random access
+
+    images.pack is memory-mapped and the index is loaded with mmap_mode, so
+    opening a store of millions of images reads only the keys. `get_bytes`
+    returns a view into the mapping without copying the encoded image.
+
+    Example:
+        with PackedImages(dataset_dir) as packed:
+            i = packed.find("images/train/0001.jpg")
+            data = packed.get_bytes(i)  # memoryview of the JPEG file
+            pixels = packed.get_array(i)  # decoded (H, W, C) uint8 array
+    """
+
+    def __init__(self, root_dir: StrPath):
+        self.root_dir = Path(root_dir)
+
+        with (self.root_dir / PACK_KEYS_FILE).open("r") as f:
+            data = json.load(f)
+        if data.get("version") != PACK_VERSION:
+            raise ValueError(f"Unsupported packed store version: {data.get('version')}")
+        self.keys: list[str] = data["keys"]
+
+        self.index = np.load(self.root_dir / PACK_INDEX_FILE, mmap_mode="r")
+        if len(self.index) != len(self.keys):
+            raise ValueError(f"Packed store index and keys do not match: {self.root_dir}")
+
+        # fingerprints of the images change when the store is written again
+        self._mtime_ns = os.stat(self.root_dir / PACK_INDEX_FILE).st_mtime_ns
+
+        # an empty file cannot be mapped
+        self._file = (self.root_dir / PACK_DATA_FILE).open("rb")
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        else:
+            self._mmap = None
+            self._view = memoryview(b"")
+
+        self._rows: dict[str, int] | None = None
+        self._dirs: dict[str, list[str]] | None = None
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def widths(self) -> np.ndarray:
+        return self.index["width"]
+
+    @property
+    def heights(self) -> np.ndarray:
+        return self.index["height"]
+
+    def find(self, key: str) -> int:
+        """Return the row of the image key, -1 if it is not in the store"""
+
+        if self._rows is None:
+            self._rows = {key: i for i, key in enumerate(self.keys)}
+        return self._rows.get(key, -1)
+
+    def find_all(self, keys: Iterable[str]) -> np.ndarray:
+        """Return the row of every key, -1 for keys which are not in the store"""
+
+        return np.array([self.find(key) for key in keys], dtype=np.int64)
+
+    def list_dir(self, dir_key: str) -> list[str]:
+        """Return the names of the images directly inside the directory dir_key"""
+
+        if self._dirs is None:
+            self._dirs = {}
+            for key in self.keys:
+                parent, name = posixpath.split(key)
+                self._dirs.setdefault(parent, []).append(name)
+        return self._dirs.get(posixpath.normpath(dir_key).strip("/"), [])
+
+    def get_bytes(self, i: int) -> memoryview:
+        """Return the encoded image i, a view into the memory-mapped store"""
+
+        offset, length = int(self.index["offset"][i]), int(self.index["length"][i])
+        return self._view[offset : offset + length]
+
+    def fingerprint(self, i: int) -> str:
+        """Return a fingerprint of the image i, like utils.manifest_utils.file_fingerprint"""
+
+        offset, length = int(self.index["offset"][i]), int(self.index["length"][i])
+        return f"{length}:{self._mtime_ns}:{offset}"
+
+    def get_image(self, i: int) -> Image.Image:
+        """Return the image i, decoded lazily by Pillow"""
+
+        return Image.open(io.BytesIO(self.get_bytes(i)))
+
+    def get_array(self, i: int, mode: str = "RGB") -> np.ndarray:
+        """Return the image i decoded as an (H, W, C) uint8 array"""
+
+        with self.get_image(i) as img:
+            return np.asarray(img.convert(mode))
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # views returned by get_bytes are still in use, the mapping
+                # is closed when the last of them is released
+                pass
+        self._file.close()
+
+    def __enter__(self) -> "PackedImages":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def check_no_packed_images(root_dir: StrPath, action: str = "transferred"):
+    """Raise a ValueError when a source dataset has a packed image store
+
+    The images of the store are read through find_packed_image, but they
+    are not files which can be referenced in place, like by the links of the
+    annotations only mode.
+    """
+
+    if has_packed_images(root_dir):
+        raise ValueError(
+            f"Images of {root_dir} are in a packed image store ({PACK_DATA_FILE}), "
+            f"they cannot be {action}"
+        )
+
+
+# Packed stores opened by find_packed_image, by directory, None for the
+# directories without a store. Stores stay open until the process exits
+_stores: dict[str, PackedImages | None] = {}
+_stores_lock = threading.Lock()
+
+
+def _reset_stores_lock():
+    # a process forked while another thread held the lock would never get it
+    global _stores_lock
+    _stores_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_stores_lock)
+
+
+def _open_store(dir_path: str) -> PackedImages | None:
+    store = _stores.get(dir_path, False)
+    if store is not False:
+        return store
+
+    with _stores_lock:
+        if dir_path not in _stores:
+            _stores[dir_path] = open_packed_images(dir_path)
+        return _stores[dir_path]
+
+
+def find_packed_image(path: StrPath) -> tuple[PackedImages, int] | None:
+    """Return the packed store and row of an image path which is not a file
+
+    The readers give the images of a packed store the path they would have
+    in the folders, <root>/<key>, so the stores of the parent directories of
+    path are looked up. Only call it for paths which are not files.
+
+    Args:
+        path (StrPath): path of the image
+
+    Returns:
+        tuple[PackedImages, int] | None: store and row of the image, None if
+            no store of a parent directory has it
+    """
+
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    while True:
+        store = _open_store(parent)
+        if store is not None:
+            row = store.find(os.path.relpath(path, parent).replace(os.sep, "/"))
+            if row >= 0:
+                return store, row
+
+        next_parent = os.path.dirname(parent)
+        if next_parent == parent:
+            return None
+        parent = next_parent
+
+
+def open_image(path: StrPath) -> Image.Image:
+    """Open an image file with Pillow, or the image of a packed store with this path"""
+
+    try:
+        return Image.open(path)
+    except FileNotFoundError:
+        found = find_packed_image(path)
+        if found is None:
+            raise
+    store, row = found
+    return store.get_image(row)
+
+
+def open_image_file(path: StrPath) -> BinaryIO:
+    """Open an image file for reading, or the image of a packed store with this path"""
+
+    try:
+        return open(path, "rb")
+    except FileNotFoundError:
+        found = find_packed_image(path)
+        if found is None:
+            raise
+    store, row = found
+    return io.BytesIO(store.get_bytes(row))
+
+
+def open_packed_images(root_dir: StrPath) -> PackedImages | None:
+    """Open the packed image store of a dataset directory, None if it has none"""
+
+    if not has_packed_images(root_dir):
+        return None
+    return PackedImages(root_dir)
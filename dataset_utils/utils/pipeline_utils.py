@@ -0,0 +1,240 @@
+import queue
+import threading
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Any, Callable, Iterable, Iterator
+
+import numpy as np
+from utils.profile_utils import StageProfiler
+
+# Number of images per item of the pipelines of the converters
+BATCH_SIZE = 1024
+
+# Seconds between two checks of the stop event by a thread blocked on a queue
+_POLL_INTERVAL = 0.05
+
+# Marks the end of the items of a queue
+_DONE = object()
+
+
+def _num_items(item) -> int:
+    return len(item) if hasattr(item, "__len__") else 1
+
+
+def batch_rows(rows: np.ndarray, batch_size: int = BATCH_SIZE) -> Iterator[np.ndarray]:
+    """Yield rows by batches of at most batch_size rows, the batches are views of rows"""
+
+    for start in range(0, len(rows), batch_size):
+        yield rows[start : start + batch_size]
+
+
+@dataclass
+class PipelineStage:
+    """A stage of a Pipeline and its totals over the last run
+
+    time is the time spent in fn summed over the workers of the stage, items
+    counts the length of the items with a length, like batches of rows, and
+    one for other items.
+    """
+
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+    time: float = 0.0
+    items: int = 0
+
+
+class Pipeline:
+    """Run items through stages of threads connected by bounded queues
+
+    Each stage has its own threads, which take the items produced by the
+    previous stage, apply the function of the stage and pass the result to
+    the next stage. Queues hold at most queue_size items and the number of
+    items inside the pipeline is bounded, so a slow stage blocks the stages
+    before it (backpressure) instead of letting items pile up in memory.
+    With ordered, results are yielded in the order of the items whatever the
+    number of workers of the stages, which is the order required to number
+    images or to serialize them.
+
+    Stages overlap for I/O and for code which releases the GIL (file copies,
+    stat, image headers, numpy). Items are usually batches of rows, so the
+    cost of the queues is paid once per batch. The first error raised by a
+    stage, or by the iteration of the items, stops the pipeline and is raised
+    again by run.
+
+    Example:
+        pipeline = Pipeline()
+        pipeline.add_stage("probe image sizes", probe_sizes, workers=4)
+        pipeline.add_stage("transfer images", transfer_images)
+        with profiler.stage("pipeline"):
+            for rows in pipeline.run(batches):
+                write_annotations(rows)
+        pipeline.record(profiler, parent="pipeline")
+    """
+
+    def __init__(self, queue_size: int = 4, ordered: bool = True):
+        """
+        Args:
+            queue_size (int, optional): maximum number of items waiting between two stages. Defaults to 4.
+            ordered (bool, optional): yield results in the order of the items. Defaults to True.
+        """  # noqa: E501
+
+        if queue_size < 1:
+            raise ValueError(f"Queue size must be at least 1: {queue_size}")
+
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.stages: list[PipelineStage] = []
+
+    def add_stage(self, name: str, fn: Callable[[Any], Any], workers: int = 1) -> "Pipeline":
+        """Append a stage applying fn to every item with workers threads, return the pipeline"""
+
+        if workers < 1:
+            raise ValueError(f"Stage '{name}' needs at least one worker: {workers}")
+
+        self.stages.append(PipelineStage(name, fn, workers))
+        return self
+
+    @property
+    def capacity(self) -> int:
+        """Maximum number of items inside the pipeline, queued, processed or waiting to be yielded"""  # noqa: E501
+
+        return sum(stage.workers for stage in self.stages) + self.queue_size * (
+            len(self.stages) + 1
+        )
+
+    def run(self, items: Iterable) -> Iterator:
+        """Yield the result of the last stage for every item
+
+        items is iterated by a thread of the pipeline, so it can itself read
+        files while the stages run. Leaving the loop early stops the pipeline.
+        """
+
+        for stage in self.stages:
+            stage.time = 0.0
+            stage.items = 0
+
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+        lock = threading.Lock()
+        errors: list[BaseException] = []
+
+        # Items enter the pipeline when they take a slot and free it once they
+        # are yielded, which bounds the results waiting for an earlier item
+        slots = threading.Semaphore(self.capacity)
+
+        # Workers of each stage still running, the last one ends the next queue
+        remaining = [stage.workers for stage in self.stages]
+
+        def fail(e: BaseException):
+            with lock:
+                if not errors:
+                    errors.append(e)
+            stop.set()
+
+        def put(q: queue.Queue, entry) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(entry, timeout=_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q: queue.Queue):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+            return _DONE
+
+        def end(k: int):
+            # The next stage has one end marker per worker, the output has one
+            num_ends = self.stages[k].workers if k < len(self.stages) else 1
+            for _ in range(num_ends):
+                put(queues[k], _DONE)
+
+        def feed():
+            try:
+                for seq, item in enumerate(items):
+                    while not slots.acquire(timeout=_POLL_INTERVAL):
+                        if stop.is_set():
+                            return
+                    if not put(queues[0], (seq, item)):
+                        return
+            except BaseException as e:
+                fail(e)
+                return
+            end(0)
+
+        def work(k: int):
+            stage = self.stages[k]
+            try:
+                while True:
+                    entry = get(queues[k])
+                    if entry is _DONE:
+                        break
+
+                    seq, item = entry
+                    start = perf_counter()
+                    result = stage.fn(item)
+                    elapsed = perf_counter() - start
+                    with lock:
+                        stage.time += elapsed
+                        stage.items += _num_items(item)
+
+                    if not put(queues[k + 1], (seq, result)):
+                        return
+            except BaseException as e:
+                fail(e)
+                return
+
+            with lock:
+                remaining[k] -= 1
+                last = remaining[k] == 0
+            if last:
+                end(k + 1)
+
+        threads = [threading.Thread(target=feed, name="pipeline_feed", daemon=True)]
+        for k, stage in enumerate(self.stages):
+            threads += [
+                threading.Thread(target=work, args=(k,), name=f"pipeline_{k}", daemon=True)
+                for _ in range(stage.workers)
+            ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            waiting: dict[int, Any] = {}
+            next_seq = 0
+            while True:
+                entry = get(queues[-1])
+                if entry is _DONE:
+                    break
+
+                seq, result = entry
+                if not self.ordered:
+                    slots.release()
+                    yield result
+                    continue
+
+                waiting[seq] = result
+                while next_seq in waiting:
+                    result = waiting.pop(next_seq)
+                    next_seq += 1
+                    slots.release()
+                    yield result
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def record(self, profiler: StageProfiler, parent: str = ""):
+        """Add the totals of the stages of the last run to a profiler, as run during the stage parent"""  # noqa: E501
+
+        for stage in self.stages:
+            profiler.record(stage.name, stage.time, items=stage.items, parent=parent)
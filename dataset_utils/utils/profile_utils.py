@@ -0,0 +1,225 @@
+import json
+import sys
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from time import perf_counter
+from typing import Iterable, Iterator, TypeVar
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+StrPath = str | Path
+
+T = TypeVar("T")
+
+
+def add_profile_args(parser: ArgumentParser):
+    """Add the --profile argument to a converter parser"""
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        nargs="?",
+        const="",
+        metavar="JSON",
+        help="Print the time, items, bytes and peak memory growth of every stage "
+        "of the conversion, and write them to the JSON file if one is given",
+        default=None,
+    )
+
+
+def peak_rss() -> int:
+    """Return the peak resident memory of the process and its waited children, in bytes"""
+
+    if resource is None:
+        return 0
+
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@dataclass
+class Stage:
+    """Totals of one stage of a conversion, over every time it was entered
+
+    rss_growth is how much the stage raised the peak RSS of the process, in
+    bytes, and peak_rss the peak RSS of the process when it was last left.
+    parent is the stage during which the threads running the stage ran, for
+    the stages added with StageProfiler.record.
+    """
+
+    name: str
+    time: float = 0.0
+    calls: int = 0
+    items: int = 0
+    bytes: int = 0
+    rss_growth: int = 0
+    peak_rss: int = 0
+    parent: str = ""
+
+
+class StageProfiler:
+    """Record the time, item count, bytes and peak memory growth of the stages of a conversion
+
+    A stage is entered with `stage`, its totals are updated by the caller
+    through the yielded Stage. Entering a stage again, for example once per
+    chunk of a streamed dataset, adds to its totals. Stages can be nested, the
+    time of a stage excludes the time of the stages entered inside it, so the
+    times of all stages add up to at most the total time. The peak RSS of the
+    process only grows, the growth while a stage runs, without the growth of
+    the stages entered inside it, is the memory used by the stage beyond what
+    earlier stages already used. The growths of all stages add up to at most
+    the peak RSS of the process.
+
+    Example:
+        profiler = StageProfiler()
+        with profiler.stage("read labels") as stage:
+            ds = read_labels(...)
+            stage.items += len(ds)
+        profiler.finish("profile.json")
+    """
+
+    def __init__(self):
+        self.stages: dict[str, Stage] = {}
+        self._start = perf_counter()
+
+        # time spent and peak RSS growth in nested stages, for each stage being timed
+        self._nested: list[float] = []
+        self._nested_growth: list[int] = []
+
+    @contextmanager
+    def stage(self, name: str, items: int = 0, nbytes: int = 0) -> Iterator[Stage]:
+        """Time the block as the stage name, and add items and nbytes to its totals"""
+
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage(name)
+        stage.items += items
+        stage.bytes += nbytes
+
+        self._nested.append(0.0)
+        self._nested_growth.append(0)
+        start_rss = peak_rss()
+        start = perf_counter()
+        try:
+            yield stage
+        finally:
+            elapsed = perf_counter() - start
+            stage.time += elapsed - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+
+            stage.peak_rss = peak_rss()
+            growth = stage.peak_rss - start_rss
+            stage.rss_growth += growth - self._nested_growth.pop()
+            if self._nested_growth:
+                self._nested_growth[-1] += growth
+            stage.calls += 1
+
+    def record(
+        self, name: str, time: float, items: int = 0, nbytes: int = 0, parent: str = ""
+    ):
+        """Add time, items and nbytes to the totals of the stage name without timing it
+
+        Used for the stages run by other threads, like the stages of a
+        utils.pipeline_utils.Pipeline, during the stage parent. Such stages
+        overlap their parent and each other, so their times can add up to
+        more than the total time. They are reported under their parent, and
+        the memory they use is counted in the growth of their parent.
+        """
+
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage(name, parent=parent)
+        stage.time += time
+        stage.items += items
+        stage.bytes += nbytes
+        stage.calls += 1
+        stage.peak_rss = peak_rss()
+
+    def iterate(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        """Time the production of each item of iterable as the stage name
+
+        Items with a length add their length to the item count, like the
+        chunks of a streamed dataset, other items count as one.
+        """
+
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as stage:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                stage.items += len(item) if hasattr(item, "__len__") else 1
+            yield item
+
+    @property
+    def total_time(self) -> float:
+        return perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        return {
+            "total_time": self.total_time,
+            "peak_rss": peak_rss(),
+            "stages": [asdict(stage) for stage in self.stages.values()],
+        }
+
+    def report(self) -> str:
+        total_time = max(self.total_time, 1e-9)
+        lines = [
+            f"{'stage':<28}{'time':>10}{'%':>7}{'items':>10}{'items/s':>11}"
+            f"{'MB':>10}{'MB/s':>9}{'RSS growth':>12}"
+        ]
+        # Stages run by threads are listed under their parent, indented
+        children: dict[str, list[Stage]] = {}
+        for stage in self.stages.values():
+            if stage.parent in self.stages and stage.parent != stage.name:
+                children.setdefault(stage.parent, []).append(stage)
+
+        rows: list[tuple[Stage, int]] = []
+
+        def add_row(stage: Stage, depth: int):
+            rows.append((stage, depth))
+            for child in children.get(stage.name, []):
+                add_row(child, depth + 1)
+
+        for stage in self.stages.values():
+            if stage.parent not in self.stages or stage.parent == stage.name:
+                add_row(stage, 0)
+
+        for stage, depth in rows:
+            elapsed = max(stage.time, 1e-9)
+            name = "  " * depth + stage.name
+            lines.append(
+                f"{name:<28}{stage.time:>9.3f}s{100 * stage.time / total_time:>6.1f}%"
+                f"{stage.items:>10}{stage.items / elapsed:>11.1f}"
+                f"{stage.bytes / 1e6:>10.1f}{stage.bytes / 1e6 / elapsed:>9.1f}"
+                f"{stage.rss_growth / 1e6:>9.0f} MB"
+            )
+        lines.append(
+            f"{'total':<28}{total_time:>9.3f}s{'peak RSS':>47}{peak_rss() / 1e6:>9.0f} MB"
+        )
+        if any(depth for _, depth in rows):
+            lines.append("indented stages run in threads during the stage above them, overlapping it")
+        return "\n".join(lines)
+
+    def dump_json(self, json_path: StrPath):
+        with open(json_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def finish(self, json_path: StrPath | None = None, verbose: bool = True):
+        """Print the report and write it to json_path if given, once the conversion is done"""
+
+        if verbose:
+            print(self.report())
+        if json_path:
+            self.dump_json(json_path)
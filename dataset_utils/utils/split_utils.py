@@ -0,0 +1,122 @@
+import hashlib
+from argparse import ArgumentParser
+from typing import Iterable
+
+import numpy as np
+
+
+def add_split_args(parser: ArgumentParser, stratify: bool = True):
+    """Add --split-seed and --stratify arguments to a converter parser with --split-ratio"""
+
+    parser.add_argument(
+        "--split-seed",
+        type=int,
+        help="Seed of the split, the same seed always puts an image in the same subset",
+        default=0,
+    )
+    if not stratify:
+        return
+
+    parser.add_argument(
+        "--stratify",
+        action="store_true",
+        help="Split the images of each class with the split ratio, images are "
+        "grouped by their rarest class",
+    )
+
+
+def hash_fractions(keys: Iterable[str], seed: int = 0) -> np.ndarray:
+    """Map every key to a number in [0, 1) from a stable hash of the key and the seed
+
+    Unlike a shuffle, the number of a key only depends on the key and the
+    seed, not on the other keys, their order or the Python hash seed.
+
+    Args:
+        keys (Iterable[str]): keys of the images, such as their file names
+        seed (int, optional): seed of the hash. Defaults to 0.
+
+    Returns:
+        np.ndarray: float64 numbers in [0, 1), one per key
+    """
+
+    prefix = f"{seed}\0".encode("utf-8")
+    digests = b"".join(
+        hashlib.blake2b(prefix + key.encode("utf-8"), digest_size=8).digest() for key in keys
+    )
+    # the top 53 bits of each digest are exactly representable in a float64
+    values = np.frombuffer(digests, dtype="<u8")
+    return (values >> np.uint64(11)).astype(np.float64) * 2.0**-53
+
+
+def _split_bounds(ratios: Iterable[float]) -> np.ndarray:
+    ratios = np.asarray(list(ratios), dtype=np.float64)
+    if len(ratios) == 0 or (ratios < 0).any() or ratios.sum() <= 0:
+        raise ValueError(f"Invalid split ratios: {ratios.tolist()}")
+
+    # upper bound of every subset but the last one, which takes the rest
+    return np.cumsum(ratios / ratios.sum())[:-1]
+
+
+def split_ids(fractions: np.ndarray, ratios: Iterable[float]) -> np.ndarray:
+    """Assign a subset to every image from its hash fraction
+
+    Subset k takes the images whose fraction falls in its share of [0, 1), so
+    the assignment of an image never changes when images are added or removed
+    and chunks of a dataset can be split independently.
+
+    Args:
+        fractions (np.ndarray): hash fraction of every image, see hash_fractions
+        ratios (Iterable[float]): ratio of every subset, normalized to sum to 1
+
+    Returns:
+        np.ndarray: subset id of every image
+    """
+
+    bounds = _split_bounds(ratios)
+    return np.searchsorted(bounds, fractions, side="right").astype(np.int32)
+
+
+def stratified_split_ids(
+    fractions: np.ndarray, strata: np.ndarray, ratios: Iterable[float]
+) -> np.ndarray:
+    """Assign a subset to every image so every stratum is split with the ratios
+
+    Inside each stratum, images are ordered by hash fraction and the first
+    round(n * ratio) of them go to the first subset, and so on. Cut points are
+    found with a partition instead of a sort, so the split is linear in the
+    number of images once they are grouped by stratum.
+
+    Args:
+        fractions (np.ndarray): hash fraction of every image, see hash_fractions
+        strata (np.ndarray): integer stratum of every image, such as its rarest class
+        ratios (Iterable[float]): ratio of every subset, normalized to sum to 1
+
+    Returns:
+        np.ndarray: subset id of every image
+    """
+
+    bounds = _split_bounds(ratios)
+    subset_ids = np.zeros(len(fractions), dtype=np.int32)
+    if len(fractions) == 0:
+        return subset_ids
+
+    # group the images by stratum
+    order = np.argsort(strata, kind="stable")
+    sorted_strata = strata[order]
+    starts = np.flatnonzero(np.r_[True, sorted_strata[1:] != sorted_strata[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        rows = order[start:end]
+        values = fractions[rows]
+
+        # the image at position cut of the ordered stratum starts the next subset
+        cuts = np.round(bounds * len(rows)).astype(np.int64)
+        thresholds = np.full(len(cuts), np.inf)
+        inside = cuts < len(rows)
+        if inside.any():
+            thresholds[inside] = np.partition(values, cuts[inside])[cuts[inside]]
+
+        subset_ids[rows] = np.searchsorted(thresholds, values, side="right")
+
+    return subset_ids
@@ -0,0 +1,346 @@
+import errno
+import os
+import shutil
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+from utils.image_meta_utils import probe_image
+from utils.packed_utils import PackedImagesWriter, find_packed_image
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+StrPath = str | Path
+
+TRANSFER_MODES = ("copy", "hardlink", "reflink", "symlink", "pack")
+
+# ioctl request to clone a file on Linux (btrfs, xfs, ...), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# Errors meaning that the filesystem cannot link/clone the files, in this case
+# the file is copied instead
+_FALLBACK_ERRNOS = {
+    errno.EXDEV,  # cross-device link
+    errno.EPERM,
+    errno.EMLINK,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+}
+
+
+def add_transfer_args(parser: ArgumentParser):
+    """Add --transfer and --workers arguments to a converter parser"""
+
+    parser.add_argument(
+        "--transfer",
+        type=str,
+        choices=TRANSFER_MODES,
+        help="How images are transferred to the output directory. "
+        "hardlink and reflink fall back to copy across filesystems, pack "
+        "writes them into one packed image store at the root of the output",
+        default="copy",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of threads used to read and transfer files",
+        default=4,
+    )
+
+
+def _reflink(src: str, dst: str):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflink is not supported", src)
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+
+
+def transfer_file(src: StrPath, dst: StrPath, mode: str = "copy") -> tuple[bool, int]:
+    """Transfer a file to dst with the given mode
+
+    An image of a packed store, given by the path the readers give it, is
+    written from the store whatever the mode, and counts as a fallback to
+    copy for the other modes.
+
+    Args:
+        src (StrPath): source file
+        dst (StrPath): destination file, it is replaced if it exists
+        mode (str, optional): one of TRANSFER_MODES. Defaults to "copy".
+
+    Raises:
+        ValueError: unsupported mode
+
+    Returns:
+        tuple[bool, int]: whether the transfer fell back to copy, and the
+            number of bytes copied (0 for links and clones)
+    """
+
+    src, dst = os.fspath(src), os.fspath(dst)
+
+    if mode == "pack":
+        raise ValueError("Packed images are written by PackTransfer, not one by one")
+
+    if mode not in TRANSFER_MODES:
+        raise ValueError(f"Unsupported transfer mode: {mode}")
+
+    # dst may be a link written by a run with another mode, copying through
+    # it would overwrite its source
+    if os.path.lexists(dst):
+        os.unlink(dst)
+
+    try:
+        if mode == "copy":
+            shutil.copy(src, dst)
+            return False, os.path.getsize(dst)
+
+        try:
+            if mode == "hardlink":
+                os.link(src, dst)
+            elif mode == "reflink":
+                _reflink(src, dst)
+            else:
+                # a symlink to a missing file would be created anyway
+                if not os.path.exists(src):
+                    raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), src)
+                os.symlink(os.path.abspath(src), dst)
+            return False, 0
+        except OSError as e:
+            if mode == "symlink" or e.errno not in _FALLBACK_ERRNOS:
+                raise
+
+        shutil.copy(src, dst)
+        return True, os.path.getsize(dst)
+    except FileNotFoundError:
+        found = find_packed_image(src)
+        if found is None:
+            raise
+
+    store, row = found
+    data = store.get_bytes(row)
+    with open(dst, "wb") as f:
+        f.write(data)
+    return mode != "copy", len(data)
+
+
+class FileTransfer:
+    """Transfer files to the output directory with a pool of threads
+
+    The number of pending transfers is bounded, so submitting millions of files
+    does not keep millions of futures in memory. The first error raised by a
+    transfer is raised again by `wait` or when leaving the context.
+
+    Example:
+        with FileTransfer(mode="hardlink", workers=8) as transfer:
+            for src, dst in files:
+                transfer.submit(src, dst)
+    """
+
+    def __init__(self, mode: str = "copy", workers: int = 4, verbose: bool = True):
+        if mode not in TRANSFER_MODES:
+            raise ValueError(f"Unsupported transfer mode: {mode}")
+
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.verbose = verbose
+
+        self.num_files = 0
+        self.num_bytes = 0
+        self.num_fallbacks = 0
+
+        # time spent transferring files, summed over the threads
+        self.time = 0.0
+
+        self._lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(self.workers * 64)
+        self._error: BaseException | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        if self.workers > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="transfer"
+            )
+        self._start = perf_counter()
+
+    def _transfer(self, src: StrPath, dst: StrPath):
+        try:
+            fallback, num_bytes = transfer_file(src, dst, self.mode)
+        except BaseException as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+            return
+
+        with self._lock:
+            self.num_files += 1
+            self.num_bytes += num_bytes
+            self.num_fallbacks += fallback
+
+    def _timed_transfer(self, src: StrPath, dst: StrPath):
+        start = perf_counter()
+        try:
+            self._transfer(src, dst)
+        finally:
+            elapsed = perf_counter() - start
+            with self._lock:
+                self.time += elapsed
+
+    def _run(self, src: StrPath, dst: StrPath):
+        try:
+            self._timed_transfer(src, dst)
+        finally:
+            self._pending.release()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, src: StrPath, dst: StrPath):
+        """Schedule the transfer of src to dst, blocks if too many are pending"""
+
+        self._raise_error()
+
+        if self._executor is None:
+            self._timed_transfer(src, dst)
+            return
+
+        self._pending.acquire()
+        self._executor.submit(self._run, src, dst)
+
+    def submit_tree(self, src_dir: StrPath, dst_dir: StrPath):
+        """Schedule the transfer of every file inside src_dir to dst_dir, like shutil.copytree"""
+
+        src_dir = Path(src_dir)
+        dst_dir = Path(dst_dir)
+        for root, _, files in os.walk(src_dir):
+            out_dir = dst_dir / Path(root).relative_to(src_dir)
+            out_dir.mkdir(parents=True, exist_ok=True)
+
+            for file_name in files:
+                self.submit(os.path.join(root, file_name), out_dir / file_name)
+
+    def wait(self):
+        """Wait for all pending transfers"""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._raise_error()
+
+    def report(self) -> str:
+        elapsed = max(perf_counter() - self._start, 1e-9)
+        return (
+            f"Transferred {self.num_files} files ({self.mode}, {self.workers} workers) "
+            f"in {elapsed:.2f}s: {self.num_files / elapsed:.1f} files/s, "
+            f"{self.num_bytes / elapsed / 1e6:.2f} MB/s copied, "
+            f"{self.num_fallbacks} fallbacks to copy"
+        )
+
+    def __enter__(self) -> "FileTransfer":
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+            return
+
+        self.wait()
+        if self.verbose:
+            print(self.report())
+
+
+class PackTransfer(FileTransfer):
+    """Write the transferred images into a packed image store instead of files
+
+    An image submitted to dst is added to the store at the root of
+    output_dir with dst relative to output_dir as key, along with its size.
+    Images are read by the pool of threads and appended in the order they
+    are read, the store is completed by `wait` or when leaving the context.
+    No store is written if no image was submitted. See utils.packed_utils.
+    """
+
+    def __init__(self, output_dir: StrPath, workers: int = 4, verbose: bool = True):
+        super().__init__("pack", workers, verbose)
+        self.output_dir = Path(output_dir)
+        self._prefix = os.path.join(os.path.abspath(self.output_dir), "")
+        self._writer: PackedImagesWriter | None = None
+
+    def _key(self, dst: StrPath) -> str:
+        dst = os.path.abspath(dst)
+        if not dst.startswith(self._prefix):
+            raise ValueError(f"Packed image is outside of the output directory: {dst}")
+        return dst[len(self._prefix) :].replace(os.sep, "/")
+
+    def _transfer(self, src: StrPath, dst: StrPath):
+        try:
+            try:
+                with open(src, "rb") as f:
+                    data = f.read()
+                meta = probe_image(src)
+                width, height = meta.width, meta.height
+            except FileNotFoundError:
+                # images of another packed store are copied from it
+                found = find_packed_image(src)
+                if found is None:
+                    raise
+                store, row = found
+                data = store.get_bytes(row)
+                width, height = int(store.widths[row]), int(store.heights[row])
+            self._writer.add(self._key(dst), data, width, height)
+        except BaseException as e:
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+            return
+
+        with self._lock:
+            self.num_files += 1
+            self.num_bytes += len(data)
+
+    def submit(self, src: StrPath, dst: StrPath):
+        # submit is called by several threads in the pipelines of the
+        # converters, the store must be created once
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = PackedImagesWriter(self.output_dir)
+        super().submit(src, dst)
+
+    def wait(self):
+        try:
+            super().wait()
+        except BaseException:
+            if self._writer is not None:
+                self._writer.abort()
+            raise
+        if self._writer is not None:
+            self._writer.close()
+
+    def __exit__(self, exc_type, *args):
+        super().__exit__(exc_type, *args)
+        if exc_type is not None and self._writer is not None:
+            self._writer.abort()
+
+
+def open_file_transfer(
+    mode: str, workers: int = 4, output_dir: StrPath = ".", verbose: bool = True
+) -> FileTransfer:
+    """Return the FileTransfer of a converter, a PackTransfer into output_dir in "pack" mode"""
+
+    if mode == "pack":
+        return PackTransfer(output_dir, workers, verbose)
+    return FileTransfer(mode, workers, verbose)